@@ -1,6 +1,6 @@
 {
     'name': 'Slovak Tax Control Statement',
-    'version': '18.0.1.1.0',
+    'version': '18.0.1.4.0',
     'category': 'Accounting/Localizations/Reporting',
     'license': 'LGPL-3',
     'summary': 'Slovak Tax Control Statement (Kontrolný výkaz DPH)',
@@ -19,7 +19,9 @@ This module adds support for generating the Slovak Tax Control Statement (Kontro
         'views/kontrolny_vykaz_views.xml',
         'security/ir.model.access.csv',
         'data/sequence.xml',
+        'data/ir_cron.xml',
         'views/menu_views.xml',
+        'views/res_company_views.xml',
     ],
     'installable': True,
     'auto_install': False,
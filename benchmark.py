@@ -0,0 +1,84 @@
+"""Performance benchmark of the Slovak VAT control statement on synthetic data.
+
+For every size, creates a month of synthetic invoices, refunds and reversed
+invoices for the company, then measures the wall time, SQL query count and
+peak Python memory of the generation, the totals recomputation and both
+exports. Every size runs in its own transaction, which is rolled back, so the
+database is left untouched. Pick a period with no real documents.
+
+Usage:
+
+    python3 benchmark.py -c /etc/odoo/odoo.conf -d benchdb --company 1 \\
+        [--sizes 1000 10000 100000] [--year 2099 --month 1] \\
+        [--baseline kv_benchmark.json [--update-baseline]] [--tolerance 1.25]
+
+With --baseline, the run fails (exit code 1) when any measurement exceeds its
+baseline value times the tolerance; --update-baseline stores the run instead.
+"""
+import argparse
+import logging
+
+from update_database import _init_worker
+
+_logger = logging.getLogger('kontrolny_vykaz.benchmark')
+
+
+def _run_size(dbname, company_id, year, month, documents):
+    from odoo import api, SUPERUSER_ID
+    from odoo.modules.registry import Registry
+    from odoo.addons.kontrolny_vykaz.tools.benchmark import run_benchmark
+
+    with Registry(dbname).cursor() as cr:
+        env = api.Environment(cr, SUPERUSER_ID, {'allowed_company_ids': [company_id]})
+        try:
+            return run_benchmark(env, env['res.company'].browse(company_id), year, month, documents)
+        finally:
+            cr.rollback()
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.split('\n\n')[0])
+    parser.add_argument('-c', '--config', required=True, help='Odoo configuration file')
+    parser.add_argument('-d', '--database', required=True)
+    parser.add_argument('--company', type=int, required=True, help='company id to create the documents in')
+    parser.add_argument('--sizes', type=int, nargs='+',
+                        help='numbers of documents to benchmark (default: 1000 10000 100000)')
+    parser.add_argument('--year', type=int, default=2099)
+    parser.add_argument('--month', type=int, default=1, choices=range(1, 13))
+    parser.add_argument('--baseline', help='JSON file with the reference measurements')
+    parser.add_argument('--update-baseline', action='store_true', help='store this run as the baseline')
+    parser.add_argument('--tolerance', type=float, default=1.25,
+                        help='allowed ratio to the baseline before a run counts as a regression')
+    args = parser.parse_args()
+
+    _init_worker(['-c', args.config, '-d', args.database])
+    # The addons path is only known once the configuration is parsed
+    from odoo.addons.kontrolny_vykaz.tools.benchmark import (
+        BENCHMARK_OPERATIONS, BENCHMARK_SIZES, check_regressions, load_baseline, save_baseline,
+    )
+    results = {}
+    for size in args.sizes or BENCHMARK_SIZES:
+        _logger.info("Benchmarking %s documents", size)
+        results[size] = _run_size(args.database, args.company, args.year, args.month, size)
+
+    print(f"{'Documents':>10} {'Operation':<16} {'Seconds':>10} {'Queries':>10} {'Peak KiB':>10}")
+    for size, operations in results.items():
+        for operation in BENCHMARK_OPERATIONS:
+            measurement = operations[operation]
+            print(f"{size:>10} {operation:<16} {measurement['seconds']:>10.2f} {measurement['queries']:>10} "
+                  f"{measurement['peak_memory_kb']:>10}")
+
+    if not args.baseline:
+        return 0
+    if args.update_baseline:
+        save_baseline(args.baseline, results)
+        print(f"Baseline written to {args.baseline}")
+        return 0
+    regressions = check_regressions(results, load_baseline(args.baseline), args.tolerance)
+    for message in regressions:
+        print(f"REGRESSION: {message}")
+    return 1 if regressions else 0
+
+
+if __name__ == '__main__':
+    raise SystemExit(main())
@@ -0,0 +1,66 @@
+from werkzeug.exceptions import BadRequest, NotFound
+from werkzeug.wsgi import wrap_file
+
+from odoo import http
+from odoo.exceptions import UserError
+from odoo.http import request
+
+EXPORT_MIMETYPES = {
+    'xml': 'application/xml',
+    'excel': 'application/vnd.openxmlformats-officedocument.spreadsheetml.sheet',
+}
+
+
+class KontrolnyVykazController(http.Controller):
+
+    @http.route('/kontrolny_vykaz/<int:statement_id>/download/<string:kind>', type='http', auth='user')
+    def download(self, statement_id, kind, persist=None, **kwargs):
+        """Stream the XML or Excel file of a statement, built on request.
+
+        The file is built into a temporary file within the request and sent in
+        chunks from there, never base64-encoded nor written to the database.
+        With `persist=1` the regular export runs instead and its stored copy
+        is sent. Repeated downloads of an unchanged statement are answered with
+        304 Not Modified through the ETag.
+        """
+        if kind not in EXPORT_MIMETYPES:
+            raise NotFound()
+        statement = request.env['kontrolny.vykaz'].browse(statement_id).exists()
+        if not statement:
+            raise NotFound()
+        statement.check_access('read')
+
+        etag = statement._get_export_etag(kind)
+        if not persist and etag in request.httprequest.if_none_match:
+            response = request.make_response('', status=304)
+            response.set_etag(etag)
+            return response
+
+        filename = statement._get_export_filename(kind)
+        try:
+            if persist:
+                # The regular export stores the file in the history and moves the state
+                statement._check_exportable(kind)
+                if kind == 'xml':
+                    statement.action_export()
+                else:
+                    statement.action_export_excel()
+                export = statement.export_ids.filtered(lambda e: e.kind == kind)[:1]
+                if not export:
+                    raise UserError('Export sa nepodarilo uložiť.')
+                content = export._get_content()
+                etag = statement._get_export_etag(kind)
+                response = request.make_response(content)
+            else:
+                output = statement._open_export_file(kind)
+                response = request.make_response(wrap_file(request.httprequest.environ, output))
+                response.direct_passthrough = True
+        except UserError as e:
+            raise BadRequest(e.args[0])
+
+        response.headers['Content-Type'] = EXPORT_MIMETYPES[kind]
+        response.headers['Content-Disposition'] = http.content_disposition(filename)
+        # Always revalidate, so a changed statement is never served from the browser cache
+        response.headers['Cache-Control'] = 'private, no-cache'
+        response.set_etag(etag)
+        return response
@@ -1,35 +1,38 @@
+import importlib
+
 from odoo import api, SUPERUSER_ID
 
 def migrate(cr, version):
     """
-    Add is_refund column to kontrolny_vykaz_a_line table if it doesn't exist.
+    Add is_refund column to kontrolny_vykaz_a_line table if it doesn't exist and fill it in batches.
     """
-    # Check if the column exists
-    cr.execute("SELECT column_name FROM information_schema.columns WHERE table_name='kontrolny_vykaz_a_line' AND column_name='is_refund'")
-    if not cr.fetchone():
-        # Add the is_refund column with default value False
-        cr.execute("ALTER TABLE kontrolny_vykaz_a_line ADD COLUMN is_refund boolean DEFAULT FALSE")
-        
-        # Update environment
-        env = api.Environment(cr, SUPERUSER_ID, {})
-        
-        # Get all records that are refunds based on related invoice type
-        cr.execute("""
-            UPDATE kontrolny_vykaz_a_line kvl
-            SET is_refund = TRUE
-            FROM account_move am
-            WHERE kvl.invoice_id = am.id
-            AND (am.move_type = 'out_refund' OR am.payment_state = 'reversed')
-        """)
-        
-        # Log the migration
-        env['ir.logging'].create({
-            'name': 'kontrolny_vykaz_migration',
-            'type': 'server',
-            'dbname': cr.dbname,
-            'level': 'info',
-            'message': 'Added is_refund column to kontrolny_vykaz_a_line table and populated values',
-            'path': 'addons/kontrolny_vykaz/migrations/18.0.1.1.0/post-migrate.py',
-            'func': 'migrate',
-            'line': 23
-        })
+    env = api.Environment(cr, SUPERUSER_ID, {})
+    # Resolved through the module of the model, whatever the addon is installed as
+    backfill_in_batches = importlib.import_module(
+        f"odoo.addons.{env['kontrolny.vykaz']._module}.tools.migration").backfill_in_batches
+    
+    # Adding a column with a constant default only changes the catalog
+    cr.execute("ALTER TABLE kontrolny_vykaz_a_line ADD COLUMN IF NOT EXISTS is_refund boolean DEFAULT FALSE")
+    
+    # Mark the refunds based on related invoice type, batch by batch, within
+    # the upgrade transaction
+    updated = backfill_in_batches(
+        cr, 'kontrolny_vykaz_a_line',
+        assignments="is_refund = TRUE",
+        from_clause="account_move am",
+        condition="""t.invoice_id = am.id
+                     AND t.is_refund IS NOT TRUE
+                     AND (am.move_type = 'out_refund' OR am.payment_state = 'reversed')""",
+    )
+    
+    # Log the migration
+    env['ir.logging'].create({
+        'name': 'kontrolny_vykaz_migration',
+        'type': 'server',
+        'dbname': cr.dbname,
+        'level': 'info',
+        'message': f'Added is_refund column to kontrolny_vykaz_a_line table and marked {updated} refund lines',
+        'path': 'addons/kontrolny_vykaz/migrations/18.0.1.1.0/post-migrate.py',
+        'func': 'migrate',
+        'line': 13
+    })
@@ -0,0 +1,8 @@
+from odoo import api, SUPERUSER_ID
+
+def migrate(cr, version):
+    """
+    Fill the per-rate totals of existing statements, the totals are no longer a stored compute.
+    """
+    env = api.Environment(cr, SUPERUSER_ID, {})
+    env['kontrolny.vykaz'].with_context(active_test=False).search([])._compute_totals()
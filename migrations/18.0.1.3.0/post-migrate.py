@@ -0,0 +1,37 @@
+import hashlib
+
+from odoo import api, SUPERUSER_ID
+
+def migrate(cr, version):
+    """
+    Move the stored xml_file/excel_file attachments into the export history, the fields are now computed from it.
+    """
+    env = api.Environment(cr, SUPERUSER_ID, {})
+    Export = env['kontrolny.vykaz.export']
+    attachments = env['ir.attachment'].search([
+        ('res_model', '=', 'kontrolny.vykaz'),
+        ('res_field', 'in', ['xml_file', 'excel_file']),
+    ])
+    for attachment in attachments:
+        statement = env['kontrolny.vykaz'].browse(attachment.res_id).exists()
+        if not statement:
+            attachment.unlink()
+            continue
+        kind = 'xml' if attachment.res_field == 'xml_file' else 'excel'
+        data = attachment.raw or b''
+        export = Export.create({
+            'kontrolny_vykaz_id': statement.id,
+            'kind': kind,
+            'filename': (statement.xml_filename if kind == 'xml' else statement.excel_filename) or attachment.name,
+            'compression': 'none',
+            'file_size': len(data),
+            'stored_size': len(data),
+            'checksum': hashlib.sha1(data).hexdigest(),
+        })
+        attachment.write({
+            'res_model': Export._name,
+            'res_field': False,
+            'res_id': export.id,
+            'name': export.filename,
+        })
+        export.attachment_id = attachment
@@ -0,0 +1,33 @@
+import logging
+
+from odoo import api, SUPERUSER_ID
+
+_logger = logging.getLogger(__name__)
+
+
+def migrate(cr, version):
+    """
+    Drop the document summaries computed from the invoice prices, and make the statements not yet exported regenerate from scratch.
+    """
+    env = api.Environment(cr, SUPERUSER_ID, {})
+    Summary = env['kontrolny.vykaz.move.summary']
+    # Rebuilt outside of the upgrade by the summary backfill action; until
+    # then the summary mode falls back to the journal items
+    cr.execute(f"DELETE FROM {Summary._table}")
+    env['ir.config_parameter'].sudo().set_param('kontrolny_vykaz.summary_backfilled', False)
+    # Their incremental data still holds amounts computed from the invoice prices
+    env['kontrolny.vykaz'].search([('state', 'in', ['draft', 'generated'])]).write({
+        'generation_watermark': False,
+        'generation_data': False,
+    })
+    # The statement currency is now EUR instead of the company currency
+    eur = env.ref('base.EUR')
+    for company in env['res.company'].search([('currency_id', '!=', eur.id)]):
+        statements = env['kontrolny.vykaz'].search([
+            ('company_id', '=', company.id),
+            ('state', 'in', ['confirmed', 'exported']),
+        ])
+        if statements:
+            _logger.warning("Totals of the confirmed and exported statements %s of %s are in %s, now shown as EUR; "
+                            "reset and regenerate them to convert", ', '.join(statements.mapped('name')),
+                            company.name, company.currency_id.name)
@@ -1 +1,7 @@
-from . import kontrolny_vykaz
\ No newline at end of file
+from . import account_move
+from . import kontrolny_vykaz
+from . import kontrolny_vykaz_export
+from . import kontrolny_vykaz_move_summary
+from . import kontrolny_vykaz_snapshot
+from . import kontrolny_vykaz_timing
+from . import res_company
@@ -0,0 +1,36 @@
+from odoo import models
+
+
+class AccountMove(models.Model):
+    _inherit = 'account.move'
+
+    def _kv_refresh_summaries(self):
+        """Rebuild the control statement summaries of these customer moves and of the refunds reversing them"""
+        moves = self.filtered(lambda m: m.move_type in ('out_invoice', 'out_refund'))
+        if not moves:
+            return
+        # Refunds take their effective date from the invoice they reverse
+        refunds = self.search([('reversed_entry_id', 'in', moves.ids), ('move_type', '=', 'out_refund')])
+        self.env['kontrolny.vykaz.move.summary']._refresh_moves(moves.ids + refunds.ids)
+
+    def _post(self, soft=True):
+        posted = super()._post(soft=soft)
+        posted._kv_refresh_summaries()
+        return posted
+
+    def button_draft(self):
+        res = super().button_draft()
+        self._kv_refresh_summaries()
+        return res
+
+    def button_cancel(self):
+        res = super().button_cancel()
+        self._kv_refresh_summaries()
+        return res
+
+    def write(self, vals):
+        res = super().write(vals)
+        # Dates of posted documents can still be corrected in place
+        if {'taxable_supply_date', 'invoice_date', 'reversed_entry_id'} & set(vals):
+            self.filtered(lambda m: m.state == 'posted')._kv_refresh_summaries()
+        return res
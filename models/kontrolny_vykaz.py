@@ -1,15 +1,110 @@
 from odoo import models, fields, api
+from odoo.exceptions import UserError
+from odoo.tools import create_index, float_compare, human_size
 import base64
+import hashlib
 import xlsxwriter
-from io import BytesIO
+from html import escape as html_escape
+from io import StringIO
 from datetime import datetime, timedelta
 from dateutil.relativedelta import relativedelta
-import xml.etree.ElementTree as ET
-from xml.dom import minidom
+import tempfile
+import time
+from collections import Counter
+
+from ..tools.amounts import CurrencyRateCache, move_tax_amounts_query
+from ..tools.classification import KV_RATES, ClassificationCache, compact_sk_vat, is_sk_vat
+from ..tools.instrumentation import PhaseTimer
+from ..tools.kv_xml import KVXmlWriter
+from ..tools.kv_xsd import validate_stream
+from ..tools.line_archive import ARCHIVE_COLUMNS, pack_rows, unpack_rows
+from ..tools.reversal_map import ReversalMap
+from .kontrolny_vykaz_move_summary import SUMMARY_BACKFILLED_PARAM
 
 import logging
 _logger = logging.getLogger(__name__)
 
+# Exports bigger than this spill from memory to a temporary file
+EXPORT_SPOOL_MAX_SIZE = 8 * 1024 * 1024
+
+# Schema violations listed in the error of a rejected XML export
+XSD_MAX_REPORTED_VIOLATIONS = 20
+
+# Number of statement lines loaded at once when streaming exports
+LINE_BATCH_SIZE = 1000
+
+# Statement lines read at once when packing them into the archive
+ARCHIVE_FETCH_SIZE = 10000
+
+# Key of the unpacked line archives in the cursor cache
+ARCHIVE_CACHE_KEY = 'kontrolny_vykaz.line_archives'
+
+# Safety window for moves committed by transactions that were still running
+# when the previous incremental generation took its watermark
+WATERMARK_OVERLAP = timedelta(minutes=5)
+
+# First key of the advisory locks serialising generations of one statement
+GENERATION_LOCK_KEY = 5870411
+
+# Documents aggregated per committed chunk of a background generation
+GENERATION_CHUNK_SIZE = 2000
+
+# Posted customer invoices and refunds of the statement period (period_moves) and
+# the documents to aggregate (documents): those plus the refunds of reversed
+# invoices of the period. Expects the company_id, date_from and date_to parameters.
+PERIOD_DOCUMENTS_CTE = """
+    period_moves AS (
+        SELECT m.id, m.payment_state
+          FROM account_move m
+         WHERE m.company_id = %(company_id)s
+           AND m.move_type IN ('out_invoice', 'out_refund')
+           AND m.state = 'posted'
+           AND (
+                (m.taxable_supply_date >= %(date_from)s AND m.taxable_supply_date <= %(date_to)s)
+                OR (m.taxable_supply_date IS NULL
+                    AND m.invoice_date >= %(date_from)s AND m.invoice_date <= %(date_to)s)
+           )
+    ),
+    documents AS (
+        SELECT id, FALSE AS is_extra FROM period_moves
+         UNION
+        SELECT r.id, TRUE AS is_extra
+          FROM account_move r
+          JOIN period_moves o ON o.id = r.reversed_entry_id AND o.payment_state = 'reversed'
+         WHERE r.company_id = %(company_id)s
+           AND r.move_type = 'out_refund'
+           AND r.state = 'posted'
+           AND r.id NOT IN (SELECT id FROM period_moves)
+    )
+"""
+
+
+TOTAL_FIELDS = ['total_a_base', 'total_a_tax', 'total_c_base', 'total_c_tax'] + [
+    f'total_{section}_{kind}_{rate}' for section in ('a', 'c') for rate in KV_RATES for kind in ('base', 'tax')
+]
+
+
+def _add_to_totals(values, is_refund, tax_rate, base, tax, sign=1):
+    """Add one line (or group of lines) of the given rate to the totals dict `values`"""
+    section = 'c' if is_refund else 'a'
+    values[f'total_{section}_base'] += sign * base
+    values[f'total_{section}_tax'] += sign * tax
+    rate = round(tax_rate or 0)
+    if rate in KV_RATES:
+        values[f'total_{section}_base_{rate}'] += sign * base
+        values[f'total_{section}_tax_{rate}'] += sign * tax
+
+
+def _count_export_line(counters, line, classification):
+    """Count one exported line into the statistics of the export summary"""
+    if line.is_summary:
+        counters['summary_lines'] += 1
+        return
+    counters['lines_not_summary'] += 1
+    if is_sk_vat(line.partner_vat):
+        counters['sk_vat_id_lines'] += 1
+        if not classification.partner(line.partner_id.id).is_vat_payer:
+            counters['empty_odb_lines'] += 1
 
 
 class KontrolnyVykaz(models.Model):
@@ -32,13 +127,42 @@ class KontrolnyVykaz(models.Model):
     # A-section lines (customer invoices)
     a_section_line_ids = fields.One2many('kontrolny.vykaz.a.line', 'kontrolny_vykaz_id', 
                                         string='Oddiel A - Faktúry pre odberateľov')
+    # Counted with one grouped query, so that the form never loads the lines
+    a1_line_count = fields.Integer('Záznamy A1', compute='_compute_line_counts')
+    c1_line_count = fields.Integer('Záznamy C1', compute='_compute_line_counts')
+    summary_line_count = fields.Integer('Súhrnné riadky', compute='_compute_line_counts')
+    line_count = fields.Integer('Riadky', compute='_compute_line_counts')
+    
+    # Summary fields, maintained by the line hooks and the bulk insert paths;
+    # _compute_totals rebuilds them from the lines
+    total_a_base = fields.Monetary(string='Základ dane oddiel A', readonly=True, copy=False)
+    total_a_tax = fields.Monetary(string='DPH oddiel A', readonly=True, copy=False)
+    total_c_base = fields.Monetary(string='Základ dane oddiel C', readonly=True, copy=False)
+    total_c_tax = fields.Monetary(string='DPH oddiel C', readonly=True, copy=False)
+    
+    # Breakdown of the totals per tax rate
+    total_a_base_5 = fields.Monetary(string='Základ dane A 5 %', readonly=True, copy=False)
+    total_a_tax_5 = fields.Monetary(string='DPH A 5 %', readonly=True, copy=False)
+    total_a_base_19 = fields.Monetary(string='Základ dane A 19 %', readonly=True, copy=False)
+    total_a_tax_19 = fields.Monetary(string='DPH A 19 %', readonly=True, copy=False)
+    total_a_base_23 = fields.Monetary(string='Základ dane A 23 %', readonly=True, copy=False)
+    total_a_tax_23 = fields.Monetary(string='DPH A 23 %', readonly=True, copy=False)
+    total_c_base_5 = fields.Monetary(string='Základ dane C 5 %', readonly=True, copy=False)
+    total_c_tax_5 = fields.Monetary(string='DPH C 5 %', readonly=True, copy=False)
+    total_c_base_19 = fields.Monetary(string='Základ dane C 19 %', readonly=True, copy=False)
+    total_c_tax_19 = fields.Monetary(string='DPH C 19 %', readonly=True, copy=False)
+    total_c_base_23 = fields.Monetary(string='Základ dane C 23 %', readonly=True, copy=False)
+    total_c_tax_23 = fields.Monetary(string='DPH C 23 %', readonly=True, copy=False)
+    # The statement is filed in EUR, whatever the currency of the company books
+    # Always EUR, the currency of the filing, whatever the currency of the company books
+    currency_id = fields.Many2one('res.currency', string='Mena', compute='_compute_currency_id',
+                                  help='Mena výkazu, vždy EUR. Sumy z účtovníctva v inej mene sa prepočítavajú.')
     
-    # Summary fields
-    total_a_base = fields.Monetary(string='Základ dane oddiel A', compute='_compute_totals', store=True)
-    total_a_tax = fields.Monetary(string='DPH oddiel A', compute='_compute_totals', store=True)
-    total_c_base = fields.Monetary(string='Základ dane oddiel C', compute='_compute_totals', store=True)
-    total_c_tax = fields.Monetary(string='DPH oddiel C', compute='_compute_totals', store=True)
-    currency_id = fields.Many2one(related='company_id.currency_id', readonly=True)
+    # Monthly filers report per month, quarterly filers per calendar quarter
+    period_type = fields.Selection([
+        ('month', 'Mesačne'),
+        ('quarter', 'Štvrťročne'),
+    ], string='Obdobie', required=True, default='month')
     
     # For month selection
     month = fields.Selection([
@@ -54,17 +178,75 @@ class KontrolnyVykaz(models.Model):
         ('10', 'Október'),
         ('11', 'November'),
         ('12', 'December')
-    ], string='Mesiac', required=True)
+    ], string='Mesiac')
+    quarter = fields.Selection([
+        ('1', '1. štvrťrok'),
+        ('2', '2. štvrťrok'),
+        ('3', '3. štvrťrok'),
+        ('4', '4. štvrťrok'),
+    ], string='Štvrťrok')
     year = fields.Integer(string='Rok', required=True, default=lambda self: datetime.now().year)
     
-    # Excel export fields
-    excel_file = fields.Binary('Excel súbor', readonly=True)
+    # Lines of old exported statements, packed into one compressed attachment
+    # and removed from the line table
+    lines_archived = fields.Boolean('Riadky archivované', readonly=True, copy=False)
+    line_archive = fields.Binary('Archív riadkov', attachment=True, readonly=True, copy=False)
+    archived_line_count = fields.Integer('Počet archivovaných riadkov', readonly=True, copy=False)
+    
+    # History of exported files, stored as (optionally compressed) attachments
+    export_ids = fields.One2many('kontrolny.vykaz.export', 'kontrolny_vykaz_id', string='História exportov',
+                                 readonly=True, copy=False)
+    
+    # Excel export fields, the file is the latest Excel export of the history
+    excel_file = fields.Binary('Excel súbor', compute='_compute_excel_file')
     excel_filename = fields.Char('Názov Excel súboru', readonly=True)
     
-    # XML export fields 
-    xml_file = fields.Binary('XML súbor', readonly=True)
+    # XML export fields, the file is the latest XML export of the history
+    xml_file = fields.Binary('XML súbor', compute='_compute_xml_file')
     xml_filename = fields.Char('Názov XML súboru', readonly=True)
     
+    # Kind of the filing the XML export produces: the regular statement, or
+    # only the rows changed since the filed snapshot
+    filing_type = fields.Selection([
+        ('R', 'Riadny'),
+        ('O', 'Opravný'),
+        ('D', 'Dodatočný'),
+    ], string='Druh výkazu', required=True, default='R', copy=False, tracking=True)
+    snapshot_line_ids = fields.One2many('kontrolny.vykaz.snapshot.line', 'kontrolny_vykaz_id',
+                                        string='Podané riadky', readonly=True, copy=False)
+    snapshot_date = fields.Datetime('Podané riadky k', readonly=True, copy=False)
+    
+    # Counters of the last XML and Excel export, rendered into the log and the chatter
+    export_stats = fields.Json('Štatistika exportu', readonly=True, copy=False, prefetch=False)
+    
+    # Incremental generation: last change of customer invoices/refunds included in the
+    # statement and the per-document contributions to the summary lines
+    generation_watermark = fields.Datetime('Zahrnuté zmeny dokladov do', readonly=True, copy=False)
+    generation_data = fields.Json('Údaje generovania', readonly=True, copy=False, prefetch=False)
+    
+    # Background generation processed in committed chunks by a cron job
+    generation_job_state = fields.Selection([
+        ('queued', 'Vo fronte'),
+        ('running', 'Prebieha'),
+        ('done', 'Dokončené'),
+        ('failed', 'Zlyhalo'),
+    ], string='Generovanie na pozadí', readonly=True, copy=False)
+    generation_progress = fields.Float('Priebeh generovania', readonly=True, copy=False)
+    generation_job_error = fields.Text('Chyba generovania', readonly=True, copy=False)
+    generation_job_data = fields.Json(readonly=True, copy=False, prefetch=False)
+    
+    timing_ids = fields.One2many('kontrolny.vykaz.timing', 'kontrolny_vykaz_id', string='Meranie behov',
+                                 readonly=True, copy=False)
+    
+    debug_logging = fields.Boolean('Podrobné logovanie', copy=False,
+                                   help='Zapisuje do logu servera každý spracovaný doklad a riadok. '
+                                        'Pre všetky výkazy sa dá zapnúť systémovým parametrom kontrolny_vykaz.debug.')
+    
+    def init(self):
+        # Changed-move lookups of the incremental generation
+        create_index(self.env.cr, 'account_move_kv_company_write_date_index', 'account_move',
+                     ['company_id', 'write_date'])
+    
     @api.model_create_multi
     def create(self, vals_list):
         for vals in vals_list:
@@ -72,292 +254,1268 @@ class KontrolnyVykaz(models.Model):
                 vals['name'] = self.env['ir.sequence'].next_by_code('kontrolny.vykaz') or '/'
         return super().create(vals_list)
     
-    @api.onchange('month', 'year')
+    def _compute_currency_id(self):
+        self.currency_id = self.env.ref('base.EUR')
+    
+    def _compute_line_counts(self):
+        counts = {record.id: Counter() for record in self}
+        statement_ids = [record_id for record_id in self.ids if record_id]
+        if statement_ids:
+            self.env['kontrolny.vykaz.a.line'].flush_model(['kontrolny_vykaz_id', 'is_summary', 'is_refund'])
+            self.env.cr.execute("""
+                SELECT kontrolny_vykaz_id, is_summary IS TRUE, is_refund IS TRUE, COUNT(*)
+                  FROM kontrolny_vykaz_a_line
+                 WHERE kontrolny_vykaz_id = ANY(%s)
+              GROUP BY 1, 2, 3
+            """, [statement_ids])
+            for statement_id, is_summary, is_refund, count in self.env.cr.fetchall():
+                kind = 'summary' if is_summary else 'c1' if is_refund else 'a1'
+                counts[statement_id][kind] += count
+        for record in self:
+            record.a1_line_count = counts[record.id]['a1']
+            record.c1_line_count = counts[record.id]['c1']
+            record.summary_line_count = counts[record.id]['summary']
+            record.line_count = record.archived_line_count if record.lines_archived else sum(counts[record.id].values())
+    
+    @api.depends('export_ids')
+    def _compute_xml_file(self):
+        self._compute_export_file('xml', 'xml_file')
+    
+    @api.depends('export_ids')
+    def _compute_excel_file(self):
+        self._compute_export_file('excel', 'excel_file')
+    
+    def _compute_export_file(self, kind, field_name):
+        # Like ir.attachment.datas: with bin_size, only the size is read
+        bin_size = self.env.context.get('bin_size')
+        for record in self:
+            export = record.export_ids.filtered(lambda e: e.kind == kind)[:1]
+            if not export:
+                record[field_name] = False
+            elif bin_size:
+                record[field_name] = human_size(export.file_size)
+            else:
+                record[field_name] = base64.b64encode(export._get_content())
+    
+    def unlink(self):
+        # Drop the attachments of the exports along with them
+        self.export_ids.unlink()
+        return super().unlink()
+    
+    def write(self, vals):
+        # Lines generated for another period or company cannot be updated incrementally
+        if {'date_from', 'date_to', 'company_id', 'period_type'} & set(vals):
+            vals = dict(vals, generation_watermark=False, generation_data=False)
+        return super().write(vals)
+    
+    _sql_constraints = [
+        ('period_check', "CHECK((period_type = 'month' AND month IS NOT NULL) "
+                         "OR (period_type = 'quarter' AND quarter IS NOT NULL))",
+         'Vyberte mesiac alebo štvrťrok výkazu.'),
+    ]
+    
+    @api.onchange('period_type', 'month', 'quarter', 'year')
     def _onchange_period(self):
-        if self.month and self.year:
+        if self.period_type == 'quarter' and self.quarter and self.year:
+            date_from = datetime(int(self.year), 3 * int(self.quarter) - 2, 1).date()
+            self.date_from = date_from
+            self.date_to = date_from + relativedelta(months=3, days=-1)
+        elif self.period_type == 'month' and self.month and self.year:
             date_from = datetime(int(self.year), int(self.month), 1).date()
             date_to = (date_from + relativedelta(months=1, days=-1))
             self.date_from = date_from
             self.date_to = date_to
     
-    @api.depends('a_section_line_ids.base_amount', 'a_section_line_ids.tax_amount', 'a_section_line_ids.is_refund')
     def _compute_totals(self):
+        """Recompute the totals and their per-rate breakdown from the lines with one grouped query"""
+        if not self:
+            return
+        totals = {record.id: dict.fromkeys(TOTAL_FIELDS, 0.0) for record in self}
+        self._add_grouped_line_amounts(totals, 'kontrolny_vykaz_id = ANY(%s)', self.ids)
         for record in self:
-            # Check all lines first to debug potential issues
-            _logger.info(f"***** Computing totals - All lines details *****")
-            for line in record.a_section_line_ids:
-                _logger.info(f"Line: invoice_number={line.invoice_number}, is_refund={line.is_refund}, base_amount={line.base_amount}, tax_amount={line.tax_amount}")
-            
-            # Regular invoices (A section)
-            a_lines = record.a_section_line_ids.filtered(lambda l: not l.is_refund)
-            record.total_a_base = sum(a_lines.mapped('base_amount'))
-            record.total_a_tax = sum(a_lines.mapped('tax_amount'))
-            
-            # Refunds (C section)
-            c_lines = record.a_section_line_ids.filtered(lambda l: l.is_refund)
-            record.total_c_base = sum(c_lines.mapped('base_amount'))
-            record.total_c_tax = sum(c_lines.mapped('tax_amount'))
-            
-            # Log totals for debugging
-            _logger.info(f"Computed totals:")
-            _logger.info(f"- Section A (regular invoices): {len(a_lines)} records, base={record.total_a_base}, tax={record.total_a_tax}")
-            _logger.info(f"- Section C (refunds): {len(c_lines)} records, base={record.total_c_base}, tax={record.total_c_tax}")
-            _logger.info(f"- Total: base={record.total_a_base + record.total_c_base}, tax={record.total_a_tax + record.total_c_tax}")
+            record._write_totals(totals[record.id])
+            _logger.debug("Computed totals of %s: A base=%s, tax=%s; C base=%s, tax=%s", record.name,
+                          record.total_a_base, record.total_a_tax, record.total_c_base, record.total_c_tax)
+    
+    def _apply_line_totals(self, lines, sign=1):
+        """Add (or with sign=-1 subtract) the amounts of `lines` to the totals of their statements.
+
+        The amounts are summed by one grouped query, whatever the number of lines.
+        """
+        if not self or not lines:
+            return
+        totals = {record.id: {name: record[name] for name in TOTAL_FIELDS} for record in self}
+        self._add_grouped_line_amounts(totals, 'id = ANY(%s)', lines.ids, sign=sign)
+        for record in self:
+            record._write_totals(totals[record.id])
+    
+    def _add_grouped_line_amounts(self, totals, where, params, sign=1):
+        """Sum the lines matching `where` per statement, section and rate into `totals` ({statement_id: values})"""
+        self.env['kontrolny.vykaz.a.line'].flush_model(
+            ['kontrolny_vykaz_id', 'is_refund', 'tax_rate', 'base_amount', 'tax_amount'])
+        self.env.cr.execute(f"""
+            SELECT kontrolny_vykaz_id, is_refund, tax_rate, SUM(base_amount), SUM(tax_amount)
+              FROM kontrolny_vykaz_a_line
+             WHERE {where}
+          GROUP BY kontrolny_vykaz_id, is_refund, tax_rate
+        """, [params])
+        for statement_id, is_refund, tax_rate, base, tax in self.env.cr.fetchall():
+            if statement_id in totals:
+                _add_to_totals(totals[statement_id], is_refund, tax_rate, base or 0.0, tax or 0.0, sign=sign)
+    
+    def _write_totals(self, values):
+        self.ensure_one()
+        values = {name: self.currency_id.round(value) for name, value in values.items()}
+        if any(values[name] != self[name] for name in values):
+            self.write(values)
     
     def action_generate_statement(self):
         self.ensure_one()
-        self._unlink_existing_lines()
-        self._generate_a_section_lines()
+        self._lock_generation()
+        if self.generation_job_state in ('queued', 'running'):
+            raise UserError('Kontrolný výkaz sa práve generuje na pozadí.')
+        self._generate()
         self.state = 'generated'
         return True
     
+    def _generate(self, operation='generate'):
+        """Bring the lines and totals up to date, incrementally once generated before; return the run counters"""
+        self.ensure_one()
+        self._restore_lines()
+        timer = PhaseTimer(self.env.cr)
+        if self.generation_watermark:
+            counters = self._generate_incremental(timer=timer)
+        else:
+            with timer.phase('line_unlink') as phase:
+                phase['lines'] = len(self.a_section_line_ids)
+                self._unlink_existing_lines()
+            counters = self._generate_a_section_lines(timer=timer)
+        # The line hooks and the bulk insert paths keep the totals up to date
+        self._record_timings(operation, timer, counters)
+        return counters
+    
+    def action_generate_statement_full(self):
+        """Rebuild the statement from scratch, ignoring the incremental watermark"""
+        self.ensure_one()
+        self.write({'generation_watermark': False, 'generation_data': False})
+        return self.action_generate_statement()
+    
+    def action_generate_statement_async(self):
+        """Queue the generation for the background job instead of running it in the request"""
+        self._lock_generation()
+        for record in self:
+            if record.generation_job_state in ('queued', 'running'):
+                continue
+            record.write({
+                'generation_job_state': 'queued',
+                'generation_progress': 0.0,
+                'generation_job_error': False,
+                'generation_job_data': False,
+            })
+        self.env.ref(f'{self._module}.ir_cron_kontrolny_vykaz_generation')._trigger()
+        return True
+    
+    def _lock_generation(self, wait=False):
+        """Take the transaction-level advisory lock of the statements.
+
+        Without `wait`, raises if another transaction is generating one of them;
+        with `wait`, returns False instead.
+        """
+        for record in self:
+            self.env.cr.execute("SELECT pg_try_advisory_xact_lock(%s, %s)", [GENERATION_LOCK_KEY, record.id])
+            if not self.env.cr.fetchone()[0]:
+                if wait:
+                    return False
+                raise UserError(f'Kontrolný výkaz {record.name} sa práve generuje.')
+        return True
+    
+    @api.model
+    def _cron_process_generation_jobs(self):
+        """Process queued and interrupted background generations chunk by chunk.
+
+        Every chunk is committed, so a crashed or timed out run resumes from
+        the last committed chunk. When the time budget runs out the cron
+        triggers itself again.
+        """
+        budget = int(self.env['ir.config_parameter'].sudo().get_param('kontrolny_vykaz.job_time_budget', 120))
+        deadline = time.monotonic() + budget
+        for statement in self.search([('generation_job_state', 'in', ('queued', 'running'))], order='id'):
+            while True:
+                if time.monotonic() > deadline:
+                    self.env.ref(f'{self._module}.ir_cron_kontrolny_vykaz_generation')._trigger()
+                    return
+                try:
+                    finished = statement._run_generation_job_step()
+                    self.env.cr.commit()
+                except Exception as e:
+                    self.env.cr.rollback()
+                    _logger.exception("Background generation of %s failed", statement.name)
+                    statement.write({'generation_job_state': 'failed', 'generation_job_error': str(e)})
+                    self.env.cr.commit()
+                    break
+                if finished:
+                    break
+    
+    def _run_generation_job_step(self):
+        """Run the next step of the background generation; return True when there is nothing left to do"""
+        self.ensure_one()
+        if not self._lock_generation(wait=True):
+            # Another worker holds the statement, it will carry on
+            return True
+        # Read the job state committed by whoever ran the previous step
+        self.invalidate_recordset()
+        if self.generation_job_state not in ('queued', 'running'):
+            return True
+        
+        if self.generation_job_state == 'queued':
+            timer = PhaseTimer(self.env.cr)
+            if self.generation_watermark:
+                # Incremental updates are small enough for a single step
+                counters = self._generate_incremental(timer=timer)
+                self._finish_generation_job(timer, counters)
+                return True
+            with timer.phase('line_unlink') as phase:
+                phase['lines'] = len(self.a_section_line_ids)
+                self._unlink_existing_lines()
+            with timer.phase('move_search') as phase:
+                document_ids = self._get_period_document_ids()
+                phase['documents'] = len(document_ids)
+            self.write({
+                'generation_job_state': 'running',
+                'generation_progress': 0.0,
+                'generation_job_data': {
+                    'watermark': fields.Datetime.to_string(self._get_moves_watermark()),
+                    'total': len(document_ids),
+                    'pending': document_ids,
+                    'contributions': {},
+                    'counters': {},
+                    # Phases of all steps, recorded as one run at the end
+                    'timings': timer.dump(),
+                },
+            })
+            _logger.info("Background generation of %s started for %s documents", self.name, len(document_ids))
+            return False
+        
+        job = self.generation_job_data
+        timer = PhaseTimer.resume(self.env.cr, job.get('timings'))
+        chunk, pending = job['pending'][:GENERATION_CHUNK_SIZE], job['pending'][GENERATION_CHUNK_SIZE:]
+        if chunk:
+            counters = Counter(job['counters'])
+            groups = self._aggregate_document_groups(move_ids=chunk, counters=counters, timer=timer)
+            with timer.phase('line_creation') as phase:
+                vals_list, contributions = self._prepare_document_lines(groups)
+                self._create_lines(vals_list)
+                phase['documents'] = len(contributions)
+                phase['lines'] = len(vals_list)
+            counters['lines_created'] += len(vals_list)
+            job['counters'] = dict(counters)
+            job['timings'] = timer.dump()
+            job['contributions'].update({str(move_id): c for move_id, c in contributions.items()})
+            job['pending'] = pending
+            done = job['total'] - len(pending)
+            self.write({
+                'generation_job_data': job,
+                'generation_progress': 100.0 * done / job['total'],
+            })
+            _logger.debug("Background generation of %s: %s/%s documents", self.name, done, job['total'])
+            return False
+        
+        # All documents processed: summary lines and watermark
+        contributions = {int(move_id): c for move_id, c in job['contributions'].items()}
+        with timer.phase('line_creation') as phase:
+            summary = self._summarize_contributions(contributions.values())
+            summary_vals_list = self._prepare_summary_lines(summary)
+            self._create_lines(summary_vals_list)
+            self._store_generation_data(fields.Datetime.to_datetime(job['watermark']), contributions, summary)
+            phase['lines'] = len(summary_vals_list)
+        counters = Counter(job['counters'], summary_lines_created=len(summary_vals_list))
+        self._finish_generation_job(timer, counters)
+        self._log_run_summary("Background generation", counters)
+        return True
+    
+    def _finish_generation_job(self, timer, counters):
+        self._record_timings('generate_async', timer, counters)
+        self.write({
+            'state': 'generated',
+            'generation_job_state': 'done',
+            'generation_progress': 100.0,
+            'generation_job_data': False,
+        })
+        _logger.info("Background generation of %s finished", self.name)
+    
+    def _get_period_document_ids(self):
+        """Ids of all documents aggregated for the period, in aggregation order"""
+        self.ensure_one()
+        self.env['account.move'].flush_model()
+        self.env.cr.execute(f"""
+            WITH {PERIOD_DOCUMENTS_CTE}
+            SELECT d.id
+              FROM documents d
+              JOIN account_move m ON m.id = d.id
+          ORDER BY d.is_extra, m.date DESC, m.name DESC, m.id DESC
+        """, {
+            'company_id': self.company_id.id,
+            'date_from': self.date_from,
+            'date_to': self.date_to,
+        })
+        return [row[0] for row in self.env.cr.fetchall()]
+    
     def _unlink_existing_lines(self):
         self.a_section_line_ids.unlink()
     
-    def _generate_a_section_lines(self):
-        """Generate lines for Section A (sales to VAT payers) and summarize individuals"""
+    def _is_debug_logging(self):
+        """Whether per-document and per-line tracing is enabled for this statement"""
+        return bool(self.debug_logging or self.env['ir.config_parameter'].sudo().get_param('kontrolny_vykaz.debug'))
+    
+    def _log_run_summary(self, operation, counters):
+        """Log the counters of one generation or export run as a single record"""
+        if _logger.isEnabledFor(logging.INFO):
+            _logger.info("%s of %s: %s", operation, self.name,
+                         ", ".join(f"{key}={value}" for key, value in sorted(counters.items())) or "nothing to do")
+    
+    def _record_timings(self, operation, timer, counters=None):
+        """Store the phases measured by `timer` as one run of `operation`, plus a total row.
+
+        Only the last runs of the statement are kept, as set by the
+        kontrolny_vykaz.timing_retention parameter (20 by default).
+        """
         self.ensure_one()
+        counters = counters or Counter()
+        documents = sum(value for key, value in counters.items() if key.startswith('documents_'))
+        lines = sum(phase['lines'] for phase in timer.phases if phase['phase'] != 'line_unlink')
+        run_date = fields.Datetime.now()
+        vals_list = [dict(phase, kontrolny_vykaz_id=self.id, run_date=run_date, operation=operation)
+                     for phase in timer.phases]
+        vals_list.append({
+            'kontrolny_vykaz_id': self.id,
+            'run_date': run_date,
+            'operation': operation,
+            'phase': 'total',
+            'duration_ms': timer.elapsed_ms,
+            'query_count': timer.query_count,
+            'documents': documents,
+            'lines': lines,
+        })
+        self.env['kontrolny.vykaz.timing'].sudo().create(vals_list)
         
+        retention = int(self.env['ir.config_parameter'].sudo().get_param('kontrolny_vykaz.timing_retention', 20))
+        self.env['kontrolny.vykaz.timing'].flush_model()
+        self.env.cr.execute("""
+            DELETE FROM kontrolny_vykaz_timing
+             WHERE kontrolny_vykaz_id = %(statement_id)s
+               AND run_date < (SELECT run_date
+                                 FROM (SELECT DISTINCT run_date
+                                         FROM kontrolny_vykaz_timing
+                                        WHERE kontrolny_vykaz_id = %(statement_id)s) runs
+                                ORDER BY run_date DESC
+                               OFFSET %(offset)s LIMIT 1)
+        """, {'statement_id': self.id, 'offset': max(retention - 1, 0)})
+        if self.env.cr.rowcount:
+            self.env['kontrolny.vykaz.timing'].invalidate_model()
+    
+    def _get_aggregation_mode(self):
+        """Return the engine used to aggregate documents per tax rate.
+
+        'sql' aggregates the invoice lines in a single grouped query (default),
+        'summary' reads the per-move summaries kept at posting time, 'orm'
+        walks the records one by one and is kept as the reference implementation.
+        The summaries are only read once they have been backfilled for the
+        documents posted before the module kept them.
+        """
+        mode = self.env.context.get('kv_aggregation_mode')
+        if mode:
+            return mode if mode in ('summary', 'sql', 'orm') else 'sql'
+        params = self.env['ir.config_parameter'].sudo()
+        mode = params.get_param('kontrolny_vykaz.aggregation_mode', 'sql')
+        if mode == 'summary' and not params.get_param(SUMMARY_BACKFILLED_PARAM):
+            _logger.warning("Document summaries are not backfilled yet, aggregating %s from the journal items",
+                            self.name)
+            return 'sql'
+        return mode if mode in ('summary', 'sql', 'orm') else 'sql'
+
+    def _aggregate_document_groups(self, move_ids=None, counters=None, timer=None):
+        """Return one dict per (document, tax rate) with the base and tax sums of the period.
+
+        Each group carries the document data needed to build A1/C1 lines:
+        move_id, partner_id, partner_vat, has_vat_id, invoice_number,
+        invoice_date, supply_date, is_refund, tax_rate, base and tax. Base and
+        tax are taken from the posted journal items and converted to EUR.
+        With `move_ids`, only those documents are aggregated. Documents by
+        type, skipped 0% lines and documents outside the period are counted
+        into `counters`, the phases are measured by `timer`.
+        """
+        self.ensure_one()
+        timer = timer or PhaseTimer(self.env.cr)
+        rates = CurrencyRateCache(self.env, self.company_id)
+        mode = self._get_aggregation_mode()
+        if mode == 'orm':
+            groups = self._aggregate_document_groups_orm(move_ids=move_ids, counters=counters, timer=timer,
+                                                         rates=rates)
+        else:
+            # Search, reversal lookup and aggregation all happen in the one query
+            counters = counters if counters is not None else Counter()
+            engine = self._aggregate_document_groups_summary if mode == 'summary' else self._aggregate_document_groups_sql
+            with timer.phase('aggregation') as phase:
+                groups = engine(move_ids=move_ids, counters=counters, rates=rates)
+                phase['documents'] = sum(value for key, value in counters.items() if key.startswith('documents_'))
+                phase['lines'] = len(groups)
+
+        # Compares whole periods: chunks and incremental runs would repeat it every time
+        if move_ids is None and self.env['ir.config_parameter'].sudo().get_param('kontrolny_vykaz.aggregation_check'):
+            self._check_aggregation_engines()
+        return groups
+
+    def _aggregate_document_groups_sql(self, move_ids=None, counters=None, rates=None):
+        """Set-based aggregation of the journal items of all invoices and refunds of the period in one query"""
+        self.ensure_one()
+        counters = counters if counters is not None else Counter()
+        if move_ids is not None and not move_ids:
+            return []
+        # The restriction applies once documents are selected, so that refunds
+        # of reversed invoices keep following their original
+        move_filter = "WHERE d.id = ANY(%(move_ids)s)" if move_ids is not None else ""
+        self.env['account.move'].flush_model()
+        self.env['account.move.line'].flush_model()
+        self.env['res.partner'].flush_model(['vat'])
+        self.env['account.tax'].flush_model(['amount'])
+
+        self.env.cr.execute(f"""
+            WITH {PERIOD_DOCUMENTS_CTE},
+            dated AS (
+                SELECT m.id,
+                       d.is_extra,
+                       m.move_type = 'out_refund' AS is_refund,
+                       CASE WHEN m.move_type = 'out_refund' AND m.reversed_entry_id IS NOT NULL
+                            THEN COALESCE(o.taxable_supply_date, o.invoice_date)
+                            ELSE COALESCE(m.taxable_supply_date, m.invoice_date)
+                       END AS effective_date
+                  FROM documents d
+                  JOIN account_move m ON m.id = d.id
+             LEFT JOIN account_move o ON o.id = m.reversed_entry_id
+                {move_filter}
+            ),
+            amounts AS ({move_tax_amounts_query("IN (SELECT id FROM dated)")})
+            SELECT m.id AS move_id,
+                   m.move_type,
+                   m.payment_state,
+                   m.partner_id,
+                   p.vat AS partner_vat,
+                   COALESCE(UPPER(p.vat) LIKE 'SK%%', FALSE) AS has_vat_id,
+                   m.name AS invoice_number,
+                   m.invoice_date,
+                   m.date AS accounting_date,
+                   dt.effective_date AS supply_date,
+                   dt.is_refund,
+                   a.tax_rate,
+                   COUNT(a.line_id) AS line_count,
+                   SUM(a.base) AS base,
+                   SUM(a.tax) AS tax
+              FROM dated dt
+              JOIN account_move m ON m.id = dt.id
+         LEFT JOIN res_partner p ON p.id = m.partner_id
+              JOIN amounts a ON a.move_id = m.id
+          GROUP BY m.id, p.vat, dt.is_extra, dt.effective_date, dt.is_refund, a.tax_rate
+            HAVING a.tax_rate = 0 OR SUM(a.base) != 0
+          ORDER BY dt.is_extra, m.date DESC, m.name DESC, m.id DESC, MIN(a.line_id)
+        """, {
+            'company_id': self.company_id.id,
+            'date_from': self.date_from,
+            'date_to': self.date_to,
+            'move_ids': list(move_ids or []),
+        })
+        return self._collect_aggregated_groups(self.env.cr.dictfetchall(), counters, rates)
+
+    def _aggregate_document_groups_summary(self, move_ids=None, counters=None, rates=None):
+        """Range read of the per-move summaries of the period, one row per document and tax rate"""
+        self.ensure_one()
+        counters = counters if counters is not None else Counter()
+        if move_ids is not None and not move_ids:
+            return []
+        move_filter = "AND s.move_id = ANY(%(move_ids)s)" if move_ids is not None else ""
+        self.env['account.move'].flush_model()
+        self.env['res.partner'].flush_model(['vat'])
+        self.env['kontrolny.vykaz.move.summary'].flush_model()
+
+        # Documents of the period by their own date, plus refunds of reversed
+        # invoices of the period by the date of the invoice, as PERIOD_DOCUMENTS_CTE
+        self.env.cr.execute(f"""
+            WITH selected AS (
+                SELECT s.*,
+                       NOT (s.document_date BETWEEN %(date_from)s AND %(date_to)s) AS is_extra
+                  FROM kontrolny_vykaz_move_summary s
+             LEFT JOIN account_move o ON o.id = s.reversed_entry_id
+                 WHERE s.company_id = %(company_id)s
+                   AND (s.document_date BETWEEN %(date_from)s AND %(date_to)s
+                        OR (s.effective_date BETWEEN %(date_from)s AND %(date_to)s
+                            AND s.is_refund AND o.payment_state = 'reversed'))
+                   {move_filter}
+            )
+            SELECT m.id AS move_id,
+                   m.move_type,
+                   m.payment_state,
+                   m.partner_id,
+                   p.vat AS partner_vat,
+                   COALESCE(UPPER(p.vat) LIKE 'SK%%', FALSE) AS has_vat_id,
+                   m.name AS invoice_number,
+                   m.invoice_date,
+                   m.date AS accounting_date,
+                   s.effective_date AS supply_date,
+                   s.is_refund,
+                   s.tax_rate,
+                   s.line_count,
+                   s.base,
+                   s.tax
+              FROM selected s
+              JOIN account_move m ON m.id = s.move_id
+         LEFT JOIN res_partner p ON p.id = m.partner_id
+             WHERE s.tax_rate = 0 OR s.base != 0
+          ORDER BY s.is_extra, m.date DESC, m.name DESC, m.id DESC, s.sequence
+        """, {
+            'company_id': self.company_id.id,
+            'date_from': self.date_from,
+            'date_to': self.date_to,
+            'move_ids': list(move_ids or []),
+        })
+        return self._collect_aggregated_groups(self.env.cr.dictfetchall(), counters, rates)
+
+    def _collect_aggregated_groups(self, rows, counters, rates=None):
+        """Turn the rows of a grouped aggregation into groups in EUR, counting documents and skipped rows"""
+        rates = rates or CurrencyRateCache(self.env, self.company_id)
+        # 0% lines and documents dated outside the period come back as well,
+        # only to be counted
+        groups = []
+        seen_move_ids = set()
+        skipped_move_ids = set()
+        for group in rows:
+            accounting_date = group.pop('accounting_date')
+            if group['move_id'] not in seen_move_ids:
+                seen_move_ids.add(group['move_id'])
+                counters[self._document_counter_key(group['move_type'], group['payment_state'])] += 1
+            if not group['supply_date'] or not self.date_from <= group['supply_date'] <= self.date_to:
+                skipped_move_ids.add(group['move_id'])
+                continue
+            if not group['tax_rate']:
+                counters['skipped_zero_rate_lines'] += group['line_count']
+                continue
+            group['tax_rate'] = float(group['tax_rate'])
+            group['base'] = rates.convert(float(group['base']), accounting_date)
+            group['tax'] = rates.convert(float(group['tax']), accounting_date)
+            groups.append(group)
+        counters['skipped_out_of_period'] += len(skipped_move_ids)
+        counters['groups'] += len(groups)
+        return groups
+
+    @api.model
+    def _document_counter_key(self, move_type, payment_state):
+        if move_type == 'out_refund':
+            return 'documents_refund'
+        return 'documents_reversed_invoice' if payment_state == 'reversed' else 'documents_invoice'
+
+    def _aggregate_document_groups_orm(self, move_ids=None, counters=None, reversal_map=None, timer=None,
+                                       classification=None, rates=None):
+        """Aggregation walking every document, journal item and tax through the ORM.
+
+        It reads the same balances as the set-based engines; the amounts they
+        must all give are checked against hand-computed values in
+        tests/test_aggregation.py.
+        """
+        self.ensure_one()
+        counters = counters if counters is not None else Counter()
+        timer = timer or PhaseTimer(self.env.cr)
+        rates = rates or CurrencyRateCache(self.env, self.company_id)
+        classification = classification or ClassificationCache(self.env)
+        debug = self._is_debug_logging()
+
         # Get all invoices and refunds for the period based on dates
-        invoices = self.env['account.move'].search([
-            ('company_id', '=', self.company_id.id),
-            ('move_type', 'in', ['out_invoice', 'out_refund']),
-            ('state', '=', 'posted'),
-            '|',
-            '&',
-            ('taxable_supply_date', '>=', self.date_from),
-            ('taxable_supply_date', '<=', self.date_to),
-            '&',
-            ('taxable_supply_date', '=', False),
-            '&',
-            ('invoice_date', '>=', self.date_from),
-            ('invoice_date', '<=', self.date_to),
-        ])
+        with timer.phase('move_search') as phase:
+            invoices = self.env['account.move'].search([
+                ('company_id', '=', self.company_id.id),
+                ('move_type', 'in', ['out_invoice', 'out_refund']),
+                ('state', '=', 'posted'),
+                '|',
+                '&',
+                ('taxable_supply_date', '>=', self.date_from),
+                ('taxable_supply_date', '<=', self.date_to),
+                '&',
+                ('taxable_supply_date', '=', False),
+                '&',
+                ('invoice_date', '>=', self.date_from),
+                ('invoice_date', '<=', self.date_to),
+            ])
+            phase['documents'] = len(invoices)
         
-        # Also search for refunds that reference reversed invoices in our period
-        reversed_invoice_ids = invoices.filtered(lambda i: i.payment_state == 'reversed').ids
-        refunds_for_reversed = self.env['account.move'].search([
-            ('company_id', '=', self.company_id.id),
-            ('move_type', '=', 'out_refund'),
-            ('state', '=', 'posted'),
-            ('reversed_entry_id', 'in', reversed_invoice_ids)
-        ])
+        # Also collect refunds that reference reversed invoices in our period,
+        # all loaded at once into the reversal map shared by the whole run
+        with timer.phase('reversal_lookup') as phase:
+            reversed_invoice_ids = invoices.filtered(lambda i: i.payment_state == 'reversed').ids
+            if reversal_map is None:
+                reversal_map = ReversalMap(self.env)
+            reversal_map.add_originals(reversed_invoice_ids)
+            refunds_for_reversed = reversal_map.all_refunds().filtered(lambda r: r.company_id == self.company_id)
+            phase['documents'] = len(reversed_invoice_ids) + len(refunds_for_reversed)
         
         # Combine all invoices and refunds, removing duplicates
         all_documents = invoices | refunds_for_reversed
+        if move_ids is not None:
+            all_documents = all_documents.filtered(lambda d: d.id in move_ids)
         
-        # Log the results for debugging
-        regular_invoices = all_documents.filtered(lambda i: i.move_type == 'out_invoice' and i.payment_state != 'reversed')
-        reversed_invoices = all_documents.filtered(lambda i: i.move_type == 'out_invoice' and i.payment_state == 'reversed')
-        refunds = all_documents.filtered(lambda i: i.move_type == 'out_refund')
-        
-        _logger.info(f"Found {len(all_documents)} total invoices/refunds")
-        _logger.info(f"Regular invoices: {len(regular_invoices)}")
-        _logger.info(f"Reversed invoices: {len(reversed_invoices)}")
-        _logger.info(f"Refunds (out_refund): {len(refunds)}")
-        
-        if reversed_invoices:
-            for rev in reversed_invoices:
-                ref = self.env['account.move'].search([
-                    ('reversed_entry_id', '=', rev.id),
-                    ('move_type', '=', 'out_refund'),
-                    ('state', '=', 'posted')
-                ], limit=1)
-                if ref:
-                    _logger.info(f"Found refund {ref.name} for reversed invoice {rev.name}")
-                else:
-                    _logger.info(f"No refund found for reversed invoice {rev.name}")
+        with timer.phase('aggregation') as aggregation_phase:
+            aggregation_phase['documents'] = len(all_documents)
+            # Partners and taxes of all documents classified up front
+            classification.add_partners(all_documents.partner_id.ids)
+            classification.add_taxes(all_documents.line_ids.tax_ids.ids + all_documents.line_ids.tax_line_id.ids)
+            for document in all_documents:
+                counters[self._document_counter_key(document.move_type, document.payment_state)] += 1
         
-        # Storage for individuals summary (grouped by tax rate)
-        individuals_tax_groups = {}
+            if debug:
+                for rev in all_documents.filtered(lambda i: i.move_type == 'out_invoice' and i.payment_state == 'reversed'):
+                    ref = reversal_map.refunds_for(rev.id)[:1]
+                    if ref:
+                        _logger.info("Found refund %s for reversed invoice %s", ref.name, rev.name)
+                    else:
+                        _logger.info("No refund found for reversed invoice %s", rev.name)
         
-        # Storage for refunds summary (grouped by tax rate)
-        refunds_tax_groups = {}
+            groups = []
         
-        # Process each document (invoice or refund)
-        for document in all_documents:
-            # Check if the partner has a Slovak VAT ID - that's the ONLY condition for going into separate A1/C1 records
-            # The x_platca_dph field only affects whether the VAT ID is shown in the XML/Excel
-            has_vat_id = document.partner_id.vat and document.partner_id.vat.upper().startswith('SK')
+            # Process each document (invoice or refund)
+            for document in all_documents:
+                # Check if the partner has a Slovak VAT ID - that's the ONLY condition for going into separate A1/C1 records
+                # The x_platca_dph field only affects whether the VAT ID is shown in the XML/Excel
+                has_vat_id = classification.partner(document.partner_id.id).has_sk_vat
             
-            # Check if this is a refund (only out_refund is considered a refund now)
-            is_refund = document.move_type == 'out_refund'
+                # Check if this is a refund (only out_refund is considered a refund now)
+                is_refund = document.move_type == 'out_refund'
             
-            # Log whether we're marking this as a refund
-            _logger.info(f"Document {document.name} is_refund flag: {is_refund} (move_type: {document.move_type})")
+                if debug:
+                    _logger.info("Document %s is_refund flag: %s (move_type: %s)", document.name, is_refund, document.move_type)
             
-            # Use taxable_supply_date if available, otherwise fall back to invoice_date
-            effective_date = document.taxable_supply_date or document.invoice_date
+                # Use taxable_supply_date if available, otherwise fall back to invoice_date
+                effective_date = document.taxable_supply_date or document.invoice_date
             
-            # For refunds that reference a reversed invoice, use the date from the original invoice
-            if is_refund and document.reversed_entry_id:
-                original_invoice = document.reversed_entry_id
-                effective_date = original_invoice.taxable_supply_date or original_invoice.invoice_date
-                _logger.info(f"Using date {effective_date} from original invoice {original_invoice.name} for refund {document.name}")
+                # For refunds that reference a reversed invoice, use the date from the original invoice
+                if is_refund and document.reversed_entry_id:
+                    original_invoice = document.reversed_entry_id
+                    effective_date = original_invoice.taxable_supply_date or original_invoice.invoice_date
+                    if debug:
+                        _logger.info("Using date %s from original invoice %s for refund %s",
+                                     effective_date, original_invoice.name, document.name)
                 
-                # Make absolutely sure this is marked as a refund
-                is_refund = True
-                _logger.info(f"Confirmed refund status for {document.name} (move_type: {document.move_type})")
+                    # Make absolutely sure this is marked as a refund
+                    is_refund = True
             
-            # Skip if the effective date is not in our period
-            if not effective_date or effective_date < self.date_from or effective_date > self.date_to:
-                _logger.info(f"Skipping document {document.name} with date {effective_date} outside period {self.date_from}-{self.date_to}")
-                continue
+                # Skip if the effective date is not in our period
+                if not effective_date or effective_date < self.date_from or effective_date > self.date_to:
+                    counters['skipped_out_of_period'] += 1
+                    if debug:
+                        _logger.info("Skipping document %s with date %s outside period %s-%s",
+                                     document.name, effective_date, self.date_from, self.date_to)
+                    continue
                 
-            # For debugging
-            if is_refund:
-                _logger.info(f"Processing refund: {document.name}, move_type: {document.move_type}, " 
-                           f"payment_state: {document.payment_state}, effective_date: {effective_date}")
-                if document.reversed_entry_id:
-                    _logger.info(f"  → References original invoice: {document.reversed_entry_id.name}")
-            elif document.payment_state == 'reversed':
-                _logger.info(f"Processing reversed invoice: {document.name}, move_type: {document.move_type}, " 
-                           f"payment_state: {document.payment_state}, effective_date: {effective_date}")
-                # Try to find the refund
-                refund = self.env['account.move'].search([
-                    ('reversed_entry_id', '=', document.id),
-                    ('move_type', '=', 'out_refund'),
-                    ('state', '=', 'posted')
-                ], limit=1)
-                if refund:
-                    _logger.info(f"  → Has refund: {refund.name}")
+                if debug:
+                    if is_refund:
+                        _logger.info("Processing refund: %s, payment_state: %s, effective_date: %s, original invoice: %s",
+                                     document.name, document.payment_state, effective_date, document.reversed_entry_id.name)
+                    elif document.payment_state == 'reversed':
+                        _logger.info("Processing reversed invoice: %s, effective_date: %s, refund: %s",
+                                     document.name, effective_date, reversal_map.refunds_for(document.id)[:1].name)
                 
-            # Group by tax rate
-            tax_groups = {}
-            for line in document.invoice_line_ids:
-                if not line.tax_ids:
-                    continue
-                    
-                # Process only lines with VAT taxes
-                for tax in line.tax_ids:
-                    # Skip lines with 0% VAT
-                    if tax.amount == 0:
-                        _logger.info(f"Skipping line with 0% VAT from {document.name}")
+                # Group by tax rate, in company currency: the balance of a customer
+                # document is a credit, so negated it is positive for invoices
+                # and negative for refunds
+                tax_groups = {}
+                for line in document.line_ids:
+                    if line.display_type == 'tax':
+                        # The tax of a rate is what its tax lines posted, not
+                        # the whole tax of the base lines carrying it
+                        if not line.tax_line_id:
+                            continue
+                        tax_info = classification.tax(line.tax_line_id.id)
+                        if tax_info.is_zero:
+                            continue
+                        tax_groups.setdefault(tax_info.rate, {'base': 0.0, 'tax': 0.0})['tax'] -= line.balance
+                        continue
+                    if line.display_type not in ('product', 'line_section', 'line_note') or not line.tax_ids:
                         continue
-                        
-                    if tax.amount not in tax_groups:
-                        tax_groups[tax.amount] = {
-                            'base': 0.0,
-                            'tax': 0.0
-                        }
-                    
-                    # Calculate base and tax amounts
-                    price_subtotal = line.price_subtotal
-                    tax_amount = line.price_total - line.price_subtotal
-                    
-                    # For refunds (out_refund only), make sure the amounts are negative
-                    if is_refund:  # is_refund is now only true for out_refund
-                        # For refunds, we need the negative amounts for balance calculations
-                        # This is crucial for reports to show correct subtraction
-                        price_subtotal = -abs(price_subtotal)
-                        tax_amount = -abs(tax_amount)
-                        _logger.info(f"Adjusted amounts for refund: price_subtotal={price_subtotal}, tax_amount={tax_amount}")
                     
-                    # Add to group
-                    tax_groups[tax.amount]['base'] += price_subtotal
-                    tax_groups[tax.amount]['tax'] += tax_amount
+                    # Process only lines with VAT taxes
+                    for tax_id in line.tax_ids.ids:
+                        tax_info = classification.tax(tax_id)
+                        # Skip lines with 0% VAT
+                        if tax_info.is_zero:
+                            counters['skipped_zero_rate_lines'] += 1
+                            continue
+                        tax_groups.setdefault(tax_info.rate, {'base': 0.0, 'tax': 0.0})['base'] -= line.balance
             
-            # Process the grouped data
-            for tax_rate, amounts in tax_groups.items():
-                if amounts['base'] == 0:
-                    continue
-                
-                _logger.info(f"Processing tax rate {tax_rate}% for document {document.name}: base={amounts['base']}, tax={amounts['tax']}")
-                
-                if has_vat_id:
-                    # Create individual line for each entity with Slovak VAT ID
-                    # regardless of x_platca_dph status
-                    line_vals = {
-                        'kontrolny_vykaz_id': self.id,
+                for tax_rate, amounts in tax_groups.items():
+                    if amounts['base'] == 0:
+                        continue
+                    groups.append({
+                        'move_id': document.id,
                         'partner_id': document.partner_id.id,
                         'partner_vat': document.partner_id.vat,
-                        'invoice_id': document.id,
+                        'has_vat_id': has_vat_id,
                         'invoice_number': document.name,
                         'invoice_date': document.invoice_date,
                         'supply_date': effective_date,
-                        'base_amount': amounts['base'],
+                        'is_refund': is_refund,
                         'tax_rate': tax_rate,
-                        'tax_amount': amounts['tax'],
-                        'is_refund': is_refund,  # Flag for credit notes
-                    }
-                    
-                    # Log creation of line
-                    _logger.info(f"Creating {'refund' if is_refund else 'invoice'} line with values: {line_vals}")
-                    
-                    # Create the line and log its ID to track it
-                    new_line = self.env['kontrolny.vykaz.a.line'].create(line_vals)
-                    _logger.info(f"Created line ID {new_line.id} with is_refund={new_line.is_refund}")
-                else:
-                    # For non-VAT ID partners, add to summary (individuals for invoices, separate for refunds)
-                    if is_refund:
-                        # Track refunds without VAT ID separately
-                        if tax_rate not in refunds_tax_groups:
-                            refunds_tax_groups[tax_rate] = {
-                                'base': 0.0,
-                                'tax': 0.0,
-                                'count': 0
-                            }
-                        
-                        refunds_tax_groups[tax_rate]['base'] += amounts['base']
-                        refunds_tax_groups[tax_rate]['tax'] += amounts['tax']
-                        refunds_tax_groups[tax_rate]['count'] += 1
+                        'base': rates.convert(amounts['base'], document.date),
+                        'tax': rates.convert(amounts['tax'], document.date),
+                    })
+            aggregation_phase['lines'] = len(groups)
+        counters['groups'] += len(groups)
+        return groups
+
+    def _check_aggregation_engines(self):
+        """Run the set-based engine in use and the ORM engine side by side and return the groups on which they disagree.
+
+        The set-based engine is the summary read in 'summary' mode and the
+        grouped line query otherwise. Mismatches are logged as warnings; an
+        empty list means both engines agree.
+        """
+        self.ensure_one()
+        rounding = self.currency_id.rounding or 0.01
+        mode = 'summary' if self._get_aggregation_mode() == 'summary' else 'sql'
+
+        def key(group):
+            return group['move_id'], round(group['tax_rate'], 4)
+
+        engine = self._aggregate_document_groups_summary if mode == 'summary' else self._aggregate_document_groups_sql
+        sql_groups = {key(g): g for g in engine()}
+        orm_groups = {key(g): g for g in self._aggregate_document_groups_orm()}
+
+        mismatches = []
+        for group_key in sql_groups.keys() | orm_groups.keys():
+            sql_group = sql_groups.get(group_key)
+            orm_group = orm_groups.get(group_key)
+            if not sql_group or not orm_group:
+                mismatches.append((group_key, sql_group, orm_group))
+                continue
+            if (float_compare(sql_group['base'], orm_group['base'], precision_rounding=rounding)
+                    or float_compare(sql_group['tax'], orm_group['tax'], precision_rounding=rounding)
+                    or sql_group['is_refund'] != orm_group['is_refund']
+                    or sql_group['has_vat_id'] != orm_group['has_vat_id']
+                    or sql_group['supply_date'] != orm_group['supply_date']):
+                mismatches.append((group_key, sql_group, orm_group))
+
+        for group_key, sql_group, orm_group in mismatches:
+            _logger.warning("Aggregation mismatch for %s on move/rate %s: %s=%s orm=%s",
+                            self.name, group_key, mode, sql_group, orm_group)
+        if not mismatches:
+            _logger.info("%s and ORM aggregation agree for %s (%s groups)", mode, self.name, len(sql_groups))
+        return mismatches
+
+    def _generate_a_section_lines(self, timer=None):
+        """Generate lines for Section A (sales to VAT payers) and summarize individuals; return the run counters"""
+        self.ensure_one()
+        timer = timer or PhaseTimer(self.env.cr)
+        if self.period_type == 'quarter':
+            return self._generate_quarter_lines(timer=timer)
+        watermark = self._get_moves_watermark()
+        counters = Counter()
+        
+        groups = self._aggregate_document_groups(counters=counters, timer=timer)
+        with timer.phase('line_creation') as phase:
+            vals_list, contributions = self._prepare_document_lines(groups)
+            summary = self._summarize_contributions(contributions.values())
+            summary_vals_list = self._prepare_summary_lines(summary)
+            
+            self._create_lines(vals_list + summary_vals_list)
+            self._store_generation_data(watermark, contributions, summary)
+            phase['documents'] = len({group['move_id'] for group in groups})
+            phase['lines'] = len(vals_list) + len(summary_vals_list)
+        counters.update(lines_created=len(vals_list), summary_lines_created=len(summary_vals_list))
+        self._log_run_summary("Generation", counters)
+        return counters
+
+    def _generate_incremental(self, timer=None):
+        """Recompute only the lines of moves posted, reset, reversed or changed since the last generation.
+
+        A1/C1 lines of the affected moves are replaced, the individuals and
+        refunds summaries are adjusted by the difference between the old and
+        the new contributions of those moves. Return the run counters.
+        """
+        self.ensure_one()
+        timer = timer or PhaseTimer(self.env.cr)
+        watermark = self._get_moves_watermark()
+        data = self.generation_data or {}
+        contributions = {int(move_id): contribution for move_id, contribution in data.get('contributions', {}).items()}
+        summary = data.get('summary') or {'individuals': {}, 'refunds': {}}
+        
+        affected_ids = self._get_changed_move_ids(self.generation_watermark)
+        
+        # Moves deleted since the last run only left their contributions behind
+        if contributions:
+            self.env.cr.execute("SELECT id FROM account_move WHERE id = ANY(%s)", [list(contributions)])
+            affected_ids |= set(contributions) - {row[0] for row in self.env.cr.fetchall()}
+        
+        Line = self.env['kontrolny.vykaz.a.line']
+        stale_lines = Line.search([
+            ('kontrolny_vykaz_id', '=', self.id),
+            ('is_summary', '=', False),
+            '|',
+            ('invoice_id', 'in', list(affected_ids)),
+            ('invoice_id', '=', False),
+        ])
+        if not affected_ids and not stale_lines:
+            _logger.info("No invoices or refunds changed for %s since %s", self.name, self.generation_watermark)
+            self.generation_watermark = watermark
+            return Counter()
+        with timer.phase('line_unlink') as phase:
+            phase['lines'] = len(stale_lines)
+            stale_lines.unlink()
+        
+        old_contributions = [contributions.pop(move_id) for move_id in affected_ids if move_id in contributions]
+        counters = Counter(moves_affected=len(affected_ids), stale_lines_removed=len(stale_lines))
+        groups = self._aggregate_document_groups(move_ids=list(affected_ids), counters=counters,
+                                                 timer=timer) if affected_ids else []
+        with timer.phase('line_creation') as phase:
+            vals_list, new_contributions = self._prepare_document_lines(groups)
+            contributions.update(new_contributions)
+        
+            # Adjust the summaries by delta and rewrite the few summary lines
+            self._summarize_contributions(old_contributions, sign=-1, summary=summary)
+            self._summarize_contributions(new_contributions.values(), summary=summary)
+            for kind in ('individuals', 'refunds'):
+                for rate_key, (base, tax, count) in list(summary[kind].items()):
+                    if count <= 0:
+                        del summary[kind][rate_key]
                     else:
-                        # Regular individuals (without refunds)
-                        if tax_rate not in individuals_tax_groups:
-                            individuals_tax_groups[tax_rate] = {
-                                'base': 0.0,
-                                'tax': 0.0,
-                                'count': 0
-                            }
-                        
-                        individuals_tax_groups[tax_rate]['base'] += amounts['base']
-                        individuals_tax_groups[tax_rate]['tax'] += amounts['tax']
-                        individuals_tax_groups[tax_rate]['count'] += 1
-        
-        # Create summary lines for individuals
-        for tax_rate, data in individuals_tax_groups.items():
-            if data['base'] > 0:
-                self.env['kontrolny.vykaz.a.line'].create({
+                        summary[kind][rate_key] = [self.currency_id.round(base), self.currency_id.round(tax), count]
+            Line.search([('kontrolny_vykaz_id', '=', self.id), ('is_summary', '=', True)]).unlink()
+            summary_vals_list = self._prepare_summary_lines(summary)
+        
+            self._create_lines(vals_list + summary_vals_list)
+            self._store_generation_data(watermark, contributions, summary)
+            phase['documents'] = len(affected_ids)
+            phase['lines'] = len(vals_list) + len(summary_vals_list)
+        counters.update(lines_created=len(vals_list), summary_lines_created=len(summary_vals_list))
+        self._log_run_summary("Incremental generation", counters)
+        return counters
+
+    def _generate_quarter_lines(self, timer=None):
+        """Build a quarterly statement from the lines and summaries of its three monthly statements.
+
+        Draft monthly statements are brought up to date incrementally first.
+        The A1/C1 lines of every month whose statement is current are copied
+        with one INSERT ... SELECT and its summaries and contributions merged;
+        only the other months are aggregated from the documents. Return the run
+        counters.
+        """
+        self.ensure_one()
+        timer = timer or PhaseTimer(self.env.cr)
+        counters = Counter()
+        watermark = self._get_moves_watermark()
+        monthly_statements = self.browse()
+        groups = []
+        for date_from, date_to in self._get_quarter_months():
+            monthly = self._find_for_period(self.company_id, date_from, date_to)
+            if (monthly and monthly.state == 'draft' and monthly.generation_watermark
+                    and monthly.generation_job_state not in ('queued', 'running')
+                    and monthly._lock_generation(wait=True)):
+                monthly._generate()
+            if monthly and monthly._has_current_lines():
+                monthly_statements |= monthly
+                continue
+            # No usable monthly data: aggregate the month as a statement of its own would
+            month = self.new({'name': self.name, 'company_id': self.company_id.id,
+                              'date_from': date_from, 'date_to': date_to})
+            groups += month._aggregate_document_groups(counters=counters, timer=timer)
+            counters['months_scanned'] += 1
+        
+        with timer.phase('line_creation') as phase:
+            vals_list, contributions = self._prepare_document_lines(groups)
+            summary = self._summarize_contributions(contributions.values())
+            for monthly in monthly_statements:
+                data = monthly.generation_data or {}
+                contributions.update({int(move_id): c for move_id, c in data.get('contributions', {}).items()})
+                self._merge_summary(summary, data.get('summary') or {})
+                watermark = min(watermark, monthly.generation_watermark)
+            summary_vals_list = self._prepare_summary_lines(summary)
+            
+            copied = self._copy_statement_lines(monthly_statements)
+            self._create_lines(vals_list + summary_vals_list)
+            self._store_generation_data(watermark, contributions, summary)
+            phase['documents'] = len({group['move_id'] for group in groups})
+            phase['lines'] = copied + len(vals_list) + len(summary_vals_list)
+        counters.update(months_merged=len(monthly_statements), lines_copied=copied,
+                        lines_created=len(vals_list), summary_lines_created=len(summary_vals_list))
+        self._log_run_summary("Quarterly generation", counters)
+        return counters
+    
+    def _get_quarter_months(self):
+        """(date_from, date_to) of each month of a quarterly statement"""
+        self.ensure_one()
+        starts = [self.date_from + relativedelta(months=offset) for offset in range(3)]
+        return [(start, start + relativedelta(months=1, days=-1)) for start in starts]
+    
+    def _has_current_lines(self):
+        """Whether the lines still match the documents: no invoice or refund changed since the last generation affects them"""
+        self.ensure_one()
+        if (not self.generation_watermark or self.lines_archived
+                or self.generation_job_state in ('queued', 'running')):
+            return False
+        changed_ids = self._get_changed_move_ids(self.generation_watermark)
+        if not changed_ids:
+            return True
+        contributions = (self.generation_data or {}).get('contributions', {})
+        if any(str(move_id) in contributions for move_id in changed_ids):
+            return False
+        if self.env['kontrolny.vykaz.a.line'].search_count([
+                ('kontrolny_vykaz_id', '=', self.id),
+                ('invoice_id', 'in', list(changed_ids)),
+        ], limit=1):
+            return False
+        # Changed moves the statement did not include may belong to it now
+        return not self._aggregate_document_groups(move_ids=list(changed_ids))
+    
+    def _merge_summary(self, summary, other):
+        """Add the individuals and refunds summaries `other` into `summary`, rounded per rate"""
+        for kind in ('individuals', 'refunds'):
+            for rate_key, (base, tax, count) in (other.get(kind) or {}).items():
+                bucket = summary[kind].setdefault(rate_key, [0.0, 0.0, 0])
+                bucket[0] = self.currency_id.round(bucket[0] + base)
+                bucket[1] = self.currency_id.round(bucket[1] + tax)
+                bucket[2] += count
+        return summary
+    
+    def _copy_statement_lines(self, statements):
+        """Copy the A1/C1 lines of `statements` into this statement with one INSERT ... SELECT; return their number"""
+        self.ensure_one()
+        if not statements:
+            return 0
+        Line = self.env['kontrolny.vykaz.a.line']
+        Line.flush_model()
+        now = fields.Datetime.now()
+        self.env.cr.execute(f"""
+            INSERT INTO {Line._table} (kontrolny_vykaz_id, partner_id, partner_vat, invoice_id, invoice_number,
+                                       invoice_date, supply_date, base_amount, tax_rate, tax_amount,
+                                       is_summary, is_refund, create_uid, create_date, write_uid, write_date)
+            SELECT %(statement_id)s, partner_id, partner_vat, invoice_id, invoice_number,
+                   invoice_date, supply_date, base_amount, tax_rate, tax_amount,
+                   FALSE, is_refund, %(uid)s, %(now)s, %(uid)s, %(now)s
+              FROM {Line._table}
+             WHERE kontrolny_vykaz_id = ANY(%(source_ids)s)
+               AND is_summary IS NOT TRUE
+          ORDER BY kontrolny_vykaz_id, id
+         RETURNING id
+        """, {'statement_id': self.id, 'source_ids': statements.ids, 'uid': self.env.uid, 'now': now})
+        copied_ids = [row[0] for row in self.env.cr.fetchall()]
+        # Rows were written behind the ORM's back: drop stale caches and add
+        # the new lines to the totals as the create hook would
+        Line.invalidate_model()
+        self.invalidate_recordset(['a_section_line_ids'])
+        self._apply_line_totals(Line.browse(copied_ids))
+        return len(copied_ids)
+    
+    def _get_moves_watermark(self):
+        """Latest change of any customer invoice or refund of the company"""
+        self.ensure_one()
+        return self._get_company_moves_watermark(self.company_id) or fields.Datetime.now()
+    
+    @api.model
+    def _get_company_moves_watermark(self, company):
+        """Latest change of any customer invoice or refund of `company`, None when it has none"""
+        self.env['account.move'].flush_model(['write_date'])
+        self.env.cr.execute("""
+            SELECT MAX(write_date)
+              FROM account_move
+             WHERE company_id = %s
+               AND move_type IN ('out_invoice', 'out_refund')
+        """, [company.id])
+        return self.env.cr.fetchone()[0]
+
+    def _get_changed_move_ids(self, since):
+        """Ids of customer invoices and refunds changed after `since`, with their reversal counterparts"""
+        self.ensure_one()
+        self.env['account.move'].flush_model(['write_date', 'reversed_entry_id'])
+        # Transactions still running when the watermark was taken commit with an
+        # older write_date, an overlap window makes sure they are picked up
+        self.env.cr.execute("""
+            WITH changed AS (
+                SELECT id, reversed_entry_id
+                  FROM account_move
+                 WHERE company_id = %(company_id)s
+                   AND move_type IN ('out_invoice', 'out_refund')
+                   AND write_date > %(since)s
+            )
+            SELECT id FROM changed
+             UNION
+            SELECT reversed_entry_id FROM changed WHERE reversed_entry_id IS NOT NULL
+             UNION
+            SELECT r.id FROM account_move r JOIN changed c ON r.reversed_entry_id = c.id
+        """, {
+            'company_id': self.company_id.id,
+            'since': since - WATERMARK_OVERLAP,
+        })
+        return {row[0] for row in self.env.cr.fetchall()}
+
+    def _store_generation_data(self, watermark, contributions, summary):
+        self.write({
+            'generation_watermark': watermark,
+            'generation_data': {
+                'contributions': {str(move_id): contribution for move_id, contribution in contributions.items()},
+                'summary': summary,
+            },
+        })
+
+    def _prepare_document_lines(self, groups):
+        """Split aggregated groups into A1/C1 line values and the contributions of documents without SK VAT ID.
+
+        Contributions are returned per move id as lists of [tax_rate, base, tax, is_refund].
+        """
+        self.ensure_one()
+        vals_list = []
+        contributions = {}
+        for group in groups:
+            if group['has_vat_id']:
+                # Create individual line for each entity with Slovak VAT ID
+                # regardless of x_platca_dph status
+                vals_list.append({
+                    'kontrolny_vykaz_id': self.id,
+                    'partner_id': group['partner_id'],
+                    'partner_vat': group['partner_vat'],
+                    'invoice_id': group['move_id'],
+                    'invoice_number': group['invoice_number'],
+                    'invoice_date': group['invoice_date'],
+                    'supply_date': group['supply_date'],
+                    'base_amount': group['base'],
+                    'tax_rate': group['tax_rate'],
+                    'tax_amount': group['tax'],
+                    'is_refund': group['is_refund'],  # Flag for credit notes
+                })
+            else:
+                # For non-VAT ID partners, add to summary (individuals for invoices, separate for refunds)
+                contributions.setdefault(group['move_id'], []).append(
+                    [group['tax_rate'], group['base'], group['tax'], group['is_refund']])
+        return vals_list, contributions
+
+    def _summarize_contributions(self, contributions, sign=1, summary=None):
+        """Add (or with sign=-1 subtract) contributions to the individuals and refunds summaries.
+
+        Summaries are grouped by tax rate as [base, tax, document count].
+        """
+        if summary is None:
+            summary = {'individuals': {}, 'refunds': {}}
+        for contribution in contributions:
+            for tax_rate, base, tax, is_refund in contribution:
+                bucket = summary['refunds' if is_refund else 'individuals'].setdefault(str(tax_rate), [0.0, 0.0, 0])
+                bucket[0] += sign * base
+                bucket[1] += sign * tax
+                bucket[2] += sign
+        return summary
+
+    def _prepare_summary_lines(self, summary):
+        """Values of the summary lines for individuals and for refunds without VAT ID"""
+        self.ensure_one()
+        vals_list = []
+        
+        # Summary lines for individuals
+        for rate_key, (base, tax, count) in summary['individuals'].items():
+            if base > 0:
+                vals_list.append({
                     'kontrolny_vykaz_id': self.id,
                     'partner_id': False,
                     'partner_vat': 'Individuals',
                     'invoice_id': False,
-                    'invoice_number': f'Súhrn ({data["count"]} faktúr)',
+                    'invoice_number': f'Súhrn ({count} faktúr)',
                     'invoice_date': self.date_to,
                     'supply_date': self.date_to,
-                    'base_amount': data['base'],
-                    'tax_rate': tax_rate,
-                    'tax_amount': data['tax'],
+                    'base_amount': base,
+                    'tax_rate': float(rate_key),
+                    'tax_amount': tax,
                     'is_summary': True,
                     'is_refund': False,
                 })
                 
-        # Create summary lines for refunds without VAT ID
-        for tax_rate, data in refunds_tax_groups.items():
-            # Before creating refund summary, log what we're about to create
-            _logger.info(f"Creating refund summary for tax_rate {tax_rate} with base={data['base']}, tax={data['tax']}, count={data['count']}")
-            
-            if data['base'] != 0:  # Changed from > 0 to != 0 to catch negative values too
-                self.env['kontrolny.vykaz.a.line'].create({
+        # Summary lines for refunds without VAT ID
+        for rate_key, (base, tax, count) in summary['refunds'].items():
+            if base != 0:  # Changed from > 0 to != 0 to catch negative values too
+                vals_list.append({
                     'kontrolny_vykaz_id': self.id,
                     'partner_id': False,
                     'partner_vat': 'Refunds',
                     'invoice_id': False,
-                    'invoice_number': f'Súhrn ({data["count"]} dobropisov)',
+                    'invoice_number': f'Súhrn ({count} dobropisov)',
                     'invoice_date': self.date_to,
                     'supply_date': self.date_to,
-                    'base_amount': data['base'],
-                    'tax_rate': tax_rate,
-                    'tax_amount': data['tax'],
+                    'base_amount': base,
+                    'tax_rate': float(rate_key),
+                    'tax_amount': tax,
                     'is_summary': True,
                     'is_refund': True,  # Explicitly set is_refund to True
                 })
+        return vals_list
+
+    def _create_lines(self, vals_list):
+        """Insert statement lines in one batched pass.
+
+        Up to `kontrolny_vykaz.copy_threshold` lines (default 5000) go through a
+        multi-row ORM create, bigger batches are streamed with COPY.
+        """
+        self.ensure_one()
+        if not vals_list:
+            return
+        threshold = int(self.env['ir.config_parameter'].sudo().get_param('kontrolny_vykaz.copy_threshold', 5000))
+        if threshold and len(vals_list) > threshold:
+            self._copy_lines(vals_list)
+        else:
+            self.env['kontrolny.vykaz.a.line'].create(vals_list)
+
+    def _copy_lines(self, vals_list, add_totals=True):
+        """COPY fast path for very large periods, bypassing per-record ORM overhead.
+
+        The amounts are added to the totals like the create hook does, unless
+        `add_totals` is False because the totals already hold the lines.
+        """
+        self.ensure_one()
+        Line = self.env['kontrolny.vykaz.a.line']
+        columns = [
+            'kontrolny_vykaz_id', 'partner_id', 'partner_vat', 'invoice_id', 'invoice_number',
+            'invoice_date', 'supply_date', 'base_amount', 'tax_rate', 'tax_amount',
+            'is_summary', 'is_refund', 'create_uid', 'create_date', 'write_uid', 'write_date',
+        ]
+        now = fields.Datetime.now()
+        defaults = {
+            'is_summary': False,
+            'is_refund': False,
+            'create_uid': self.env.uid,
+            'create_date': now,
+            'write_uid': self.env.uid,
+            'write_date': now,
+        }
+
+        def _format(value):
+            if value is None or value is False:
+                return '\\N'
+            if value is True:
+                return 't'
+            return str(value).replace('\\', '\\\\').replace('\t', '\\t').replace('\n', '\\n').replace('\r', '\\r')
+
+        buffer = StringIO()
+        for vals in vals_list:
+            row = []
+            for column in columns:
+                value = vals.get(column, defaults.get(column))
+                if column in ('is_summary', 'is_refund'):
+                    value = 't' if value else 'f'
+                row.append(_format(value))
+            buffer.write('\t'.join(row))
+            buffer.write('\n')
+        buffer.seek(0)
+
+        Line.flush_model()
+        self.env.cr.copy_expert(
+            f'COPY {Line._table} ({", ".join(columns)}) FROM STDIN', buffer)
+
+        # Rows were written behind the ORM's back: drop stale caches and add
+        # the new lines to the totals
+        Line.invalidate_model()
+        self.invalidate_recordset(['a_section_line_ids'])
+        if not add_totals:
+            return
+        totals = {name: self[name] for name in TOTAL_FIELDS}
+        for vals in vals_list:
+            _add_to_totals(totals, vals.get('is_refund'), vals.get('tax_rate'),
+                           vals.get('base_amount') or 0.0, vals.get('tax_amount') or 0.0)
+        self._write_totals(totals)
     
     def action_confirm(self):
         self.ensure_one()
         self.state = 'confirmed'
         return True
     
+    @api.model
+    def _find_for_period(self, company, date_from, date_to, period_type='month'):
+        """Latest statement of `company` for exactly the period"""
+        return self.search([
+            ('company_id', '=', company.id),
+            ('period_type', '=', period_type),
+            ('date_from', '=', date_from),
+            ('date_to', '=', date_to),
+        ], order='id desc', limit=1)
+    
+    @api.model
+    def _get_or_create_for_period(self, company, year, month):
+        """Return the monthly statement of `company` for the period, creating it when missing"""
+        date_from = datetime(int(year), int(month), 1).date()
+        date_to = date_from + relativedelta(months=1, days=-1)
+        statement = self._find_for_period(company, date_from, date_to)
+        if not statement:
+            statement = self.create({
+                'company_id': company.id,
+                'period_type': 'month',
+                'month': f'{int(month):02d}',
+                'year': int(year),
+                'date_from': date_from,
+                'date_to': date_to,
+            })
+        return statement
+    
+    @api.model
+    def _cron_precompute_statements(self, frequency='nightly'):
+        """Keep the draft statements of the current and the previous month of every company up to date.
+
+        The nightly run covers the companies set to a nightly or an hourly
+        precomputation, the hourly run only the latter. Companies without any
+        change of their customer invoices and refunds since their last run are
+        skipped. Each company is committed on its own, so on close day
+        "Generovať KV" only picks up the postings of the last hours.
+        """
+        modes = ['hourly'] if frequency == 'hourly' else ['nightly', 'hourly']
+        companies = self.env['res.company'].search([
+            ('kv_precompute', 'in', modes),
+            ('country_id.code', '=', 'SK'),
+        ])
+        for company in companies:
+            watermark = self._get_company_moves_watermark(company)
+            if not watermark or (company.kv_precompute_watermark and watermark <= company.kv_precompute_watermark):
+                _logger.info("No invoices or refunds changed for %s, statements not precomputed", company.name)
+                continue
+            try:
+                self.with_company(company)._precompute_company_statements(company)
+                company.kv_precompute_watermark = watermark
+                self.env.cr.commit()
+            except Exception:
+                self.env.cr.rollback()
+                _logger.exception("Precomputation of the control statements of %s failed", company.name)
+    
+    @api.model
+    def _precompute_company_statements(self, company):
+        """Generate the current and the previous month of `company`, leaving the statements in draft"""
+        today = fields.Date.context_today(self)
+        for day in (today - relativedelta(months=1), today):
+            statement = self._get_or_create_for_period(company, day.year, day.month)
+            # Statements confirmed, exported or generated on their own are left alone
+            if statement.state != 'draft' or statement.generation_job_state in ('queued', 'running'):
+                continue
+            if not statement._lock_generation(wait=True):
+                continue
+            statement._generate('precompute')
+    
+    def _run_month_end_batch(self, force=False):
+        """Generate, confirm and export the statement headlessly; return the duration of each phase in seconds.
+
+        Statements already exported are left alone unless `force` is set.
+        """
+        self.ensure_one()
+        timings = {}
+        if self.state == 'exported' and not force:
+            return timings
+        
+        def _timed(phase, method):
+            start = time.monotonic()
+            method()
+            timings[phase] = time.monotonic() - start
+        
+        if self.state != 'draft':
+            self.action_reset_to_draft()
+        _timed('generate', self.action_generate_statement)
+        self.action_confirm()
+        _timed('export_xml', self.action_export)
+        _timed('export_excel', self.action_export_excel)
+        return timings
+    
     def action_export(self):
         """Export KV data to XML file matching the required format for Slovak tax authorities"""
         self.ensure_one()
@@ -374,217 +1532,634 @@ class KontrolnyVykaz(models.Model):
                 }
             }
             
-        # Create XML structure
-        # Define the namespace
-        xmlns = "https://ekr.financnasprava.sk/Formulare/XSD/kv_dph_2025.xsd"
+        timer = PhaseTimer(self.env.cr)
+        classification = self._get_classification_cache()
+        filename = self._get_export_filename('xml')
+        Snapshot = self.env['kontrolny.vykaz.snapshot.line']
+        delta = None
+        if self.filing_type != 'R':
+            self._check_exportable('xml')
+            if self.lines_archived:
+                # Archived after the filing and not regenerated since
+                raise UserError('Riadky výkazu sú archivované a od podania sa nezmenili. '
+                                'Pre opravný alebo dodatočný výkaz ho vráťte do konceptu a vygenerujte znova.')
+            delta = Snapshot._diff(self)
+            if all(row['old_hash'] == row['new_hash'] for row in delta):
+                raise UserError('Od podania výkazu sa žiadny riadok nezmenil.')
+        
+        # Stream the document to a spooled temporary file, then store it once
+        with tempfile.SpooledTemporaryFile(max_size=EXPORT_SPOOL_MAX_SIZE) as stream:
+            with timer.phase('xml_build') as phase:
+                counters = self._write_xml(stream, classification=classification, delta=delta)
+                phase['lines'] = counters['a1_records'] + counters['c1_records']
+            xsd_validation = self._get_xsd_validation_mode()
+            if xsd_validation != 'off':
+                with timer.phase('xml_validate') as phase:
+                    stream.seek(0)
+                    violations = validate_stream(stream)
+                    phase['lines'] = counters['a1_records'] + counters['c1_records']
+                if violations and xsd_validation == 'block':
+                    raise UserError(self._format_xsd_violations(violations))
+                if violations:
+                    # The bundled schema is stricter than the portal: report, do not refuse
+                    counters['xsd_warning'] = self._format_xsd_violations(violations)
+            with timer.phase('file_write'):
+                stream.seek(0)
+                self._store_export('xml', filename, stream.read())
+                self.write({
+                    'xml_filename': filename,
+                    'state': 'exported'
+                })
+                self.flush_recordset(['xml_filename', 'state'])
+            # What was filed becomes the base of the next corrective or supplementary filing
+            with timer.phase('snapshot') as phase:
+                if delta is None:
+                    Snapshot._take(self)
+                else:
+                    Snapshot._apply(self, delta)
+                    phase['lines'] = len(delta)
+        counters['druh'] = self.filing_type
+        self._record_timings('export_xml', timer)
+        self._store_export_stats('xml', filename, counters)
+        
+        return {
+            'type': 'ir.actions.act_url',
+            'url': f'/web/content?model=kontrolny.vykaz&id={self.id}&field=xml_file&filename={filename}&download=true',
+            'target': 'self',
+        }
+    
+    def _get_export_filename(self, kind):
+        self.ensure_one()
+        # Corrective and supplementary filings are told apart from the regular one
+        suffix = f'_{self.filing_type}' if kind == 'xml' and self.filing_type != 'R' else ''
+        if self.period_type == 'quarter':
+            if kind == 'xml':
+                return f'KVDPH_{self.year}_STVRTROK_{int(self.quarter)}{suffix}.XML'
+            return f'KV_DPHS_{self.year}_Q{int(self.quarter)}.xlsx'
+        if kind == 'xml':
+            return f'KVDPH_{self.year}_MESIAC_{int(self.month)}{suffix}.XML'
+        return f'KV_DPHS_{self.year}_{int(self.month)}.xlsx'
+    
+    def _get_export_etag(self, kind):
+        """Version of the `kind` export: changes whenever the statement, its lines or the data read with them change.
+
+        Besides the company, the export reads the VAT classification of the
+        line partners and the original invoice numbers (FO) of the refunds,
+        so their latest changes are part of the version too.
+        """
+        self.ensure_one()
+        self.env['kontrolny.vykaz.a.line'].flush_model()
+        self.env['res.partner'].flush_model()
+        self.env['account.move'].flush_model(['name', 'ref', 'reversed_entry_id'])
+        self.flush_recordset()
+        cr = self.env.cr
+        cr.execute("""
+            SELECT COUNT(l.id), MAX(l.write_date), MAX(l.id),
+                   ARRAY_AGG(DISTINCT l.partner_id) FILTER (WHERE l.partner_id IS NOT NULL),
+                   ARRAY_AGG(DISTINCT l.invoice_id) FILTER (WHERE l.is_refund AND l.invoice_id IS NOT NULL)
+              FROM kontrolny_vykaz_a_line l
+             WHERE l.kontrolny_vykaz_id = %s
+        """, [self.id])
+        count, write_date, max_id, partner_ids, refund_ids = cr.fetchone()
+        line_version = (count, write_date, max_id)
+        if self.lines_archived:
+            lines = list(self._iter_archived_line_values())
+            partner_ids = list({values['partner_id'] for values in lines if values['partner_id']})
+            refund_ids = list({values['invoice_id'] for values in lines
+                               if values['is_refund'] and values['invoice_id']})
+        cr.execute("""
+            SELECT (SELECT MAX(p.write_date) FROM res_partner p WHERE p.id = ANY(%(partner_ids)s)),
+                   (SELECT MAX(GREATEST(m.write_date, o.write_date))
+                      FROM account_move m
+                 LEFT JOIN account_move o ON o.id = m.reversed_entry_id
+                     WHERE m.id = ANY(%(refund_ids)s))
+        """, {'partner_ids': partner_ids or [], 'refund_ids': refund_ids or []})
+        partners_version, refunds_version = cr.fetchone()
+        company = self.company_id
+        version = (kind, self.id, self.state, self.write_date, line_version, partners_version, refunds_version,
+                   company.write_date, company.partner_id.write_date)
+        return hashlib.sha1(repr(version).encode()).hexdigest()
+    
+    def _get_xsd_validation_mode(self):
+        """How XML exports are checked against the bundled schema, set by kontrolny_vykaz.xsd_validation.
+
+        'warn' (default) lists the violations in the export message, 'block'
+        (or 1) refuses the export, 'off' (or 0) skips the check.
+        """
+        value = self.env['ir.config_parameter'].sudo().get_param('kontrolny_vykaz.xsd_validation', 'warn')
+        value = value.strip().lower()
+        if value in ('0', 'false', 'off', ''):
+            return 'off'
+        if value in ('1', 'true', 'block'):
+            return 'block'
+        return 'warn'
+    
+    @api.model
+    def _format_xsd_violations(self, violations):
+        lines = [f'XML nezodpovedá schéme KVDPH_2025, počet chýb: {len(violations)}.']
+        for violation in violations[:XSD_MAX_REPORTED_VIOLATIONS]:
+            record = violation['tag'] or 'dokument'
+            if violation['invoice']:
+                record = f"{record} {violation['invoice']}"
+            lines.append(f"- {record} (riadok {violation['line']}): {violation['message']}")
+        if len(violations) > XSD_MAX_REPORTED_VIOLATIONS:
+            lines.append(f'- ... a ďalších {len(violations) - XSD_MAX_REPORTED_VIOLATIONS}')
+        return '\n'.join(lines)
+    
+    def _check_exportable(self, kind):
+        self.ensure_one()
+        if kind == 'xml' and self.state not in ('confirmed', 'exported'):
+            raise UserError('Prosím, najprv potvrďte kontrolný výkaz.')
+        if kind == 'xml' and self.filing_type != 'R' and not self.snapshot_date:
+            raise UserError('Opravný alebo dodatočný výkaz sa dá vytvoriť až po exporte riadneho výkazu.')
+        if kind == 'excel' and self.state not in ('generated', 'confirmed', 'exported'):
+            raise UserError('Prosím, najprv vygenerujte kontrolný výkaz.')
+    
+    def _open_export_file(self, kind):
+        """Build the `kind` ('xml' or 'excel') file into a temporary file and return it, positioned at the start.
+
+        Nothing is stored: the caller streams the file and closes it, which
+        also removes it from disk.
+        """
+        self._check_exportable(kind)
+        if kind == 'xml':
+            output = tempfile.SpooledTemporaryFile(max_size=EXPORT_SPOOL_MAX_SIZE)
+            try:
+                self._write_xml(output)
+            except Exception:
+                output.close()
+                raise
+        else:
+            output = tempfile.NamedTemporaryFile(suffix='.xlsx')
+            try:
+                self._write_excel(output.name)
+            except Exception:
+                output.close()
+                raise
+        output.seek(0)
+        return output
+    
+    def action_download_xml(self):
+        """Stream the XML without storing it"""
+        self.ensure_one()
+        return {
+            'type': 'ir.actions.act_url',
+            'url': f'/kontrolny_vykaz/{self.id}/download/xml',
+            'target': 'self',
+        }
+    
+    def action_download_excel(self):
+        """Stream the Excel workbook without storing it"""
+        self.ensure_one()
+        return {
+            'type': 'ir.actions.act_url',
+            'url': f'/kontrolny_vykaz/{self.id}/download/excel',
+            'target': 'self',
+        }
+    
+    def _store_export(self, kind, filename, data):
+        """Add the exported file to the history and drop the exports beyond the retention.
+
+        The compression follows kontrolny_vykaz.export_compression (none, gzip
+        or zip, default gzip); kontrolny_vykaz.export_retention sets how many
+        exports of each kind a statement keeps (default 5). A file identical to
+        the latest export of its kind is not stored again.
+        """
+        self.ensure_one()
+        params = self.env['ir.config_parameter'].sudo()
+        latest = self.export_ids.filtered(lambda e: e.kind == kind)[:1]
+        if latest and latest.filename == filename and latest.checksum == hashlib.sha1(data).hexdigest():
+            return latest
+        compression = params.get_param('kontrolny_vykaz.export_compression', 'gzip')
+        if compression not in ('none', 'gzip', 'zip'):
+            compression = 'gzip'
+        export = self.env['kontrolny.vykaz.export'].create({
+            'kontrolny_vykaz_id': self.id,
+            'kind': kind,
+            'filename': filename,
+        })
+        export._set_content(data, compression)
+        
+        retention = max(int(params.get_param('kontrolny_vykaz.export_retention', 5)), 1)
+        self.invalidate_recordset(['export_ids'])
+        self.export_ids.filtered(lambda e: e.kind == kind)[retention:].unlink()
+        return export
+    
+    def _store_export_stats(self, kind, filename, counters):
+        """Keep the counters of an export on the statement, then log and post them"""
+        self.ensure_one()
+        stats = dict(self.export_stats or {})
+        stats[kind] = dict(counters, filename=filename, date=fields.Datetime.to_string(fields.Datetime.now()))
+        self.export_stats = stats
+        self._log_run_summary(f"{'XML' if kind == 'xml' else 'Excel'} export {filename}", counters)
+        self.message_post(body=self._render_export_message(kind))
+    
+    def _render_export_message(self, kind):
+        """Chatter summary of the last `kind` ('xml' or 'excel') export, rendered from export_stats"""
+        self.ensure_one()
+        stats = (self.export_stats or {}).get(kind) or {}
+        if kind == 'xml':
+            intro = "Kontrolný výkaz bol úspešne exportovaný a stiahnutý ako XML súbor."
+            file_label = "XML Súbor"
+            notes = [
+                "Poznámka: Súhrnné záznamy pre fyzické osoby bez IČ DPH sú zahrnuté v celkových sumách, ale nie sú exportované ako samostatné A1 záznamy v XML súbore.",
+                "Upozornenie: Partneri s IČ DPH SK, ktorí majú nastavené x_platca_dph=False, majú prázdny atribút Odb v A1 záznamoch.",
+            ]
+        else:
+            intro = "Kontrolný výkaz bol úspešne exportovaný do Excel súboru."
+            file_label = "Excel Súbor"
+            notes = ["Poznámka: Aj v Excel súbore sa používa pole x_platca_dph na určenie, či sa má v stĺpci Odb zobraziť IČ DPH."]
+        filing_html = ''
+        if stats.get('druh') in ('O', 'D'):
+            filing_html = f"""
+                <li><strong>Druh výkazu:</strong> {dict(self._fields['filing_type'].selection)[stats['druh']]}</li>
+                <li><strong>Pridané / odobraté / zmenené riadky:</strong> {stats.get('rows_added', 0)} / {stats.get('rows_removed', 0)} / {stats.get('rows_changed', 0)}</li>"""
+        notes_html = ''.join(f"<p><em>{note}</em></p>" for note in notes)
+        if stats.get('xsd_warning'):
+            notes_html += "<p><strong>{}</strong></p>".format(
+                '<br/>'.join(html_escape(line) for line in stats['xsd_warning'].split('\n')))
+        return f"""
+            <p>{intro}</p>
+            <ul>
+                <li><strong>{file_label}:</strong> {stats.get('filename', '')}</li>{filing_html}
+                <li><strong>Počet A1 záznamov:</strong> {stats.get('lines_not_summary', 0)}</li>
+                <li><strong>Počet súhrnných záznamov pre fyzické osoby:</strong> {stats.get('summary_lines', 0)}</li>
+                <li><strong>Počet záznamov s SK IČ DPH:</strong> {stats.get('sk_vat_id_lines', 0)}</li>
+                <li><strong>Počet záznamov s prázdnym atribútom Odb (x_platca_dph=False):</strong> {stats.get('empty_odb_lines', 0)}</li>
+            </ul>
+            {notes_html}
+        """
+    
+    def _get_classification_cache(self):
+        """Classification cache preloaded with the partners of all lines of the statement"""
+        self.ensure_one()
+        if self.lines_archived:
+            return ClassificationCache(self.env).add_partners(
+                [values['partner_id'] for values in self._iter_archived_line_values()])
+        Line = self.env['kontrolny.vykaz.a.line']
+        Line.flush_model(['kontrolny_vykaz_id', 'partner_id'])
+        self.env.cr.execute("""
+            SELECT DISTINCT partner_id FROM kontrolny_vykaz_a_line
+             WHERE kontrolny_vykaz_id = %s AND partner_id IS NOT NULL
+        """, [self.id])
+        return ClassificationCache(self.env).add_partners([row[0] for row in self.env.cr.fetchall()])
+    
+    def _iter_lines(self, domain=None, batch_size=LINE_BATCH_SIZE):
+        """Yield the statement lines matching `domain` in id order, one batch in memory at a time.
+
+        Lines of an archived statement are yielded as new (in-memory) records
+        read from the archive.
+        """
+        self.ensure_one()
+        Line = self.env['kontrolny.vykaz.a.line']
+        if self.lines_archived:
+            batch = []
+            for values in self._iter_archived_line_values(domain):
+                batch.append(values)
+                if len(batch) == batch_size:
+                    yield from (Line.new(dict(vals)) for vals in batch)
+                    batch = []
+            yield from (Line.new(dict(vals)) for vals in batch)
+            return
+        line_ids = Line.search([('kontrolny_vykaz_id', '=', self.id)] + (domain or []), order='id').ids
+        for index in range(0, len(line_ids), batch_size):
+            lines = Line.browse(line_ids[index:index + batch_size])
+            yield from lines
+            lines.invalidate_recordset()
+    
+    def _iter_archived_line_values(self, domain=None):
+        """Yield the values of the archived lines matching `domain`, which only supports (field, '=', value)"""
+        self.ensure_one()
+        conditions = []
+        for name, operator, value in domain or []:
+            if operator != '=':
+                raise ValueError(f"Unsupported operator {operator!r} on archived lines")
+            conditions.append((name, value))
+        for values in self._get_archived_line_values():
+            if all((values[name] or False) == (value or False) for name, value in conditions):
+                yield values
+    
+    def _get_archived_line_values(self):
+        """Values of all archived lines, unpacked once per transaction however many passes an export makes"""
+        self.ensure_one()
+        archives = self.env.cr.cache.setdefault(ARCHIVE_CACHE_KEY, {})
+        if self.id not in archives:
+            data = self.with_context(bin_size=False).line_archive
+            archives[self.id] = list(unpack_rows(base64.b64decode(data))) if data else []
+        return archives[self.id]
+    
+    def _drop_archived_line_values(self):
+        archives = self.env.cr.cache.get(ARCHIVE_CACHE_KEY, {})
+        for statement_id in self.ids:
+            archives.pop(statement_id, None)
+    
+    def _get_line_invoice_ids(self, domain):
+        """Ids of the documents of the lines matching `domain`, archived or not"""
+        self.ensure_one()
+        if self.lines_archived:
+            return list({values['invoice_id'] for values in self._iter_archived_line_values(domain)
+                         if values['invoice_id']})
+        lines = self.env['kontrolny.vykaz.a.line'].search([('kontrolny_vykaz_id', '=', self.id)] + domain)
+        invoice_ids = lines.invoice_id.ids
+        lines.invalidate_recordset()
+        return invoice_ids
+    
+    def _count_lines(self, domain):
+        """Number of lines matching `domain`, archived or not"""
+        self.ensure_one()
+        if self.lines_archived:
+            return sum(1 for _values in self._iter_archived_line_values(domain))
+        return self.env['kontrolny.vykaz.a.line'].search_count([('kontrolny_vykaz_id', '=', self.id)] + domain)
+    
+    @api.model
+    def _cron_compact_statements(self):
+        """Archive the lines of exported statements older than kontrolny_vykaz.compact_after_months months (off when 0)"""
+        months = int(self.env['ir.config_parameter'].sudo().get_param('kontrolny_vykaz.compact_after_months', 0))
+        if months <= 0:
+            return
+        limit = fields.Date.context_today(self).replace(day=1) - relativedelta(months=months)
+        statements = self.search([
+            ('state', '=', 'exported'),
+            ('lines_archived', '=', False),
+            ('date_to', '<', limit),
+        ], order='date_to, id')
+        for statement in statements:
+            statement._compact_lines()
+            self.env.cr.commit()
+    
+    def _compact_lines(self):
+        """Pack the lines of these statements into their archive and remove them from the line table.
+
+        Totals and exports are unaffected: exports read the archive and
+        resetting the statement to draft restores the lines.
+        """
+        Line = self.env['kontrolny.vykaz.a.line']
+        Line.flush_model()
+        for statement in self.filtered(lambda s: not s.lines_archived):
+            cr = self.env.cr
+            cr.execute(f"""
+                SELECT {', '.join(ARCHIVE_COLUMNS)}
+                  FROM kontrolny_vykaz_a_line
+                 WHERE kontrolny_vykaz_id = %s
+              ORDER BY id
+            """, [statement.id])
+            count = cr.rowcount
+            data = pack_rows(iter(lambda: cr.fetchmany(ARCHIVE_FETCH_SIZE), []))
+            statement.write({
+                'line_archive': base64.b64encode(data),
+                'archived_line_count': count,
+                'lines_archived': True,
+            })
+            # Behind the ORM's back, so that the line hooks leave the totals alone
+            cr.execute("DELETE FROM kontrolny_vykaz_a_line WHERE kontrolny_vykaz_id = %s", [statement.id])
+            _logger.info("Archived %s lines of %s into %s bytes", count, statement.name, len(data))
+        Line.invalidate_model()
+        self.invalidate_recordset(['a_section_line_ids'])
+        self._drop_archived_line_values()
+    
+    def _restore_lines(self):
+        """Put the archived lines of these statements back into the line table"""
+        for statement in self.filtered('lines_archived'):
+            vals_list = [dict(values, kontrolny_vykaz_id=statement.id)
+                         for values in statement._iter_archived_line_values()]
+            if vals_list:
+                # Archiving kept the totals, they already hold these lines
+                statement._copy_lines(vals_list, add_totals=False)
+            statement.write({
+                'line_archive': False,
+                'archived_line_count': 0,
+                'lines_archived': False,
+            })
+            statement._drop_archived_line_values()
+
+    def _write_xml(self, stream, counters=None, classification=None, delta=None):
+        """Write the KVDPH_2025 document for this statement to the binary `stream`.
+
+        Written A1/C1 records, skipped zero-base lines and the statistics of the
+        export summary are counted into `counters`, which is returned. A
+        corrective or supplementary filing only holds the rows of `delta`
+        (computed against the snapshot when not given).
+        """
+        self.ensure_one()
+        if self.filing_type != 'R' and delta is None:
+            delta = self.env['kontrolny.vykaz.snapshot.line']._diff(self)
+        counters = counters if counters is not None else Counter()
+        classification = classification or self._get_classification_cache()
+        debug = self._is_debug_logging()
+        writer = KVXmlWriter(stream)
+        writer.declaration()
         
-        # Root element
-        root = ET.Element("KVDPH_2025", xmlns=xmlns)
+        # Root element with the namespace
+        writer.start("KVDPH_2025", {"xmlns": "https://ekr.financnasprava.sk/Formulare/XSD/kv_dph_2025.xsd"})
         
         # Identification section
-        identification = ET.SubElement(root, "Identifikacia")
+        writer.start("Identifikacia")
         
         # Get company data
         company = self.company_id
-        vat_number = company.vat or ''
-        if vat_number and not vat_number.startswith('SK'):
-            vat_number = 'SK' + vat_number.replace('SK', '')
+        vat_number = compact_sk_vat(company.vat)
             
         # Add identification details
-        ET.SubElement(identification, "IcDphPlatitela").text = vat_number
-        ET.SubElement(identification, "Druh").text = "R"  # Regular statement
+        writer.element("IcDphPlatitela", vat_number)
+        writer.element("Druh", self.filing_type or 'R')  # Regular, corrective or supplementary statement
         
         # Period information
-        period = ET.SubElement(identification, "Obdobie")
-        ET.SubElement(period, "Rok").text = str(self.year)
-        ET.SubElement(period, "Mesiac").text = str(int(self.month))
+        writer.start("Obdobie")
+        writer.element("Rok", str(self.year))
+        if self.period_type == 'quarter':
+            writer.element("Stvrtrok", str(int(self.quarter)))
+        else:
+            writer.element("Mesiac", str(int(self.month)))
+        writer.end()
         
         # Company details
-        ET.SubElement(identification, "Nazov").text = company.name or ''
-        ET.SubElement(identification, "Stat").text = company.country_id.name or 'Slovensko'
-        ET.SubElement(identification, "Obec").text = company.city or ''
-        ET.SubElement(identification, "PSC").text = company.zip or ''
-        ET.SubElement(identification, "Ulica").text = company.street or ''
-        ET.SubElement(identification, "Cislo").text = company.street2 or ''
-        ET.SubElement(identification, "Tel").text = company.phone or ''
-        ET.SubElement(identification, "Email").text = company.email or ''
+        writer.element("Nazov", company.name or '')
+        writer.element("Stat", company.country_id.name or 'Slovensko')
+        writer.element("Obec", company.city or '')
+        writer.element("PSC", company.zip or '')
+        writer.element("Ulica", company.street or '')
+        writer.element("Cislo", company.street2 or '')
+        writer.element("Tel", company.phone or '')
+        writer.element("Email", company.email or '')
+        writer.end()
         
         # Transactions section
-        transactions = ET.SubElement(root, "Transakcie")
+        writer.start("Transakcie")
+        if self.filing_type != 'R':
+            total_base, total_tax = self._write_xml_delta_records(writer, delta, counters, classification)
+        else:
+            total_base, total_tax = self._write_xml_records(writer, counters, classification, debug)
+        
+        # Add special handling for negative amounts (when refunds > regular invoices)
+        writer.element("D2", attrs={
+            "Z": "{:.2f}".format(total_base if total_base >= 0 else 0),
+            "D": "{:.2f}".format(total_tax if total_tax >= 0 else 0),
+            "ZZn": "{:.2f}".format(abs(total_base) if total_base < 0 else 0),
+            "DZn": "{:.2f}".format(abs(total_tax) if total_tax < 0 else 0),
+        })
+        writer.close()
+        return counters
+    
+    def _prepare_xml_record(self, record, classification, reversal_map=None, cancel=False):
+        """Tag and attributes of the A1 or C1 record of a statement line or a filed snapshot line.
+
+        With `cancel` the amounts are negated, so that the record withdraws
+        the one filed before.
+        """
+        sign = -1 if cancel else 1
+        # Format date as YYYY-MM-DD
+        date_str = record.supply_date.strftime('%Y-%m-%d') if record.supply_date else ''
+        
+        # For VAT-registered customers, check if they're marked as VAT payers (x_platca_dph)
+        # Empty for non-VAT customers or when x_platca_dph is False
+        odb = classification.odb(record.partner_id.id, record.partner_vat)
+        if not record.is_refund:
+            return "A1", {
+                "Odb": odb,
+                "F": record.invoice_number or '',
+                "Den": date_str,
+                "Z": "{:.2f}".format(sign * abs(record.base_amount)),  # Use absolute value for display
+                "D": "{:.2f}".format(sign * abs(record.tax_amount)),   # Use absolute value for display
+                "S": str(int(record.tax_rate)),
+            }
+        
+        # For refunds, try to get the original invoice number if available
+        original_invoice_number = reversal_map.original_number(record.invoice_id.id) if record.invoice_id else ""
+        
+        # FO should be the refund number, FP should be the original invoice number
+        attrs = {
+            "Odb": odb,
+            "FP": record.invoice_number or '',  # Refund number
+        }
+        if original_invoice_number:
+            attrs["FO"] = original_invoice_number  # Original invoice number
+        # Use negative values for credit notes in XML for the actual calculation
+        attrs.update({
+            "Den": date_str,
+            "Z": "{:.2f}".format(-sign * abs(record.base_amount)),  # Negative for refund
+            "D": "{:.2f}".format(-sign * abs(record.tax_amount)),   # Negative for refund
+            "S": str(int(record.tax_rate)),
+        })
+        return "C1", attrs
+    
+    def _write_xml_delta_records(self, writer, delta, counters, classification):
+        """Write the A1/C1 records of a corrective or supplementary filing; return its D2 base and tax.
+
+        Every row changed since the snapshot withdraws its filed version with
+        negated amounts and states its current one; added rows only state
+        theirs, removed rows only withdraw theirs. Summary lines only enter the
+        D2 totals, which are the difference to the filed statement.
+        """
+        changes = [row for row in delta if row['old_hash'] != row['new_hash']]
+        filed = self.env['kontrolny.vykaz.snapshot.line'].browse(
+            [row['snapshot_id'] for row in changes if row['snapshot_id']])
+        current = self.env['kontrolny.vykaz.a.line'].browse([row['line_id'] for row in changes if row['line_id']])
+        classification.add_partners(filed.partner_id.ids + current.partner_id.ids)
+        reversal_map = ReversalMap(self.env).add_refunds(
+            filed.filtered('is_refund').invoice_id.ids + current.filtered('is_refund').invoice_id.ids)
+        counters.update(
+            rows_added=sum(1 for row in changes if not row['old_hash']),
+            rows_removed=sum(1 for row in changes if not row['new_hash']),
+            rows_changed=sum(1 for row in changes if row['old_hash'] and row['new_hash']),
+        )
+        
+        total_base = total_tax = 0.0
+        records = [(record, True) for record in filed] + [(record, False) for record in current]
+        for record, cancel in records:
+            sign = -1 if cancel else 1
+            total_base += sign * record.base_amount
+            total_tax += sign * record.tax_amount
         
+        # All A1 records precede the C1 records
+        for is_refund in (False, True):
+            for record, cancel in records:
+                if record.is_summary or record.is_refund != is_refund:
+                    continue
+                if record.base_amount == 0:
+                    counters['zero_base_skipped'] += 1
+                    continue
+                tag, attrs = self._prepare_xml_record(record, classification, reversal_map, cancel=cancel)
+                counters['c1_records' if is_refund else 'a1_records'] += 1
+                writer.element(tag, attrs=attrs)
+        return self.currency_id.round(total_base), self.currency_id.round(total_tax)
+    
+    def _write_xml_records(self, writer, counters, classification, debug=False):
+        """Write the A1/C1 records of all lines of the statement; return the D2 base and tax"""
         # Process regular Section A lines (A1 transactions - sales with VAT)
         # Only include lines with VAT-registered customers (exclude summary lines for individuals)
-        for line in self.a_section_line_ids.filtered(lambda l: not l.is_summary and not l.is_refund):
+        for line in self._iter_lines([('is_summary', '=', False), ('is_refund', '=', False)]):
+            _count_export_line(counters, line, classification)
             # Process both regular and reversed invoices for A1 section
             # Skip if base amount is zero
             if line.base_amount == 0:
+                counters['zero_base_skipped'] += 1
                 continue
-                
-            # Format date as YYYY-MM-DD
-            date_str = line.supply_date.strftime('%Y-%m-%d') if line.supply_date else ''
-            
-            # Create A1 element with attributes
-            a1 = ET.SubElement(transactions, "A1")
             
-            # For VAT-registered customers, check if they're marked as VAT payers (x_platca_dph)
-            if line.partner_id and hasattr(line.partner_id, 'x_platca_dph') and line.partner_id.x_platca_dph and line.partner_vat and line.partner_vat.upper().startswith('SK'):
-                a1.set("Odb", line.partner_vat)
-            else:
-                a1.set("Odb", "")  # Empty for non-VAT customers or when x_platca_dph is False
-                
-            a1.set("F", line.invoice_number or '')
-            a1.set("Den", date_str)
-            a1.set("Z", "{:.2f}".format(abs(line.base_amount)))  # Use absolute value for display
-            a1.set("D", "{:.2f}".format(abs(line.tax_amount)))   # Use absolute value for display
-            a1.set("S", str(int(line.tax_rate)))
+            tag, attrs = self._prepare_xml_record(line, classification)
+            if debug:
+                _logger.info("A1 record: %s, base_amount: %s, Odb: %r", line.invoice_number, line.base_amount,
+                             attrs["Odb"])
+            counters['a1_records'] += 1
+            writer.element(tag, attrs=attrs)
         
         # Process credit notes (C1 transactions - refunds with VAT)
-        refund_lines = self.a_section_line_ids.filtered(lambda l: not l.is_summary and l.is_refund)
-        _logger.info(f"Found {len(refund_lines)} refund lines to process in C1 section")
+        refund_domain = [('is_summary', '=', False), ('is_refund', '=', True)]
         
-        # Log all a_section_line_ids to debug why refunds might not be found
-        _logger.info("***** All a_section_line_ids *****")
-        for line in self.a_section_line_ids:
-            _logger.info(f"Line: invoice_number={line.invoice_number}, is_refund={line.is_refund}, is_summary={line.is_summary}, base_amount={line.base_amount}")
+        # Original invoice numbers (FO) of all refunds, resolved in one batch
+        reversal_map = ReversalMap(self.env).add_refunds(self._get_line_invoice_ids(refund_domain))
         
-        for line in refund_lines:
+        for line in self._iter_lines(refund_domain):
+            _count_export_line(counters, line, classification)
             # Skip lines with zero base amount
             if line.base_amount == 0:
+                counters['zero_base_skipped'] += 1
                 continue
-                
-            # Log for debugging
-            _logger.info(f"Processing refund line: {line.invoice_number}, base_amount: {line.base_amount}, is_refund: {line.is_refund}")
-            
-            # Format date as YYYY-MM-DD
-            date_str = line.supply_date.strftime('%Y-%m-%d') if line.supply_date else ''
-            
-            # Create C1 element with attributes (for credit notes)
-            c1 = ET.SubElement(transactions, "C1")
-            
-            # For VAT-registered customers, check if they're marked as VAT payers (x_platca_dph)
-            if line.partner_id and hasattr(line.partner_id, 'x_platca_dph') and line.partner_id.x_platca_dph and line.partner_vat and line.partner_vat.upper().startswith('SK'):
-                c1.set("Odb", line.partner_vat)
-            else:
-                c1.set("Odb", "")  # Empty for non-VAT customers or when x_platca_dph is False
-            
-            # For refunds, try to get the original invoice number if available
-            original_invoice_number = ""
-            if line.invoice_id and line.invoice_id.reversed_entry_id:
-                original_invoice_number = line.invoice_id.reversed_entry_id.name
-                _logger.info(f"Using original invoice number: {original_invoice_number} for refund {line.invoice_number}")
-            elif line.invoice_id and line.invoice_id.ref and "Obrátenie z:" in line.invoice_id.ref:
-                # Extract original invoice number from the reference
-                original_invoice_number = line.invoice_id.ref.replace("Obrátenie z:", "").strip()
-                _logger.info(f"Extracted original invoice number from ref: {original_invoice_number} for refund {line.invoice_number}")
             
-            # FO should be the refund number, FP should be the original invoice number
-            c1.set("FP", line.invoice_number or '')  # Refund number
-            if original_invoice_number:
-                c1.set("FO", original_invoice_number)  # Original invoice number
-            c1.set("Den", date_str)
-            # Use negative values for credit notes in XML for the actual calculation
-            c1.set("Z", "{:.2f}".format(-abs(line.base_amount)))  # Negative for refund
-            c1.set("D", "{:.2f}".format(-abs(line.tax_amount)))   # Negative for refund
-            c1.set("S", str(int(line.tax_rate)))
-        
-        # If we had credit notes (C1 transactions), we would add them here
-        # For example:
-        # c1 = ET.SubElement(transactions, "C1")
-        # c1.set("Odb", vat_number)
-        # c1.set("FO", "reference_number")
-        # ...
+            tag, attrs = self._prepare_xml_record(line, classification, reversal_map)
+            if debug:
+                _logger.info("C1 record: %s, base_amount: %s, Odb: %r, original invoice: %s",
+                             line.invoice_number, line.base_amount, attrs["Odb"], attrs.get("FO", ""))
+            counters['c1_records'] += 1
+            writer.element(tag, attrs=attrs)
+        
+        # Summary lines for individuals only enter the D2 totals, count them without loading them
+        counters['summary_lines'] += self._count_lines([('is_summary', '=', True)])
         
         # Add totals section (D2) - This includes all transactions including those for individuals
         # The total amounts include both regular A1 lines and summary lines (individuals without VAT ID)
         # and are adjusted for refunds (C1 records)
-        d2 = ET.SubElement(transactions, "D2")
         
         # Calculate total amounts properly considering all sections
         total_base = self.total_a_base + self.total_c_base
         total_tax = self.total_a_tax + self.total_c_tax
         
-        # Log the totals for debugging
-        _logger.info(f"D2 Totals - Base: {total_base}, Tax: {total_tax}")
-        _logger.info(f"Section A - Base: {self.total_a_base}, Tax: {self.total_a_tax}")
-        _logger.info(f"Section C - Base: {self.total_c_base}, Tax: {self.total_c_tax}")
-        
-        # Add special handling for negative amounts (when refunds > regular invoices)
-        d2.set("Z", "{:.2f}".format(total_base if total_base >= 0 else 0))
-        d2.set("D", "{:.2f}".format(total_tax if total_tax >= 0 else 0))
-        d2.set("ZZn", "{:.2f}".format(abs(total_base) if total_base < 0 else 0))
-        d2.set("DZn", "{:.2f}".format(abs(total_tax) if total_tax < 0 else 0))
-        
-        # Convert to properly formatted XML string
-        rough_string = ET.tostring(root, 'utf-8')
-        
-        # Add XML declaration
-        xml_declaration = '<?xml version="1.0" encoding="UTF-8" standalone="yes"?>\n'
-        
-        # Parse the string to get a DOM representation
-        reparsed = minidom.parseString(rough_string)
-        pretty_xml = reparsed.toprettyxml(indent="  ")
-        
-        # Remove extra blank lines that minidom sometimes adds
-        xml_lines = [line for line in pretty_xml.splitlines() if line.strip()]
-        pretty_xml = '\n'.join(xml_lines)
-        
-        # Replace the XML declaration with our custom one
-        if pretty_xml.startswith('<?xml'):
-            pretty_xml = xml_declaration + pretty_xml.split('\n', 1)[1]
-        else:
-            pretty_xml = xml_declaration + pretty_xml
-        
-        # Set xml file and filename
-        filename = f'KVDPH_{self.year}_MESIAC_{int(self.month)}.XML'
-        file_data = base64.b64encode(pretty_xml.encode('utf-8'))
-        
-        self.write({
-            'xml_file': file_data,
-            'xml_filename': filename,
-            'state': 'exported'
-        })
-        
-        # Log the export with a note about individuals
-        total_vat_registered = len(self.a_section_line_ids.filtered(lambda l: not l.is_summary))
-        total_individuals = len(self.a_section_line_ids.filtered(lambda l: l.is_summary))
-        total_with_vat_id = len(self.a_section_line_ids.filtered(lambda l: not l.is_summary and l.partner_vat and l.partner_vat.upper().startswith('SK')))
-        total_with_empty_odb = len(self.a_section_line_ids.filtered(lambda l: not l.is_summary and l.partner_vat and l.partner_vat.upper().startswith('SK') and ((hasattr(l.partner_id, 'x_platca_dph') and not l.partner_id.x_platca_dph) or not hasattr(l.partner_id, 'x_platca_dph'))))
-        
-        _logger.info(
-            f"Exported XML file: {filename} with {total_vat_registered} A1 records. "
-            f"{total_individuals} summary records for individuals were included in totals but not as A1 records. "
-            f"{total_with_vat_id} records have a Slovak VAT ID, of which {total_with_empty_odb} have x_platca_dph=False (empty Odb attribute)."
-        )
-        
-        # Display a message about individuals being excluded from A1 records
-        total_vat_registered = len(self.a_section_line_ids.filtered(lambda l: not l.is_summary))
-        total_individuals = len(self.a_section_line_ids.filtered(lambda l: l.is_summary))
-        total_with_vat_id = len(self.a_section_line_ids.filtered(lambda l: not l.is_summary and l.partner_vat and l.partner_vat.upper().startswith('SK')))
-        total_with_empty_odb = len(self.a_section_line_ids.filtered(lambda l: not l.is_summary and l.partner_vat and l.partner_vat.upper().startswith('SK') and ((hasattr(l.partner_id, 'x_platca_dph') and not l.partner_id.x_platca_dph) or not hasattr(l.partner_id, 'x_platca_dph'))))
-        
-        message = f"""
-            <p>Kontrolný výkaz bol úspešne exportovaný a stiahnutý ako XML súbor.</p>
-            <ul>
-                <li><strong>XML Súbor:</strong> {filename}</li>
-                <li><strong>Počet A1 záznamov:</strong> {total_vat_registered}</li>
-                <li><strong>Počet súhrnných záznamov pre fyzické osoby:</strong> {total_individuals}</li>
-                <li><strong>Počet záznamov s SK IČ DPH:</strong> {total_with_vat_id}</li>
-                <li><strong>Počet záznamov s prázdnym atribútom Odb (x_platca_dph=False):</strong> {total_with_empty_odb}</li>
-            </ul>
-            <p><em>Poznámka: Súhrnné záznamy pre fyzické osoby bez IČ DPH sú zahrnuté v celkových sumách, ale nie sú exportované ako samostatné A1 záznamy v XML súbore.</em></p>
-            <p><em>Upozornenie: Partneri s IČ DPH SK, ktorí majú nastavené x_platca_dph=False, majú prázdny atribút Odb v A1 záznamoch.</em></p>
+        if debug:
+            _logger.info("D2 totals of %s - Base: %s, Tax: %s (section A: %s/%s, section C: %s/%s)",
+                         self.name, total_base, total_tax, self.total_a_base, self.total_a_tax,
+                         self.total_c_base, self.total_c_tax)
+        return total_base, total_tax
+    
+    def action_view_lines(self):
+        """Open the lines of the statement in their own list, grouped by record kind and tax rate.
+
+        Archived lines are not in the line table any more: they are listed in
+        the Excel workbook, streamed from the archive.
         """
-        
-        self.message_post(body=message)
-        
-        return {
-            'type': 'ir.actions.act_url',
-            'url': f'/web/content?model=kontrolny.vykaz&id={self.id}&field=xml_file&filename={filename}&download=true',
-            'target': 'self',
-        }
+        self.ensure_one()
+        if self.lines_archived:
+            return self.action_download_excel()
+        action = self.env['ir.actions.act_window']._for_xml_id(f'{self._module}.action_kontrolny_vykaz_a_line')
+        action.update({
+            'name': f'Riadky - {self.name}',
+            'domain': [('kontrolny_vykaz_id', '=', self.id)],
+        })
+        return action
     
     def action_reset_to_draft(self):
         self.ensure_one()
+        if self.generation_job_state in ('queued', 'running'):
+            raise UserError('Kontrolný výkaz sa práve generuje na pozadí.')
+        self._restore_lines()
         self.state = 'draft'
         return True
     
@@ -604,198 +2179,149 @@ class KontrolnyVykaz(models.Model):
                 }
             }
         
-        # Create Excel file in memory
-        output = BytesIO()
-        workbook = xlsxwriter.Workbook(output)
+        timer = PhaseTimer(self.env.cr)
+        classification = self._get_classification_cache()
+        filename = self._get_export_filename('excel')
+        
+        # Build the workbook in a temporary file, then store it once
+        with tempfile.NamedTemporaryFile(suffix='.xlsx') as output:
+            with timer.phase('excel_build') as phase:
+                counters = self._write_excel(output.name, classification=classification)
+                phase['lines'] = counters['excel_rows']
+            with timer.phase('file_write'):
+                output.seek(0)
+                self._store_export('excel', filename, output.read())
+                self.write({
+                    'excel_filename': filename,
+                    'state': 'exported' if self.state != 'exported' else self.state
+                })
+                self.flush_recordset(['excel_filename', 'state'])
+        self._record_timings('export_excel', timer)
+        self._store_export_stats('excel', filename, counters)
+        
+        return {
+            'type': 'ir.actions.act_url',
+            'url': f'/web/content?model=kontrolny.vykaz&id={self.id}&field=excel_file&filename={filename}&download=true',
+            'target': 'self',
+        }
+
+    def _write_excel(self, path, classification=None, counters=None):
+        """Write the KV DPHS workbook for this statement to `path`; return the counters of the export summary.
+
+        The workbook runs in constant_memory mode: each row is flushed to disk
+        as soon as the next one starts, so rows must be written in order.
+        """
+        self.ensure_one()
+        classification = classification or self._get_classification_cache()
+        counters = counters if counters is not None else Counter()
+        workbook = xlsxwriter.Workbook(path, {'constant_memory': True})
         worksheet = workbook.add_worksheet('KV DPHS')
         
-        # Define formats
+        # Define formats, shared by all cells
         header_format = workbook.add_format({
             'bold': True, 
             'align': 'center', 
             'valign': 'vcenter', 
             'bg_color': '#D3D3D3'
         })
-        date_format = workbook.add_format({'num_format': 'mm/dd/yy'})
         number_format = workbook.add_format({'num_format': '#,##0.00'})
         
-        # Write headers
         headers = [
-            'ns1:IcDphPlatitela', 'ns1:Druh', 'ns1:Rok', 'ns1:Mesiac', 'ns1:Nazov', 
+            'ns1:IcDphPlatitela', 'ns1:Druh', 'ns1:Rok',
+            'ns1:Stvrtrok' if self.period_type == 'quarter' else 'ns1:Mesiac', 'ns1:Nazov',
             'ns1:Stat', 'ns1:Obec', 'ns1:PSC', 'ns1:Ulica', 'ns1:Cislo', 'ns1:Tel', 'ns1:Email',
             'Odb', 'F', 'Den', 'Z', 'D', 'S', 'Odb2', 'FO', 'FP', 'ZR', 'DR', 'S3', 'Z4', 'D5', 'ZZn', 'DZn'
         ]
         
+        # Adjust column widths
         for col, header in enumerate(headers):
-            worksheet.write(0, col, header, header_format)
+            worksheet.set_column(col, col, len(header) + 2)
         
-        # Get company data
+        # Write headers
+        worksheet.write_row(0, 0, headers, header_format)
+        
+        # Company block (ns1:IcDphPlatitela .. ns1:Email), identical on every row
         company = self.company_id
+        company_cells = [
+            company.vat or '',                       # ns1:IcDphPlatitela
+            'R',                                     # ns1:Druh: the workbook always lists the whole statement
+            self.year,                               # ns1:Rok
+            int(self.quarter if self.period_type == 'quarter' else self.month),  # ns1:Mesiac / ns1:Stvrtrok
+            company.name or '',                      # ns1:Nazov
+            company.country_id.name or 'Slovensko',  # ns1:Stat
+            company.city or '',                      # ns1:Obec
+            company.zip or '',                       # ns1:PSC
+            company.street or '',                    # ns1:Ulica
+            company.street2 or '',                   # ns1:Cislo
+            company.phone or '',                     # ns1:Tel
+            company.email or '',                     # ns1:Email
+        ]
+        
+        # Totals with special handling for negative values
+        total_base = self.total_a_base
+        total_tax = self.total_a_tax
+        totals_cells = [total_base if total_base >= 0 else 0, total_tax if total_tax >= 0 else 0]  # Z4, D5
+        totals_negative_cells = [abs(total_base) if total_base < 0 else 0,
+                                 abs(total_tax) if total_tax < 0 else 0]                      # ZZn, DZn
         
         # Process regular lines (with VAT ID)
         row = 1
-        regular_lines = self.a_section_line_ids.filtered(lambda l: not l.is_summary)
-        
-        for line in regular_lines:
+        for line in self._iter_lines([('is_summary', '=', False)]):
+            _count_export_line(counters, line, classification)
             # Skip if no partner VAT (should be handled in summary)
             # We leave in entries where partner has VAT but x_platca_dph is False (will have empty Odb)
-            if not line.partner_vat or not line.partner_vat.upper().startswith('SK'):
+            if not is_sk_vat(line.partner_vat):
                 continue
                 
             # Format date as MM/DD/YY
             date_str = line.supply_date.strftime('%m/%d/%y') if line.supply_date else ''
             
-            # Basic columns
-            worksheet.write(row, 0, company.vat or '')  # ns1:IcDphPlatitela
-            worksheet.write(row, 1, 'R')                # ns1:Druh (always R)
-            worksheet.write(row, 2, self.year)          # ns1:Rok
-            worksheet.write(row, 3, int(self.month))    # ns1:Mesiac
-            worksheet.write(row, 4, company.name or '') # ns1:Nazov
-            
-            # Company address details
-            worksheet.write(row, 5, company.country_id.name or 'Slovensko')  # ns1:Stat
-            worksheet.write(row, 6, company.city or '')                      # ns1:Obec
-            worksheet.write(row, 7, company.zip or '')                       # ns1:PSC
-            worksheet.write(row, 8, company.street or '')                    # ns1:Ulica
-            worksheet.write(row, 9, company.street2 or '')                   # ns1:Cislo
-            worksheet.write(row, 10, company.phone or '')                    # ns1:Tel
-            worksheet.write(row, 11, company.email or '')                    # ns1:Email
+            worksheet.write_row(row, 0, company_cells)
             
             # Invoice details
-            if line.partner_id and hasattr(line.partner_id, 'x_platca_dph') and line.partner_id.x_platca_dph and line.partner_vat and line.partner_vat.upper().startswith('SK'):
-                worksheet.write(row, 12, line.partner_vat or '')                 # Odb (customer VAT)
-            else:
-                worksheet.write(row, 12, '')                                     # Odb (empty for non-VAT payers)
+            odb = classification.odb(line.partner_id.id, line.partner_vat)  # Odb, empty for non-VAT payers
                 
             # Invoice/refund specific fields
             if line.is_refund:
-                # For refunds (C1)
-                worksheet.write(row, 13, '')                                     # F (empty for refunds)
-                worksheet.write(row, 14, '')                                     # Den (empty for refunds)
-                worksheet.write(row, 15, '')                                     # Z (empty for refunds)
-                worksheet.write(row, 16, '')                                     # D (empty for refunds)
-                worksheet.write(row, 17, '')                                     # S (empty for refunds)
-                
-                # Refund fields
-                worksheet.write(row, 18, '')                                     # Odb2 (usually empty)
-                worksheet.write(row, 19, line.invoice_number or '')              # FO (original invoice number)
-                worksheet.write(row, 20, '')                                     # FP (usually empty)
-                # Use absolute values for the Excel export
-                worksheet.write(row, 21, abs(line.base_amount), number_format)   # ZR (refund base amount)
-                worksheet.write(row, 22, abs(line.tax_amount), number_format)    # DR (refund tax amount)
-                worksheet.write(row, 23, int(line.tax_rate))                     # S3 (tax rate for refunds) 
+                # For refunds (C1): F, Den, Z, D, S and Odb2 stay empty,
+                # FO holds the original invoice number, FP is usually empty
+                worksheet.write_row(row, 12, [odb, '', '', '', '', '', '', line.invoice_number or '', ''])
+                # Use absolute values for the Excel export (ZR, DR)
+                worksheet.write_row(row, 21, [abs(line.base_amount), abs(line.tax_amount)], number_format)
+                worksheet.write(row, 23, int(line.tax_rate))  # S3 (tax rate for refunds)
             else:
-                # For regular invoices (A1)
-                worksheet.write(row, 13, line.invoice_number or '')              # F (invoice number)
-                worksheet.write(row, 14, date_str)                               # Den (date)
-                worksheet.write(row, 15, line.base_amount, number_format)        # Z (base amount)
-                worksheet.write(row, 16, line.tax_amount, number_format)         # D (tax amount)
-                worksheet.write(row, 17, int(line.tax_rate))                     # S (tax rate)
-                
-                # Empty refund fields
-                worksheet.write(row, 18, '')                                     # Odb2
-                worksheet.write(row, 19, '')                                     # FO
-                worksheet.write(row, 20, '')                                     # FP
-                worksheet.write(row, 21, '')                                     # ZR
-                worksheet.write(row, 22, '')                                     # DR
-                worksheet.write(row, 23, '')                                     # S3
-            
-            # Calculate total amounts considering refunds
-            total_base = self.total_a_base
-            total_tax = self.total_a_tax
+                # For regular invoices (A1): Odb, F, Den
+                worksheet.write_row(row, 12, [odb, line.invoice_number or '', date_str])
+                worksheet.write_row(row, 15, [line.base_amount, line.tax_amount], number_format)  # Z, D
+                # S, then empty Odb2, FO, FP, ZR, DR, S3
+                worksheet.write_row(row, 17, [int(line.tax_rate), '', '', '', '', '', ''])
             
-            # Totals with special handling for negative values
-            worksheet.write(row, 24, total_base if total_base >= 0 else 0, number_format)  # Z4 (total base)
-            worksheet.write(row, 25, total_tax if total_tax >= 0 else 0, number_format)    # D5 (total tax)
-            worksheet.write(row, 26, abs(total_base) if total_base < 0 else 0)             # ZZn
-            worksheet.write(row, 27, abs(total_tax) if total_tax < 0 else 0)               # DZn
+            worksheet.write_row(row, 24, totals_cells, number_format)  # Z4, D5
+            worksheet.write_row(row, 26, totals_negative_cells)        # ZZn, DZn
             
             row += 1
         
         # Process summary lines for individuals (no VAT ID) at the end
-        summary_lines = self.a_section_line_ids.filtered(lambda l: l.is_summary)
-        
-        for line in summary_lines:
+        for line in self._iter_lines([('is_summary', '=', True)]):
+            _count_export_line(counters, line, classification)
             # Format date as MM/DD/YY
             date_str = line.supply_date.strftime('%m/%d/%y') if line.supply_date else ''
             
-            # Basic columns (same as regular lines)
-            worksheet.write(row, 0, company.vat or '')  # ns1:IcDphPlatitela
-            worksheet.write(row, 1, 'R')                # ns1:Druh (always R)
-            worksheet.write(row, 2, self.year)          # ns1:Rok
-            worksheet.write(row, 3, int(self.month))    # ns1:Mesiac
-            worksheet.write(row, 4, company.name or '') # ns1:Nazov
+            worksheet.write_row(row, 0, company_cells)
             
-            # Company address details (same as regular lines)
-            worksheet.write(row, 5, company.country_id.name or 'Slovensko')  # ns1:Stat
-            worksheet.write(row, 6, company.city or '')                      # ns1:Obec
-            worksheet.write(row, 7, company.zip or '')                       # ns1:PSC
-            worksheet.write(row, 8, company.street or '')                    # ns1:Ulica
-            worksheet.write(row, 9, company.street2 or '')                   # ns1:Cislo
-            worksheet.write(row, 10, company.phone or '')                    # ns1:Tel
-            worksheet.write(row, 11, company.email or '')                    # ns1:Email
-            
-            # For individuals, the VAT ID (Odb) is blank or can be "Individuals"
-            worksheet.write(row, 12, '')                                     # Odb (blank for individuals)
-            worksheet.write(row, 13, line.invoice_number or '')              # F (summary invoice number)
-            worksheet.write(row, 14, date_str)                               # Den (date)
-            worksheet.write(row, 15, line.base_amount, number_format)        # Z (base amount)
-            worksheet.write(row, 16, line.tax_amount, number_format)         # D (tax amount)
-            worksheet.write(row, 17, int(line.tax_rate))                     # S (tax rate)
-            
-            # Extra columns (same as regular lines)
-            worksheet.write(row, 18, '')  # Odb2
-            worksheet.write(row, 19, '')  # FO
-            worksheet.write(row, 20, '')  # FP
-            worksheet.write(row, 21, '')  # ZR
-            worksheet.write(row, 22, '')  # DR
-            worksheet.write(row, 23, '')  # S3
-            worksheet.write(row, 24, self.total_a_base, number_format)  # Z4 (total base)
-            worksheet.write(row, 25, self.total_a_tax, number_format)   # D5 (total tax)
-            worksheet.write(row, 26, 0)   # ZZn
-            worksheet.write(row, 27, 0)   # DZn
+            # For individuals, the VAT ID (Odb) is blank: Odb, F, Den
+            worksheet.write_row(row, 12, ['', line.invoice_number or '', date_str])
+            worksheet.write_row(row, 15, [line.base_amount, line.tax_amount], number_format)  # Z, D
+            # S, then empty Odb2, FO, FP, ZR, DR, S3
+            worksheet.write_row(row, 17, [int(line.tax_rate), '', '', '', '', '', ''])
+            worksheet.write_row(row, 24, [total_base, total_tax], number_format)  # Z4, D5
+            worksheet.write_row(row, 26, [0, 0])  # ZZn, DZn
             
             row += 1
         
-        # Adjust column widths
-        for col, header in enumerate(headers):
-            worksheet.set_column(col, col, len(header) + 2)
-        
         workbook.close()
-        
-        # Set excel file and filename
-        filename = f'KV_DPHS_{self.year}_{int(self.month)}.xlsx'
-        file_data = base64.b64encode(output.getvalue())
-        
-        self.write({
-            'excel_file': file_data,
-            'excel_filename': filename,
-            'state': 'exported' if self.state != 'exported' else self.state
-        })
-        
-        # Log success message for the Excel export
-        total_vat_registered = len(self.a_section_line_ids.filtered(lambda l: not l.is_summary))
-        total_individuals = len(self.a_section_line_ids.filtered(lambda l: l.is_summary))
-        total_with_vat_id = len(self.a_section_line_ids.filtered(lambda l: not l.is_summary and l.partner_vat and l.partner_vat.upper().startswith('SK')))
-        total_with_empty_odb = len(self.a_section_line_ids.filtered(lambda l: not l.is_summary and l.partner_vat and l.partner_vat.upper().startswith('SK') and ((hasattr(l.partner_id, 'x_platca_dph') and not l.partner_id.x_platca_dph) or not hasattr(l.partner_id, 'x_platca_dph'))))
-        
-        self.message_post(body=f"""
-            <p>Kontrolný výkaz bol úspešne exportovaný do Excel súboru.</p>
-            <ul>
-                <li><strong>Excel Súbor:</strong> {filename}</li>
-                <li><strong>Počet A1 záznamov:</strong> {total_vat_registered}</li>
-                <li><strong>Počet súhrnných záznamov pre fyzické osoby:</strong> {total_individuals}</li>
-                <li><strong>Počet záznamov s SK IČ DPH:</strong> {total_with_vat_id}</li>
-                <li><strong>Počet záznamov s prázdnym atribútom Odb (x_platca_dph=False):</strong> {total_with_empty_odb}</li>
-            </ul>
-            <p><em>Poznámka: Aj v Excel súbore sa používa pole x_platca_dph na určenie, či sa má v stĺpci Odb zobraziť IČ DPH.</em></p>
-        """)
-        
-        return {
-            'type': 'ir.actions.act_url',
-            'url': f'/web/content?model=kontrolny.vykaz&id={self.id}&field=excel_file&filename={filename}&download=true',
-            'target': 'self',
-        }
+        counters['excel_rows'] += row - 1
+        return counters
 
 
 class KontrolnyVykazALine(models.Model):
@@ -805,15 +2331,42 @@ class KontrolnyVykazALine(models.Model):
     kontrolny_vykaz_id = fields.Many2one('kontrolny.vykaz', string='Kontrolný výkaz', ondelete='cascade')
     partner_id = fields.Many2one('res.partner', string='Odberateľ')
     partner_vat = fields.Char(string='IČ DPH odberateľa')
-    invoice_id = fields.Many2one('account.move', string='Faktúra')
+    invoice_id = fields.Many2one('account.move', string='Faktúra', index='btree_not_null')
     invoice_number = fields.Char(string='Číslo faktúry')
     invoice_date = fields.Date(string='Dátum vyhotovenia')
     supply_date = fields.Date(string='Dátum dodania')
     base_amount = fields.Monetary(string='Základ dane')
-    tax_rate = fields.Float(string='Sadzba DPH (%)')
+    # Not summed in the groups of the line list
+    tax_rate = fields.Float(string='Sadzba DPH (%)', aggregator=False)
     tax_amount = fields.Monetary(string='Suma DPH')
     currency_id = fields.Many2one(related='kontrolny_vykaz_id.currency_id')
     is_summary = fields.Boolean(string='Je súhrnný riadok', default=False,
                              help='Toto je súhrnný riadok pre fyzické osoby bez IČ DPH')
     is_refund = fields.Boolean(string='Je dobropis', default=False,
-                             help='Toto je dobropis (faktúra so zápornou hodnotou)')
\ No newline at end of file
+                             help='Toto je dobropis (faktúra so zápornou hodnotou)')
+    
+    def init(self):
+        # Every export, total and view filters the lines of one statement by
+        # these flags and reads them in id order; the statement alone is the
+        # prefix of the same index
+        create_index(self.env.cr, 'kontrolny_vykaz_a_line_statement_flags_index', self._table,
+                     ['kontrolny_vykaz_id', 'is_summary', 'is_refund', 'id'])
+    
+    @api.model_create_multi
+    def create(self, vals_list):
+        lines = super().create(vals_list)
+        lines.kontrolny_vykaz_id._apply_line_totals(lines)
+        return lines
+    
+    def write(self, vals):
+        if not {'kontrolny_vykaz_id', 'is_refund', 'tax_rate', 'base_amount', 'tax_amount'} & set(vals):
+            return super().write(vals)
+        statements = self.kontrolny_vykaz_id
+        res = super().write(vals)
+        (statements | self.kontrolny_vykaz_id)._compute_totals()
+        return res
+    
+    def unlink(self):
+        statements = self.kontrolny_vykaz_id
+        statements._apply_line_totals(self, sign=-1)
+        return super().unlink()
\ No newline at end of file
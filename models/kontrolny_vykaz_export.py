@@ -0,0 +1,101 @@
+from odoo import models, fields, api
+from odoo.exceptions import UserError
+
+import gzip
+import hashlib
+import io
+import zipfile
+
+# Extension added to the stored file name per compression
+COMPRESSION_SUFFIXES = {'none': '', 'gzip': '.gz', 'zip': '.zip'}
+
+
+class KontrolnyVykazExport(models.Model):
+    """One exported XML or Excel file of a statement, stored as a filestore attachment.
+
+    Only the metadata lives in the table; the content is read from the
+    attachment, and decompressed, when the file is actually downloaded.
+    """
+    _name = 'kontrolny.vykaz.export'
+    _description = 'Export kontrolného výkazu'
+    _order = 'create_date desc, id desc'
+
+    kontrolny_vykaz_id = fields.Many2one('kontrolny.vykaz', string='Kontrolný výkaz', required=True,
+                                         ondelete='cascade', index=True)
+    kind = fields.Selection([
+        ('xml', 'XML'),
+        ('excel', 'Excel'),
+    ], string='Typ', required=True)
+    filename = fields.Char('Názov súboru', required=True)
+    compression = fields.Selection([
+        ('none', 'Bez kompresie'),
+        ('gzip', 'gzip'),
+        ('zip', 'zip'),
+    ], string='Kompresia', required=True, default='none')
+    file_size = fields.Integer('Veľkosť (B)', help='Veľkosť nekomprimovaného súboru')
+    stored_size = fields.Integer('Uložená veľkosť (B)')
+    checksum = fields.Char('Kontrolný súčet', help='SHA-1 nekomprimovaného súboru')
+    attachment_id = fields.Many2one('ir.attachment', string='Príloha', readonly=True, ondelete='set null')
+
+    @api.model
+    def _compress(self, data, compression, filename):
+        if compression == 'gzip':
+            # Fixed mtime: identical exports give identical files, which the filestore deduplicates
+            return gzip.compress(data, mtime=0)
+        if compression == 'zip':
+            buffer = io.BytesIO()
+            with zipfile.ZipFile(buffer, 'w', zipfile.ZIP_DEFLATED) as archive:
+                archive.writestr(zipfile.ZipInfo(filename, date_time=(1980, 1, 1, 0, 0, 0)), data,
+                                 compress_type=zipfile.ZIP_DEFLATED)
+            return buffer.getvalue()
+        return data
+
+    def _set_content(self, data, compression='none'):
+        """Store `data` in a new attachment, compressed as requested"""
+        self.ensure_one()
+        stored = self._compress(data, compression, self.filename)
+        attachment_vals = {
+            'name': self.filename + COMPRESSION_SUFFIXES[compression],
+            'raw': stored,
+            'res_model': self._name,
+            'res_id': self.id,
+        }
+        if compression != 'none':
+            attachment_vals['mimetype'] = f'application/{compression}'
+        attachment = self.env['ir.attachment'].sudo().create(attachment_vals)
+        self.write({
+            'attachment_id': attachment.id,
+            'compression': compression,
+            'file_size': len(data),
+            'stored_size': len(stored),
+            'checksum': hashlib.sha1(data).hexdigest(),
+        })
+
+    def _get_content(self):
+        """Uncompressed content of the exported file"""
+        self.ensure_one()
+        if not self.attachment_id:
+            raise UserError(f'Súbor {self.filename} už nie je uložený.')
+        stored = self.attachment_id.sudo().raw
+        if self.compression == 'gzip':
+            return gzip.decompress(stored)
+        if self.compression == 'zip':
+            with zipfile.ZipFile(io.BytesIO(stored)) as archive:
+                return archive.read(archive.namelist()[0])
+        return stored
+
+    def action_download(self):
+        self.ensure_one()
+        if not self.attachment_id:
+            raise UserError(f'Súbor {self.filename} už nie je uložený.')
+        return {
+            'type': 'ir.actions.act_url',
+            'url': f'/web/content/{self.attachment_id.id}?download=true',
+            'target': 'self',
+        }
+
+    def unlink(self):
+        attachments = self.attachment_id
+        res = super().unlink()
+        attachments.sudo().unlink()
+        return res
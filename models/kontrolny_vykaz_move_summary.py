@@ -0,0 +1,133 @@
+from odoo import models, fields, api
+from odoo.tools import create_index
+
+import logging
+
+from ..tools.amounts import move_tax_amounts_query
+
+_logger = logging.getLogger(__name__)
+
+# Moves summarised per batch of the backfill
+SUMMARY_BACKFILL_BATCH_SIZE = 10000
+
+# Set once every document posted before the summaries were kept has its rows
+SUMMARY_BACKFILLED_PARAM = 'kontrolny_vykaz.summary_backfilled'
+
+
+class KontrolnyVykazMoveSummary(models.Model):
+    """Base and tax of one posted customer invoice or refund per tax rate.
+
+    Filled when the move is posted and dropped when it is reset to draft or
+    cancelled, so a generation reads one row per document and rate instead of
+    every journal item. Amounts are in company currency, summed from the
+    posted product and tax lines, and use the sign convention of the
+    statement: refunds are negative.
+    """
+    _name = 'kontrolny.vykaz.move.summary'
+    _description = 'Súhrn dokladu pre kontrolný výkaz'
+    _order = 'move_id, sequence'
+    _log_access = False
+
+    move_id = fields.Many2one('account.move', string='Doklad', required=True, ondelete='cascade', index=True)
+    company_id = fields.Many2one('res.company', string='Spoločnosť', required=True)
+    reversed_entry_id = fields.Many2one('account.move', string='Obrátený doklad', index='btree_not_null')
+    is_refund = fields.Boolean('Je dobropis')
+    document_date = fields.Date('Dátum dokladu', help='Dátum dodania dokladu, inak dátum vyhotovenia')
+    effective_date = fields.Date('Dátum pre výkaz',
+                                 help='Pri dobropise k obrátenej faktúre dátum pôvodnej faktúry, inak dátum dokladu')
+    tax_rate = fields.Float('Sadzba DPH (%)')
+    base = fields.Float('Základ dane')
+    tax = fields.Float('Suma DPH')
+    line_count = fields.Integer('Počet riadkov')
+    sequence = fields.Integer(help='Prvý riadok faktúry so sadzbou, určuje poradie v rámci dokladu')
+
+    _sql_constraints = [
+        ('move_rate_uniq', 'unique(move_id, tax_rate)', 'Súhrn dokladu môže mať každú sadzbu len raz.'),
+    ]
+
+    def init(self):
+        # Month-end range reads by own and by effective date
+        create_index(self.env.cr, 'kontrolny_vykaz_move_summary_document_date_index', self._table,
+                     ['company_id', 'document_date'])
+        create_index(self.env.cr, 'kontrolny_vykaz_move_summary_effective_date_index', self._table,
+                     ['company_id', 'effective_date'])
+
+    @api.model
+    def _refresh_moves(self, move_ids):
+        """Rebuild the rows of `move_ids`; moves not posted (any more) lose theirs"""
+        move_ids = list(set(move_ids))
+        if not move_ids:
+            return
+        self.env['account.move'].flush_model()
+        self.env['account.move.line'].flush_model()
+        self.env['account.tax'].flush_model(['amount'])
+        self.flush_model()
+        self.env.cr.execute(f"DELETE FROM {self._table} WHERE move_id = ANY(%s)", [move_ids])
+        self.env.cr.execute(f"""
+            WITH amounts AS ({move_tax_amounts_query("= ANY(%(move_ids)s)")})
+            INSERT INTO {self._table} (move_id, company_id, reversed_entry_id, is_refund, document_date,
+                                       effective_date, tax_rate, base, tax, line_count, sequence)
+            SELECT m.id,
+                   m.company_id,
+                   m.reversed_entry_id,
+                   m.move_type = 'out_refund',
+                   COALESCE(m.taxable_supply_date, m.invoice_date),
+                   CASE WHEN m.move_type = 'out_refund' AND m.reversed_entry_id IS NOT NULL
+                        THEN COALESCE(o.taxable_supply_date, o.invoice_date)
+                        ELSE COALESCE(m.taxable_supply_date, m.invoice_date)
+                   END,
+                   a.tax_rate,
+                   SUM(a.base),
+                   SUM(a.tax),
+                   COUNT(a.line_id),
+                   MIN(a.line_id)
+              FROM account_move m
+         LEFT JOIN account_move o ON o.id = m.reversed_entry_id
+              JOIN amounts a ON a.move_id = m.id
+             WHERE m.id = ANY(%(move_ids)s)
+               AND m.state = 'posted'
+               AND m.move_type IN ('out_invoice', 'out_refund')
+          GROUP BY m.id, o.id, a.tax_rate
+            HAVING COUNT(a.line_id) > 0
+        """, {'move_ids': move_ids})
+        self.invalidate_model()
+
+    @api.model
+    def _cron_backfill(self):
+        """Fill the summaries of the existing documents outside of any upgrade, committing every batch"""
+        self._backfill(commit=True)
+
+    @api.model
+    def _backfill(self, batch_size=SUMMARY_BACKFILL_BATCH_SIZE, commit=False):
+        """Summarise the posted customer invoices and refunds that have no rows yet.
+
+        Once done, the 'summary' aggregation mode may read the table. With
+        `commit`, every batch is committed, so an interrupted run resumes
+        where it stopped.
+        """
+        total = 0
+        while True:
+            self.env.cr.execute(f"""
+                SELECT m.id
+                  FROM account_move m
+                 WHERE m.state = 'posted'
+                   AND m.move_type IN ('out_invoice', 'out_refund')
+                   AND NOT EXISTS (SELECT 1 FROM {self._table} s WHERE s.move_id = m.id)
+                   AND EXISTS (SELECT 1
+                                 FROM account_move_line l
+                                 JOIN account_move_line_account_tax_rel rel ON rel.account_move_line_id = l.id
+                                WHERE l.move_id = m.id
+                                  AND l.display_type IN ('product', 'line_section', 'line_note'))
+              ORDER BY m.id
+                 LIMIT %s
+            """, [batch_size])
+            move_ids = [row[0] for row in self.env.cr.fetchall()]
+            if not move_ids:
+                break
+            self._refresh_moves(move_ids)
+            total += len(move_ids)
+            if commit:
+                self.env.cr.commit()
+            _logger.info("Summarised %s customer invoices and refunds for the control statement", total)
+        self.env['ir.config_parameter'].sudo().set_param(SUMMARY_BACKFILLED_PARAM, '1')
+        return total
@@ -0,0 +1,152 @@
+import json
+
+from odoo import models, fields, api
+
+# Identity of a statement line across generations: record kind, document and rate
+ROW_KEY_SQL = """concat_ws('|',
+    CASE WHEN l.is_summary AND l.is_refund THEN 'SC' WHEN l.is_summary THEN 'SA'
+         WHEN l.is_refund THEN 'C1' ELSE 'A1' END,
+    CASE WHEN l.is_summary THEN '' ELSE COALESCE(l.invoice_id::text, l.invoice_number, '') END,
+    round(l.tax_rate::numeric, 2))"""
+
+# Content of a statement line as filed: everything that ends up in the XML
+ROW_HASH_SQL = """md5(concat_ws('|', l.partner_id, l.partner_vat, l.invoice_number, l.invoice_date, l.supply_date,
+    round(l.base_amount::numeric, 2), round(l.tax_amount::numeric, 2)))"""
+
+# Archived lines of a statement as a row source of alias l, from a JSON array
+# of their values; archived lines have no id any more
+ARCHIVED_LINES_SQL = """jsonb_to_recordset(%(archived)s::jsonb) AS l(
+    kontrolny_vykaz_id integer, id integer, partner_id integer, partner_vat varchar, invoice_id integer,
+    invoice_number varchar, invoice_date date, supply_date date, base_amount numeric, tax_rate numeric,
+    tax_amount numeric, is_summary boolean, is_refund boolean)"""
+
+
+class KontrolnyVykazSnapshotLine(models.Model):
+    """One line of a statement as it was filed, with the key and content hash it is compared by.
+
+    Taken when the regular statement is exported and advanced by each
+    corrective or supplementary filing. A deleted document leaves its rows
+    without invoice_id, which makes them candidates of the next diff. Rows are only written by SQL from the
+    statement lines and are read-only for users.
+    """
+    _name = 'kontrolny.vykaz.snapshot.line'
+    _description = 'Podaný riadok kontrolného výkazu'
+    _order = 'kontrolny_vykaz_id, id'
+    _log_access = False
+
+    kontrolny_vykaz_id = fields.Many2one('kontrolny.vykaz', string='Kontrolný výkaz', required=True,
+                                         ondelete='cascade', index=True)
+    line_id = fields.Integer('Riadok výkazu', help='Riadok výkazu, z ktorého bol záznam podaný')
+    row_key = fields.Char('Kľúč', required=True)
+    row_hash = fields.Char('Odtlačok obsahu', required=True)
+    partner_id = fields.Many2one('res.partner', string='Odberateľ', ondelete='set null')
+    partner_vat = fields.Char('IČ DPH odberateľa')
+    invoice_id = fields.Many2one('account.move', string='Faktúra', ondelete='set null', index='btree_not_null')
+    invoice_number = fields.Char('Číslo faktúry')
+    invoice_date = fields.Date('Dátum vyhotovenia')
+    supply_date = fields.Date('Dátum dodania')
+    base_amount = fields.Float('Základ dane')
+    tax_rate = fields.Float('Sadzba DPH (%)')
+    tax_amount = fields.Float('Suma DPH')
+    is_summary = fields.Boolean('Je súhrnný riadok')
+    is_refund = fields.Boolean('Je dobropis')
+
+    _sql_constraints = [
+        ('statement_key_uniq', 'unique(kontrolny_vykaz_id, row_key)', 'Podaný riadok musí byť vo výkaze jedinečný.'),
+    ]
+
+    def _insert_lines(self, statement, where, params, source='kontrolny_vykaz_a_line l'):
+        """Copy the lines of `statement` matching `where` (on alias l) of `source` into the snapshot"""
+        self.env.cr.execute(f"""
+            INSERT INTO {self._table} (kontrolny_vykaz_id, line_id, row_key, row_hash, partner_id, partner_vat,
+                                       invoice_id, invoice_number, invoice_date, supply_date, base_amount,
+                                       tax_rate, tax_amount, is_summary, is_refund)
+            SELECT l.kontrolny_vykaz_id, l.id, {ROW_KEY_SQL}, {ROW_HASH_SQL}, l.partner_id, l.partner_vat,
+                   l.invoice_id, l.invoice_number, l.invoice_date, l.supply_date, l.base_amount,
+                   l.tax_rate, l.tax_amount, COALESCE(l.is_summary, FALSE), COALESCE(l.is_refund, FALSE)
+              FROM {source}
+             WHERE l.kontrolny_vykaz_id = %(statement_id)s
+               AND ({where})
+        """, dict(params, statement_id=statement.id))
+
+    def _mark_taken(self, statement):
+        # Moves changed after this point are the candidates of the next diff
+        statement.write({'snapshot_date': self.env.cr.now()})
+        self.invalidate_model()
+
+    @api.model
+    def _take(self, statement):
+        """Replace the snapshot of `statement` by its current lines"""
+        self.env['kontrolny.vykaz.a.line'].flush_model()
+        self.env.cr.execute(f"DELETE FROM {self._table} WHERE kontrolny_vykaz_id = %s", [statement.id])
+        if statement.lines_archived:
+            # Same rows and hashes, read from the archive instead of the line table
+            archived = [dict(values, kontrolny_vykaz_id=statement.id)
+                        for values in statement._get_archived_line_values()]
+            self._insert_lines(statement, 'TRUE', {'archived': json.dumps(archived, default=str)},
+                               source=ARCHIVED_LINES_SQL)
+        else:
+            self._insert_lines(statement, 'TRUE', {})
+        self._mark_taken(statement)
+
+    @api.model
+    def _diff(self, statement):
+        """Compare the lines of `statement` depending on what changed since the snapshot with their filed version.
+
+        Candidates are found the way an incremental generation finds its
+        work: the lines and filed rows of the documents changed since the
+        snapshot (statement._get_changed_move_ids), the few summary lines
+        and rows without a document (which includes filed rows of deleted
+        documents), and lines edited in place after the snapshot. Lines that
+        were only recreated, by a full regeneration, a restore from the
+        archive or a quarter rebuild, are not candidates. The two sides are
+        matched by key with one full hash join. Return one dict per candidate
+        with row_key, line_id, snapshot_id, old_hash and new_hash: no old
+        hash for an added row, no new hash for a removed one, equal hashes
+        for a line rebuilt with the same content.
+        """
+        self.env['kontrolny.vykaz.a.line'].flush_model()
+        self.flush_model()
+        move_ids = list(statement._get_changed_move_ids(statement.snapshot_date))
+        self.env.cr.execute(f"""
+            WITH candidates AS (
+                SELECT l.id AS line_id, {ROW_KEY_SQL} AS row_key, {ROW_HASH_SQL} AS row_hash
+                  FROM kontrolny_vykaz_a_line l
+                 WHERE l.kontrolny_vykaz_id = %(statement_id)s
+                   AND (l.invoice_id = ANY(%(move_ids)s)
+                        OR l.invoice_id IS NULL
+                        OR (l.create_date <= %(snapshot_date)s AND l.write_date > %(snapshot_date)s))
+            ),
+            filed AS (
+                SELECT s.id, s.row_key, s.row_hash
+                  FROM {self._table} s
+                 WHERE s.kontrolny_vykaz_id = %(statement_id)s
+                   AND (s.invoice_id = ANY(%(move_ids)s)
+                        OR s.invoice_id IS NULL
+                        OR s.row_key IN (SELECT row_key FROM candidates))
+            )
+            SELECT COALESCE(c.row_key, f.row_key) AS row_key,
+                   c.line_id,
+                   f.id AS snapshot_id,
+                   f.row_hash AS old_hash,
+                   c.row_hash AS new_hash
+              FROM candidates c
+         FULL JOIN filed f ON f.row_key = c.row_key
+          ORDER BY 1
+        """, {
+            'statement_id': statement.id,
+            'move_ids': move_ids,
+            'snapshot_date': statement.snapshot_date,
+        })
+        return self.env.cr.dictfetchall()
+
+    @api.model
+    def _apply(self, statement, delta):
+        """Advance the snapshot of `statement` by the rows of `delta`, as returned by _diff"""
+        snapshot_ids = [row['snapshot_id'] for row in delta if row['snapshot_id']]
+        line_ids = [row['line_id'] for row in delta if row['line_id']]
+        if snapshot_ids:
+            self.env.cr.execute(f"DELETE FROM {self._table} WHERE id = ANY(%s)", [snapshot_ids])
+        if line_ids:
+            self._insert_lines(statement, 'l.id = ANY(%(line_ids)s)', {'line_ids': line_ids})
+        self._mark_taken(statement)
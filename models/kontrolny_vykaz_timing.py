@@ -0,0 +1,36 @@
+from odoo import models, fields
+
+
+class KontrolnyVykazTiming(models.Model):
+    _name = 'kontrolny.vykaz.timing'
+    _description = 'Meranie behu kontrolného výkazu'
+    _order = 'run_date desc, id'
+
+    kontrolny_vykaz_id = fields.Many2one('kontrolny.vykaz', string='Kontrolný výkaz', required=True,
+                                         ondelete='cascade', index=True)
+    run_date = fields.Datetime('Začiatok behu', required=True)
+    operation = fields.Selection([
+        ('generate', 'Generovanie'),
+        ('generate_async', 'Generovanie na pozadí'),
+        ('precompute', 'Predvýpočet'),
+        ('export_xml', 'Export XML'),
+        ('export_excel', 'Export Excel'),
+    ], string='Operácia', required=True)
+    phase = fields.Selection([
+        ('line_unlink', 'Odstránenie riadkov'),
+        ('move_search', 'Vyhľadanie dokladov'),
+        ('reversal_lookup', 'Dobropisy stornovaných faktúr'),
+        ('aggregation', 'Agregácia dokladov'),
+        ('line_creation', 'Vytvorenie riadkov'),
+        ('totals', 'Prepočet súčtov'),
+        ('xml_build', 'Zostavenie XML'),
+        ('xml_validate', 'Kontrola XML podľa XSD'),
+        ('snapshot', 'Snímka podaných riadkov'),
+        ('excel_build', 'Zostavenie Excelu'),
+        ('file_write', 'Kódovanie a zápis súboru'),
+        ('total', 'Celkom'),
+    ], string='Fáza', required=True)
+    duration_ms = fields.Float('Trvanie (ms)', digits=(16, 1))
+    query_count = fields.Integer('Počet SQL dotazov')
+    documents = fields.Integer('Spracované doklady')
+    lines = fields.Integer('Spracované riadky')
@@ -0,0 +1,13 @@
+from odoo import models, fields
+
+
+class ResCompany(models.Model):
+    _inherit = 'res.company'
+
+    kv_precompute = fields.Selection([
+        ('none', 'Vypnutý'),
+        ('nightly', 'Každú noc'),
+        ('hourly', 'Každú noc a každú hodinu'),
+    ], string='Predvýpočet kontrolného výkazu', default='nightly', required=True,
+        help='Ako často sa pripravujú koncepty kontrolného výkazu za aktuálny a predchádzajúci mesiac.')
+    kv_precompute_watermark = fields.Datetime('Predvýpočet KV zahŕňa zmeny do', readonly=True, copy=False)
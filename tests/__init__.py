@@ -0,0 +1,2 @@
+from . import test_aggregation
+from . import test_benchmark
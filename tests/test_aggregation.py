@@ -0,0 +1,177 @@
+from datetime import date
+
+from odoo.addons.account.tests.common import AccountTestInvoicingCommon
+from odoo.tests import tagged
+
+from ..models.kontrolny_vykaz import TOTAL_FIELDS
+
+AGGREGATION_MODES = ('sql', 'summary', 'orm')
+
+
+@tagged('-at_install', 'post_install')
+class TestAggregationEngines(AccountTestInvoicingCommon):
+    """The set-based engines and the ORM engine give the same groups on one month of documents"""
+
+    @classmethod
+    def setUpClass(cls):
+        super().setUpClass()
+        cls.company = cls.company_data['company']
+        Tax = cls.env['account.tax']
+        cls.tax_23, cls.tax_5, cls.tax_0 = (Tax.create({
+            'name': f'KV {amount} %',
+            'amount': amount,
+            'amount_type': 'percent',
+            'type_tax_use': 'sale',
+            'company_id': cls.company.id,
+        }) for amount in (23.0, 5.0, 0.0))
+        Partner = cls.env['res.partner'].with_context(no_vat_validation=True)
+        cls.partner_sk = Partner.create({'name': 'KV SK platiteľ', 'vat': 'SK2020123456', 'is_company': True})
+        cls.partner_foreign = Partner.create({'name': 'KV CZ odberateľ', 'vat': 'CZ12345678', 'is_company': True})
+        cls.partner_individual = Partner.create({'name': 'KV fyzická osoba'})
+
+        cls.invoice_sk = cls._create_document('out_invoice', cls.partner_sk, date(2025, 3, 10),
+                                              [(100.0, cls.tax_23), (200.0, cls.tax_5), (50.0, cls.tax_0)])
+        cls.invoice_individual = cls._create_document('out_invoice', cls.partner_individual, date(2025, 3, 12),
+                                                      [(80.0, cls.tax_23)])
+        cls.invoice_foreign = cls._create_document('out_invoice', cls.partner_foreign, date(2025, 3, 15),
+                                                   [(40.0, cls.tax_5)])
+        cls.refund_sk = cls._create_document('out_refund', cls.partner_sk, date(2025, 3, 20),
+                                             [(30.0, cls.tax_23)])
+        cls.invoice_outside = cls._create_document('out_invoice', cls.partner_sk, date(2025, 4, 3),
+                                                   [(10.0, cls.tax_23)])
+        # Reversed in April: the refund follows the March date of its invoice
+        cls.invoice_reversed = cls._create_document('out_invoice', cls.partner_sk, date(2025, 3, 5),
+                                                    [(60.0, cls.tax_23)])
+        cls.refund_reversal = cls.invoice_reversed._reverse_moves(
+            [{'invoice_date': date(2025, 4, 2), 'date': date(2025, 4, 2)}], cancel=True)
+
+        cls.statement = cls.env['kontrolny.vykaz'].create({
+            'company_id': cls.company.id,
+            'period_type': 'month',
+            'month': '03',
+            'year': 2025,
+            'date_from': date(2025, 3, 1),
+            'date_to': date(2025, 3, 31),
+        })
+
+    @classmethod
+    def _create_document(cls, move_type, partner, invoice_date, lines):
+        move = cls.env['account.move'].create({
+            'move_type': move_type,
+            'partner_id': partner.id,
+            'invoice_date': invoice_date,
+            'date': invoice_date,
+            'invoice_line_ids': [(0, 0, {
+                'name': f'Položka {index}',
+                'quantity': 1,
+                'price_unit': price,
+                'tax_ids': [(6, 0, tax.ids)],
+            }) for index, (price, tax) in enumerate(lines)],
+        })
+        move.action_post()
+        return move
+
+    def _groups(self, mode):
+        groups = self.statement.with_context(kv_aggregation_mode=mode)._aggregate_document_groups()
+        return {
+            (group['move_id'], round(group['tax_rate'], 4)): (
+                round(group['base'], 2), round(group['tax'], 2), group['is_refund'], group['has_vat_id'],
+                group['supply_date'], group['invoice_number'],
+            )
+            for group in groups
+        }
+
+    def test_engines_agree(self):
+        reference = self._groups('orm')
+        self.assertTrue(reference)
+        for mode in ('sql', 'summary'):
+            with self.subTest(mode=mode):
+                self.assertEqual(self._groups(mode), reference)
+        self.assertEqual(self.statement._check_aggregation_engines(), [])
+
+    def test_period_rules(self):
+        for mode in AGGREGATION_MODES:
+            with self.subTest(mode=mode):
+                groups = self._groups(mode)
+                move_ids = {move_id for move_id, _rate in groups}
+                rates = {rate for _move_id, rate in groups}
+                # 0% lines are skipped, documents supplied outside the period left out
+                self.assertNotIn(0.0, rates)
+                self.assertNotIn(self.invoice_outside.id, move_ids)
+                self.assertEqual(set(groups), {
+                    (self.invoice_sk.id, 23.0), (self.invoice_sk.id, 5.0),
+                    (self.invoice_individual.id, 23.0), (self.invoice_foreign.id, 5.0),
+                    (self.refund_sk.id, 23.0),
+                    (self.invoice_reversed.id, 23.0), (self.refund_reversal.id, 23.0),
+                })
+                # The refund of the reversed invoice takes the date of the invoice
+                reversal = groups[(self.refund_reversal.id, 23.0)]
+                self.assertEqual(reversal[4], date(2025, 3, 5))
+                # Refunds are negative and flagged
+                for move in (self.refund_sk, self.refund_reversal):
+                    base, tax, is_refund = groups[(move.id, 23.0)][:3]
+                    self.assertTrue(is_refund)
+                    self.assertLess(base, 0.0)
+                    self.assertLess(tax, 0.0)
+                # Only Slovak VAT IDs get their own A1/C1 records
+                self.assertTrue(groups[(self.invoice_sk.id, 23.0)][3])
+                self.assertFalse(groups[(self.invoice_foreign.id, 5.0)][3])
+                self.assertFalse(groups[(self.invoice_individual.id, 23.0)][3])
+
+    def _eur(self, amount, move):
+        # Independent of the engines: company currency to EUR at the accounting date
+        company_currency = self.company.currency_id
+        eur = self.env.ref('base.EUR')
+        if company_currency == eur:
+            return amount
+        return company_currency._convert(amount, eur, self.company, move.date)
+
+    def test_amounts_from_balances(self):
+        # Line with two taxes: its base counts for both rates, each rate only gets its own tax
+        invoice_two_taxes = self._create_document('out_invoice', self.partner_sk, date(2025, 3, 25),
+                                                  [(100.0, self.tax_23 | self.tax_5)])
+        expected = {
+            (self.invoice_sk, 23.0): (100.0, 23.0),
+            (self.invoice_sk, 5.0): (200.0, 10.0),
+            (self.invoice_individual, 23.0): (80.0, 18.4),
+            (self.invoice_foreign, 5.0): (40.0, 2.0),
+            (self.refund_sk, 23.0): (-30.0, -6.9),
+            (self.invoice_reversed, 23.0): (60.0, 13.8),
+            (self.refund_reversal, 23.0): (-60.0, -13.8),
+            (invoice_two_taxes, 23.0): (100.0, 23.0),
+            (invoice_two_taxes, 5.0): (100.0, 5.0),
+        }
+        expected = {
+            (move.id, rate): (round(self._eur(base, move), 2), round(self._eur(tax, move), 2))
+            for (move, rate), (base, tax) in expected.items()
+        }
+        for mode in AGGREGATION_MODES:
+            with self.subTest(mode=mode):
+                groups = self._groups(mode)
+                self.assertEqual({key: values[:2] for key, values in groups.items()}, expected)
+
+    def test_statement_currency(self):
+        self.assertEqual(self.statement.currency_id, self.env.ref('base.EUR'))
+
+    def _assert_totals_match_lines(self):
+        maintained = {name: self.statement[name] for name in TOTAL_FIELDS}
+        self.statement._compute_totals()
+        self.assertEqual(maintained, {name: self.statement[name] for name in TOTAL_FIELDS})
+
+    def test_totals_follow_lines(self):
+        # The generation leaves the totals to the line hooks and the bulk insert paths
+        self.statement._generate()
+        self.assertTrue(self.statement.total_a_base)
+        self._assert_totals_match_lines()
+        self._create_document('out_invoice', self.partner_sk, date(2025, 3, 26), [(70.0, self.tax_23)])
+        self.statement._generate()
+        self._assert_totals_match_lines()
+        # COPY path and a full rebuild over existing lines
+        self.env['ir.config_parameter'].sudo().set_param('kontrolny_vykaz.copy_threshold', 1)
+        self.statement.write({'generation_watermark': False, 'generation_data': False})
+        self.statement._generate()
+        self._assert_totals_match_lines()
+        # Archiving keeps the totals, restoring the lines must not add them twice
+        self.statement._compact_lines()
+        self.statement._restore_lines()
+        self._assert_totals_match_lines()
@@ -0,0 +1,33 @@
+import os
+
+from odoo.tests import TransactionCase, tagged
+
+from ..tools.benchmark import check_regressions, load_baseline, run_benchmark
+
+BASELINE_PATH = os.path.join(os.path.dirname(os.path.abspath(__file__)), 'kv_benchmark_baseline.json')
+
+
+@tagged('-at_install', 'post_install', 'kv_benchmark')
+class TestKontrolnyVykazBenchmark(TransactionCase):
+    """Benchmark of generation and exports on synthetic data, failing on a regression past the baseline.
+
+    The committed baseline holds query budgets, which do not depend on the
+    machine; a baseline written by benchmark.py on a reference machine can
+    be given in KV_BENCHMARK_BASELINE instead. KV_BENCHMARK_SIZES lists the
+    document counts to run (default 1000).
+    """
+
+    def test_generation_and_exports(self):
+        company = self.env.company
+        sizes = [int(size) for size in os.environ.get('KV_BENCHMARK_SIZES', '1000').split()]
+        results = {}
+        # One month per size, so that the sizes do not add up in one statement
+        for month, size in enumerate(sizes, start=1):
+            try:
+                results[size] = run_benchmark(self.env, company, 2099, month, size)
+            except ValueError as e:
+                self.skipTest(str(e))
+        baseline = load_baseline(os.environ.get('KV_BENCHMARK_BASELINE') or BASELINE_PATH)
+        tolerance = float(os.environ.get('KV_BENCHMARK_TOLERANCE', 1.25))
+        regressions = check_regressions(results, baseline, tolerance)
+        self.assertFalse(regressions, '\n'.join(regressions))
@@ -0,0 +1,8 @@
+from . import amounts
+from . import classification
+from . import instrumentation
+from . import kv_xml
+from . import kv_xsd
+from . import line_archive
+from . import migration
+from . import reversal_map
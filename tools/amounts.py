@@ -0,0 +1,57 @@
+from datetime import date as Date
+
+
+def move_tax_amounts_query(move_filter):
+    """Query of the base and tax contributions of customer documents per tax rate, in company currency.
+
+    Each product line gives its balance as base to every tax it carries and
+    each tax line gives its balance as tax to the rate of its tax, so a line
+    with several taxes no longer counts the tax of the others. Amounts are
+    negated balances: positive for invoices, negative for refunds. Rows carry
+    move_id, tax_rate, base, tax and line_id (of the product line, NULL for tax
+    lines). `move_filter` restricts account_move_line.move_id, e.g.
+    "= ANY(%(move_ids)s)".
+    """
+    return f"""
+        SELECT l.move_id, t.amount AS tax_rate, -l.balance AS base, 0.0 AS tax, l.id AS line_id
+          FROM account_move_line l
+          JOIN account_move_line_account_tax_rel rel ON rel.account_move_line_id = l.id
+          JOIN account_tax t ON t.id = rel.account_tax_id
+         WHERE l.display_type IN ('product', 'line_section', 'line_note')
+           AND l.move_id {move_filter}
+     UNION ALL
+        SELECT l.move_id, t.amount, 0.0, -l.balance, NULL
+          FROM account_move_line l
+          JOIN account_tax t ON t.id = l.tax_line_id
+         WHERE l.display_type = 'tax'
+           AND l.move_id {move_filter}
+    """
+
+
+class CurrencyRateCache:
+    """Rates from the company currency to EUR, the currency of the statement, looked up once per date and run.
+
+    Journal items are already in the company currency at the rate of their
+    posting, foreign currency invoices included; only companies keeping their
+    books in another currency than EUR need a conversion.
+    """
+
+    def __init__(self, env, company):
+        self.env = env
+        self.company = company
+        self.source = company.currency_id
+        self.target = env.ref('base.EUR')
+        self.active = self.source != self.target
+        self._rates = {}
+
+    def rate(self, date):
+        date = date or Date.today()
+        if date not in self._rates:
+            self._rates[date] = self.env['res.currency']._get_conversion_rate(
+                self.source, self.target, self.company, date)
+        return self._rates[date]
+
+    def convert(self, amount, date):
+        if not self.active:
+            return amount
+        return self.target.round(amount * self.rate(date))
@@ -0,0 +1,198 @@
+import json
+import random
+import time
+import tracemalloc
+from datetime import date
+
+from dateutil.relativedelta import relativedelta
+
+from .reversal_map import REVERSAL_REF_PREFIX
+
+BENCHMARK_SIZES = (1000, 10000, 100000)
+BENCHMARK_OPERATIONS = ('generate', 'compute_totals', 'export_xml', 'export_excel')
+
+# Share of each partner kind in the synthetic dataset
+PARTNER_MIX = (
+    ('sk_payer', 0.4),        # SK VAT ID, x_platca_dph set
+    ('sk_non_payer', 0.1),    # SK VAT ID, x_platca_dph not set
+    ('foreign', 0.1),         # EU VAT ID of another country
+    ('individual', 0.4),      # no VAT ID
+)
+CREATE_BATCH_SIZE = 500
+
+
+def _sk_vat(rng):
+    """Random SK VAT ID passing the checksum of the Slovak tax authority"""
+    while True:
+        number = rng.randrange(10 ** 9, 10 ** 10)
+        digits = str(number)
+        if number % 11 == 0 and digits[2] in '234789':
+            return f'SK{digits}'
+
+
+class SyntheticDataset:
+    """Posted customer invoices, refunds and reversed invoices of one month, with their partners.
+
+    Documents get one to three lines at the sale tax rates found for the
+    company, so multi-rate documents are common. Everything is created through
+    the ORM in the current transaction; benchmarks roll it back afterwards.
+    """
+
+    def __init__(self, env, company, year, month, seed=0):
+        self.env = env.with_company(company).with_context(no_vat_validation=True, tracking_disable=True,
+                                                           mail_create_nolog=True, mail_notrack=True)
+        self.company = company
+        self.date_from = date(year, month, 1)
+        self.date_to = self.date_from + relativedelta(months=1, days=-1)
+        self.rng = random.Random(seed)
+        self.partners = self.env['res.partner']
+        self.taxes = self.env['account.tax'].search([
+            ('company_id', '=', company.id),
+            ('type_tax_use', '=', 'sale'),
+            ('amount_type', '=', 'percent'),
+            ('amount', 'in', [0.0, 5.0, 19.0, 23.0]),
+            ('price_include', '=', False),
+        ])
+        if not self.taxes.filtered('amount'):
+            raise ValueError(f"Company {company.name} has no 5/19/23 % sale taxes to build invoices with")
+
+    def create_partners(self, count):
+        Partner = self.env['res.partner']
+        has_platca_dph = 'x_platca_dph' in Partner._fields
+        kinds = [kind for kind, _share in PARTNER_MIX]
+        weights = [share for _kind, share in PARTNER_MIX]
+        vals_list = []
+        for index in range(count):
+            kind = self.rng.choices(kinds, weights)[0]
+            vals = {'name': f'KV benchmark {kind} {index}', 'is_company': kind != 'individual'}
+            if kind in ('sk_payer', 'sk_non_payer'):
+                vals['vat'] = _sk_vat(self.rng)
+            elif kind == 'foreign':
+                vals['vat'] = f'CZ{self.rng.randrange(10 ** 7, 10 ** 8)}'
+            if has_platca_dph:
+                vals['x_platca_dph'] = kind == 'sk_payer'
+            vals_list.append(vals)
+        self.partners |= Partner.create(vals_list)
+        return self.partners
+
+    def _document_vals(self, move_type):
+        invoice_date = self.date_from + relativedelta(days=self.rng.randrange((self.date_to - self.date_from).days + 1))
+        return {
+            'move_type': move_type,
+            'partner_id': self.rng.choice(self.partners).id,
+            'invoice_date': invoice_date,
+            'taxable_supply_date': invoice_date,
+            'invoice_line_ids': [
+                (0, 0, {
+                    'name': f'Položka {line}',
+                    'quantity': self.rng.randint(1, 10),
+                    'price_unit': round(self.rng.uniform(1.0, 2000.0), 2),
+                    'tax_ids': [(6, 0, self.rng.choice(self.taxes).ids)],
+                })
+                for line in range(self.rng.randint(1, 3))
+            ],
+        }
+
+    def create_documents(self, count, refund_ratio=0.1, reversed_ratio=0.05):
+        """Create and post `count` documents: invoices, standalone refunds and reversed invoices with their refunds"""
+        if not self.partners:
+            self.create_partners(max(count // 10, 10))
+        Move = self.env['account.move']
+        reversed_count = int(count * reversed_ratio)
+        refund_count = int(count * refund_ratio)
+        # Every reversed invoice brings its own refund
+        invoice_count = count - refund_count - 2 * reversed_count
+        plan = ['out_invoice'] * (invoice_count + reversed_count) + ['out_refund'] * refund_count
+        moves = Move
+        for index in range(0, len(plan), CREATE_BATCH_SIZE):
+            batch = Move.create([self._document_vals(move_type) for move_type in plan[index:index + CREATE_BATCH_SIZE]])
+            batch.action_post()
+            moves |= batch
+            batch.invalidate_recordset()
+        to_reverse = moves.filtered(lambda m: m.move_type == 'out_invoice')[:reversed_count]
+        for index in range(0, len(to_reverse), CREATE_BATCH_SIZE):
+            batch = to_reverse[index:index + CREATE_BATCH_SIZE]
+            batch._reverse_moves([{
+                'ref': f'{REVERSAL_REF_PREFIX} {move.name}',
+                'invoice_date': move.invoice_date,
+            } for move in batch], cancel=True)
+        self.env.flush_all()
+        return moves
+
+
+def measure(env, method):
+    """Run `method`; return its wall time in seconds, SQL query count and peak Python memory in KiB"""
+    env.flush_all()
+    tracing = tracemalloc.is_tracing()
+    if not tracing:
+        tracemalloc.start()
+    tracemalloc.reset_peak()
+    start_queries = env.cr.sql_log_count
+    start = time.perf_counter()
+    method()
+    env.flush_all()
+    result = {
+        'seconds': time.perf_counter() - start,
+        'queries': env.cr.sql_log_count - start_queries,
+        'peak_memory_kb': tracemalloc.get_traced_memory()[1] // 1024,
+    }
+    if not tracing:
+        tracemalloc.stop()
+    return result
+
+
+def run_benchmark(env, company, year, month, documents, seed=0):
+    """Build a synthetic month of `documents` documents and measure generation and exports on it"""
+    dataset = SyntheticDataset(env, company, year, month, seed=seed)
+    dataset.create_documents(documents)
+    statement = env['kontrolny.vykaz']._get_or_create_for_period(company, year, month)
+    if statement.state != 'draft':
+        statement.action_reset_to_draft()
+    totals = ['total_a_base', 'total_a_tax', 'total_c_base', 'total_c_tax']
+
+    def compute_totals():
+        statement.invalidate_recordset(totals)
+        statement._compute_totals()
+
+    results = {'generate': measure(env, statement.action_generate_statement_full)}
+    results['compute_totals'] = measure(env, compute_totals)
+    statement.action_confirm()
+    results['export_xml'] = measure(env, statement.action_export)
+    results['export_excel'] = measure(env, statement.action_export_excel)
+    return results
+
+
+def load_baseline(path):
+    try:
+        with open(path) as f:
+            return json.load(f)
+    except FileNotFoundError:
+        return {}
+
+
+def save_baseline(path, results):
+    """Write `results` ({size: {operation: measurement}}) as the new baseline"""
+    with open(path, 'w') as f:
+        json.dump({str(size): ops for size, ops in results.items()}, f, indent=2, sort_keys=True)
+
+
+def check_regressions(results, baseline, tolerance=1.25):
+    """Return a message for every measurement more than `tolerance` times its baseline value"""
+    regressions = []
+    for size, operations in results.items():
+        for operation, measurement in operations.items():
+            reference = baseline.get(str(size), {}).get(operation)
+            if not reference:
+                continue
+            for metric, value in measurement.items():
+                # Baselines may only hold the portable metrics, e.g. query counts
+                if metric not in reference:
+                    continue
+                limit = reference[metric] * tolerance
+                # Tiny values are dominated by noise
+                if metric == 'seconds':
+                    limit = max(limit, 0.05)
+                if value > limit:
+                    regressions.append(f"{operation} at {size} documents: {metric} {value:.2f} "
+                                       f"exceeds baseline {reference[metric]:.2f} x {tolerance}")
+    return regressions
@@ -0,0 +1,92 @@
+from collections import namedtuple
+
+# Tax rates reported with their own totals in the control statement
+KV_RATES = (5, 19, 23)
+
+PartnerInfo = namedtuple('PartnerInfo', ['has_sk_vat', 'is_vat_payer', 'vat'])
+TaxInfo = namedtuple('TaxInfo', ['rate', 'is_zero', 'kv_rate'])
+
+_UNKNOWN_PARTNER = PartnerInfo(False, False, '')
+
+
+def normalize_vat(vat):
+    # Same test as the SQL aggregation: UPPER(vat) LIKE 'SK%'
+    return (vat or '').upper()
+
+
+def compact_sk_vat(vat):
+    """Slovak VAT ID as filed in the XML: upper case, without separators, with the SK prefix"""
+    vat = ''.join(char for char in normalize_vat(vat) if char.isalnum())
+    if vat and not vat.startswith('SK'):
+        vat = 'SK' + vat
+    return vat
+
+
+def is_sk_vat(vat):
+    """Whether `vat` is a Slovak VAT ID, the only condition for separate A1/C1 records"""
+    return normalize_vat(vat).startswith('SK')
+
+
+class ClassificationCache:
+    """Partner VAT and tax rate classification, loaded once per generation or export run.
+
+    Partners and taxes are fetched in one query per batch of ids; the hot
+    loops then only look up ids instead of reading records. Whether the
+    partner model has the custom x_platca_dph field is resolved when the
+    cache is built.
+    """
+
+    def __init__(self, env):
+        self.env = env
+        self.has_platca_dph = 'x_platca_dph' in env['res.partner']._fields
+        self._partners = {}
+        self._taxes = {}
+
+    def add_partners(self, partner_ids):
+        """Load the classification of `partner_ids` not known yet"""
+        partner_ids = [pid for pid in set(partner_ids) if pid and pid not in self._partners]
+        if not partner_ids:
+            return self
+        field_names = ['vat', 'x_platca_dph'] if self.has_platca_dph else ['vat']
+        partners = self.env['res.partner'].with_context(active_test=False).search_fetch(
+            [('id', 'in', partner_ids)], field_names)
+        for partner in partners:
+            vat = normalize_vat(partner.vat)
+            self._partners[partner.id] = PartnerInfo(
+                has_sk_vat=vat.startswith('SK'),
+                is_vat_payer=bool(self.has_platca_dph and partner.x_platca_dph),
+                vat=vat,
+            )
+        partners.invalidate_recordset()
+        return self
+
+    def add_taxes(self, tax_ids):
+        """Load the rates of `tax_ids` not known yet"""
+        tax_ids = [tid for tid in set(tax_ids) if tid and tid not in self._taxes]
+        if not tax_ids:
+            return self
+        for tax in self.env['account.tax'].with_context(active_test=False).search_fetch(
+                [('id', 'in', tax_ids)], ['amount']):
+            rate = tax.amount
+            self._taxes[tax.id] = TaxInfo(
+                rate=rate,
+                is_zero=rate == 0,
+                kv_rate=round(rate) if round(rate) in KV_RATES else None,
+            )
+        return self
+
+    def partner(self, partner_id):
+        if partner_id and partner_id not in self._partners:
+            self.add_partners([partner_id])
+        return self._partners.get(partner_id, _UNKNOWN_PARTNER)
+
+    def tax(self, tax_id):
+        if tax_id not in self._taxes:
+            self.add_taxes([tax_id])
+        return self._taxes[tax_id]
+
+    def odb(self, partner_id, vat):
+        """Value of the Odb attribute: the Slovak VAT ID of a partner marked as VAT payer, else empty"""
+        if partner_id and self.partner(partner_id).is_vat_payer and is_sk_vat(vat):
+            return compact_sk_vat(vat)
+        return ''
@@ -0,0 +1,61 @@
+import time
+from contextlib import contextmanager
+
+
+class PhaseTimer:
+    """Collects wall time and query count of the phases of one generation or export run.
+
+    Query counts come from the cursor's own statement counter, so they include
+    every query the ORM issued on behalf of the phase.
+    """
+
+    def __init__(self, cr):
+        self.cr = cr
+        self.phases = []
+        self._start = time.perf_counter()
+        self._start_queries = cr.sql_log_count
+        # Time and queries of the earlier transactions of a resumed run
+        self._previous_ms = 0.0
+        self._previous_queries = 0
+
+    @classmethod
+    def resume(cls, cr, data):
+        """Timer carrying on a run measured in earlier transactions, from the `dump` they stored"""
+        timer = cls(cr)
+        if data:
+            timer.phases = [dict(record) for record in data['phases']]
+            timer._previous_ms = data['elapsed_ms']
+            timer._previous_queries = data['query_count']
+        return timer
+
+    def dump(self):
+        """JSON data of the run so far, repeated phases summed, to be resumed in another transaction"""
+        phases = {}
+        for record in self.phases:
+            total = phases.setdefault(record['phase'], {
+                'phase': record['phase'], 'documents': 0, 'lines': 0, 'duration_ms': 0.0, 'query_count': 0,
+            })
+            for key in ('documents', 'lines', 'duration_ms', 'query_count'):
+                total[key] += record[key]
+        return {'phases': list(phases.values()), 'elapsed_ms': self.elapsed_ms, 'query_count': self.query_count}
+
+    @contextmanager
+    def phase(self, name):
+        """Measure the enclosed block; the yielded dict takes `documents` and `lines` counts"""
+        record = {'phase': name, 'documents': 0, 'lines': 0}
+        start = time.perf_counter()
+        start_queries = self.cr.sql_log_count
+        try:
+            yield record
+        finally:
+            record['duration_ms'] = (time.perf_counter() - start) * 1000.0
+            record['query_count'] = self.cr.sql_log_count - start_queries
+            self.phases.append(record)
+
+    @property
+    def elapsed_ms(self):
+        return self._previous_ms + (time.perf_counter() - self._start) * 1000.0
+
+    @property
+    def query_count(self):
+        return self._previous_queries + self.cr.sql_log_count - self._start_queries
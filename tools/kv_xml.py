@@ -0,0 +1,66 @@
+# XML declaration required by the eDane portal
+XML_DECLARATION = '<?xml version="1.0" encoding="UTF-8" standalone="yes"?>'
+
+
+def _escape(value):
+    # Same escaping minidom applies to both text and attribute values
+    return value.replace("&", "&amp;").replace("<", "&lt;").replace('"', "&quot;").replace(">", "&gt;")
+
+
+class KVXmlWriter:
+    """Incremental, pretty-printing XML writer for the KVDPH document.
+
+    Every element is written to `stream` as soon as it is known, so memory
+    stays flat no matter how many A1/C1 records a statement holds. The output
+    is the one the previous ElementTree + minidom pipeline produced: two space
+    indentation, one element per line, `<Tag/>` for empty elements, no blank
+    lines and no trailing newline.
+    """
+
+    def __init__(self, stream, indent="  ", encoding="utf-8"):
+        self.stream = stream
+        self.indent = indent
+        self.encoding = encoding
+        self._open_tags = []
+
+    def _write_line(self, line):
+        # The previous pipeline dropped whitespace-only lines, which also
+        # affects values containing line breaks
+        lines = [part for part in line.splitlines() if part.strip()]
+        if lines:
+            self.stream.write(("\n" + "\n".join(lines)).encode(self.encoding))
+
+    def _open(self, tag, attrs):
+        parts = [self.indent * len(self._open_tags), "<", tag]
+        for name, value in (attrs or {}).items():
+            parts.append(f' {name}="{_escape(value)}"')
+        return "".join(parts)
+
+    def declaration(self):
+        self.stream.write(XML_DECLARATION.encode(self.encoding))
+
+    def start(self, tag, attrs=None):
+        """Open an element that will contain child elements"""
+        self._write_line(self._open(tag, attrs) + ">")
+        self._open_tags.append(tag)
+
+    def end(self):
+        """Close the innermost open element"""
+        tag = self._open_tags.pop()
+        self._write_line(f"{self.indent * len(self._open_tags)}</{tag}>")
+
+    def element(self, tag, text=None, attrs=None):
+        """Write a leaf element with optional text and attributes"""
+        line = self._open(tag, attrs)
+        if text:
+            # The XML parser of the previous pipeline normalised line endings
+            text = text.replace("\r\n", "\n").replace("\r", "\n")
+            line += f">{_escape(text)}</{tag}>"
+        else:
+            line += "/>"
+        self._write_line(line)
+
+    def close(self):
+        """Close all elements still open"""
+        while self._open_tags:
+            self.end()
@@ -0,0 +1,55 @@
+import os
+import threading
+
+from lxml import etree
+
+XSD_PATH = os.path.join(os.path.dirname(os.path.dirname(os.path.abspath(__file__))), 'data', 'xsd', 'kv_dph_2025.xsd')
+
+_schema = None
+_schema_lock = threading.Lock()
+
+
+def get_schema():
+    """The compiled KVDPH_2025 schema, parsed once per worker process"""
+    global _schema
+    if _schema is None:
+        with _schema_lock:
+            if _schema is None:
+                _schema = etree.XMLSchema(etree.parse(XSD_PATH))
+    return _schema
+
+
+def validate_stream(stream):
+    """Validate the KVDPH document read from the binary `stream`; return its violations.
+
+    Each violation is a dict with the line, the message, the record tag
+    (A1, C1, ...) and the invoice number of the offending record, if any.
+    The document is parsed straight from the (spooled) file, without
+    building an intermediate string.
+    """
+    schema = get_schema()
+    parser = etree.XMLParser(resolve_entities=False, no_network=True, huge_tree=True)
+    try:
+        document = etree.parse(stream, parser)
+    except etree.XMLSyntaxError as e:
+        return [{'line': e.lineno, 'message': e.msg, 'tag': None, 'invoice': None}]
+    if schema.validate(document):
+        return []
+
+    errors = list(schema.error_log)
+    lines = {error.line for error in errors}
+    records = {}
+    for element in document.iter():
+        if element.sourceline in lines and element.sourceline not in records:
+            records[element.sourceline] = element
+    violations = []
+    for error in errors:
+        element = records.get(error.line)
+        tag = etree.QName(element).localname if element is not None else None
+        violations.append({
+            'line': error.line,
+            'message': error.message,
+            'tag': tag,
+            'invoice': element.get('F') or element.get('FP') if element is not None else None,
+        })
+    return violations
@@ -0,0 +1,35 @@
+import gzip
+import io
+import json
+
+# Columns of kontrolny_vykaz_a_line kept in the archive, in row order
+ARCHIVE_COLUMNS = [
+    'partner_id', 'partner_vat', 'invoice_id', 'invoice_number', 'invoice_date', 'supply_date',
+    'base_amount', 'tax_rate', 'tax_amount', 'is_summary', 'is_refund',
+]
+
+_FLOAT_COLUMNS = ('base_amount', 'tax_rate', 'tax_amount')
+
+
+def pack_rows(batches):
+    """Gzipped JSON lines of the rows yielded in `batches` (lists of tuples in ARCHIVE_COLUMNS order)"""
+    buffer = io.BytesIO()
+    # Fixed mtime: the same lines always give the same archive
+    with gzip.GzipFile(fileobj=buffer, mode='wb', mtime=0) as archive:
+        for rows in batches:
+            for row in rows:
+                archive.write(json.dumps(row, default=str).encode())
+                archive.write(b'\n')
+    return buffer.getvalue()
+
+
+def unpack_rows(data):
+    """Yield the rows of a packed archive as dicts of line values"""
+    with gzip.GzipFile(fileobj=io.BytesIO(data)) as archive:
+        for raw in archive:
+            values = dict(zip(ARCHIVE_COLUMNS, json.loads(raw)))
+            for name in _FLOAT_COLUMNS:
+                values[name] = float(values[name] or 0.0)
+            values['is_summary'] = bool(values['is_summary'])
+            values['is_refund'] = bool(values['is_refund'])
+            yield values
@@ -0,0 +1,52 @@
+import logging
+import time
+
+_logger = logging.getLogger(__name__)
+
+# Rows updated per committed batch of a backfill
+BACKFILL_BATCH_SIZE = 20000
+
+# Seconds to wait between two committed batches, leaving room for the regular load
+BACKFILL_PAUSE = 0.1
+
+
+def backfill_in_batches(cr, table, assignments, from_clause='', condition='TRUE', params=None,
+                        batch_size=BACKFILL_BATCH_SIZE, pause=BACKFILL_PAUSE, commit=False):
+    """Run `UPDATE table t SET assignments FROM from_clause WHERE condition` in id-ranged batches.
+
+    The table is walked by ranges of `batch_size` ids, so every statement only
+    scans and joins the rows of its range, whatever the size of the table.
+    Committing is left to the caller: inside a module upgrade every batch
+    stays in the upgrade transaction, so a later failing migration rolls the
+    whole upgrade back. Only a caller running on its own (a script or a
+    scheduled action) should pass `commit`, which commits each batch to
+    release its locks; `condition` must then leave out the rows already
+    done, so that running it again resumes where it stopped. The table is
+    aliased `t`; `params` are passed to every batch next to id_from and
+    id_to. Return the number of rows updated.
+    """
+    cr.execute(f"SELECT MIN(id), MAX(id) FROM {table}")
+    min_id, max_id = cr.fetchone()
+    if min_id is None:
+        return 0
+    query = f"""
+        UPDATE {table} t
+           SET {assignments}
+               {f'FROM {from_clause}' if from_clause else ''}
+         WHERE t.id >= %(id_from)s AND t.id < %(id_to)s
+           AND ({condition})
+    """
+    updated = 0
+    span = max_id - min_id + 1
+    for id_from in range(min_id, max_id + 1, batch_size):
+        id_to = id_from + batch_size
+        cr.execute(query, dict(params or {}, id_from=id_from, id_to=id_to))
+        updated += cr.rowcount
+        if commit:
+            cr.commit()
+        _logger.info("Backfill of %s: %d%% of the ids, %s rows updated",
+                     table, min(100, (id_to - min_id) * 100 // span), updated)
+        # Pausing only helps the regular load once the locks are released
+        if commit and pause and id_to <= max_id:
+            time.sleep(pause)
+    return updated
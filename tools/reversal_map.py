@@ -0,0 +1,69 @@
+from collections import defaultdict
+
+# Prefix Odoo puts into the reference of a reversal move
+REVERSAL_REF_PREFIX = "Obrátenie z:"
+
+
+class ReversalMap:
+    """Posted customer refunds indexed by the invoice they reverse.
+
+    Built once per generation/export run with one query per batch of moves,
+    instead of one `search` per reversed invoice or per C1 line.
+    """
+
+    def __init__(self, env):
+        self.env = env
+        self._refunds_by_original = defaultdict(list)
+        self._loaded_originals = set()
+        self._origin_by_refund = {}
+
+    def add_originals(self, original_ids):
+        """Load the posted refunds reversing any of `original_ids`"""
+        original_ids = [oid for oid in original_ids if oid not in self._loaded_originals]
+        if not original_ids:
+            return self
+        refunds = self.env['account.move'].search_fetch([
+            ('reversed_entry_id', 'in', original_ids),
+            ('move_type', '=', 'out_refund'),
+            ('state', '=', 'posted'),
+        ], ['name', 'ref', 'reversed_entry_id'])
+        self._loaded_originals.update(original_ids)
+        self._index_refunds(refunds, by_original=True)
+        return self
+
+    def add_refunds(self, refund_ids):
+        """Load the original invoice numbers of the refunds `refund_ids`"""
+        refund_ids = [rid for rid in refund_ids if rid not in self._origin_by_refund]
+        if not refund_ids:
+            return self
+        refunds = self.env['account.move'].browse(refund_ids)
+        refunds.fetch(['name', 'ref', 'reversed_entry_id'])
+        self._index_refunds(refunds)
+        return self
+
+    def _index_refunds(self, refunds, by_original=False):
+        # One batched read of the original invoice names
+        refunds.reversed_entry_id.fetch(['name'])
+        for refund in refunds:
+            if by_original:
+                self._refunds_by_original[refund.reversed_entry_id.id].append(refund)
+            if refund.reversed_entry_id:
+                self._origin_by_refund[refund.id] = refund.reversed_entry_id.name
+            elif refund.ref and REVERSAL_REF_PREFIX in refund.ref:
+                # Extract original invoice number from the reference
+                self._origin_by_refund[refund.id] = refund.ref.replace(REVERSAL_REF_PREFIX, "").strip()
+            else:
+                self._origin_by_refund[refund.id] = ""
+
+    def refunds_for(self, original_id):
+        """Posted refunds reversing the invoice `original_id`"""
+        return self.env['account.move'].union(*self._refunds_by_original.get(original_id, []))
+
+    def all_refunds(self):
+        """All posted refunds loaded through `add_originals`"""
+        return self.env['account.move'].union(*(
+            refund for refunds in self._refunds_by_original.values() for refund in refunds))
+
+    def original_number(self, refund_id):
+        """Number of the invoice reversed by `refund_id`, or an empty string"""
+        return self._origin_by_refund.get(refund_id, "")
@@ -0,0 +1,119 @@
+"""Month-end batch runner for the Slovak VAT control statement.
+
+Creates or reuses the monthly `kontrolny.vykaz` of every company, generates it
+and exports the XML and Excel files. Companies are processed in parallel, each
+worker process with its own registry and database cursor, so the whole batch
+takes about as long as the slowest company.
+
+Usage:
+
+    python3 update_database.py -c /etc/odoo/odoo.conf -d mydb --year 2025 --month 9 \\
+        [--company 1 --company 3] [--workers 8] [--output-dir /tmp/kv] [--force]
+
+Without --company, all companies located in Slovakia are processed. Statements
+already exported are skipped unless --force is given.
+"""
+import argparse
+import logging
+import multiprocessing
+import os
+import time
+from concurrent.futures import ProcessPoolExecutor, as_completed
+
+_logger = logging.getLogger('kontrolny_vykaz.batch')
+
+
+def _init_worker(odoo_args):
+    import odoo
+    odoo.tools.config.parse_config(odoo_args)
+    odoo.netsvc.init_logger()
+
+
+def _run_company(dbname, company_id, year, month, output_dir, force):
+    """Process one company in its own cursor; return a report dict"""
+    import base64
+    from odoo import api, SUPERUSER_ID
+    from odoo.modules.registry import Registry
+
+    start = time.monotonic()
+    report = {'company_id': company_id, 'timings': {}, 'error': None}
+    try:
+        with Registry(dbname).cursor() as cr:
+            env = api.Environment(cr, SUPERUSER_ID, {'allowed_company_ids': [company_id]})
+            company = env['res.company'].browse(company_id)
+            report['company'] = company.name
+            statement = env['kontrolny.vykaz']._get_or_create_for_period(company, year, month)
+            report['statement'] = statement.name
+            report['timings'] = statement._run_month_end_batch(force=force)
+            if output_dir and report['timings']:
+                for filename, data in ((statement.xml_filename, statement.xml_file),
+                                       (statement.excel_filename, statement.excel_file)):
+                    if filename and data:
+                        path = os.path.join(output_dir, f'{company_id}_{filename}')
+                        with open(path, 'wb') as f:
+                            f.write(base64.b64decode(data))
+    except Exception as e:
+        _logger.exception("Month-end batch failed for company %s", company_id)
+        report['error'] = str(e)
+    report['total'] = time.monotonic() - start
+    return report
+
+
+def _get_company_ids(dbname):
+    from odoo import api, SUPERUSER_ID
+    from odoo.modules.registry import Registry
+
+    with Registry(dbname).cursor() as cr:
+        env = api.Environment(cr, SUPERUSER_ID, {})
+        return env['res.company'].search([('country_id.code', '=', 'SK')]).ids
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.split('\n\n')[0])
+    parser.add_argument('-c', '--config', required=True, help='Odoo configuration file')
+    parser.add_argument('-d', '--database', required=True)
+    parser.add_argument('--year', type=int, required=True)
+    parser.add_argument('--month', type=int, required=True, choices=range(1, 13))
+    parser.add_argument('--company', type=int, action='append', dest='company_ids',
+                        help='company id to process, can be repeated (default: all Slovak companies)')
+    parser.add_argument('--workers', type=int, default=os.cpu_count(),
+                        help='number of worker processes (default: number of CPUs)')
+    parser.add_argument('--output-dir', help='also write the exported files to this directory')
+    parser.add_argument('--force', action='store_true', help='regenerate statements already exported')
+    args = parser.parse_args()
+
+    odoo_args = ['-c', args.config, '-d', args.database]
+    _init_worker(odoo_args)
+    company_ids = args.company_ids or _get_company_ids(args.database)
+    if args.output_dir:
+        os.makedirs(args.output_dir, exist_ok=True)
+
+    start = time.monotonic()
+    reports = []
+    # Spawned workers start without the parent's database connections
+    context = multiprocessing.get_context('spawn')
+    with ProcessPoolExecutor(max_workers=min(args.workers, len(company_ids)) or 1, mp_context=context,
+                             initializer=_init_worker, initargs=(odoo_args,)) as executor:
+        futures = [
+            executor.submit(_run_company, args.database, company_id, args.year, args.month,
+                            args.output_dir, args.force)
+            for company_id in company_ids
+        ]
+        for future in as_completed(futures):
+            report = future.result()
+            reports.append(report)
+            _logger.info("Company %s done in %.1fs", report.get('company', report['company_id']), report['total'])
+
+    phases = ['generate', 'export_xml', 'export_excel']
+    print(f"{'Company':<40} {'Statement':<16} " + ' '.join(f'{p:>12}' for p in phases) + f" {'Total':>8}  Status")
+    for report in sorted(reports, key=lambda r: -r['total']):
+        status = report['error'] or ('skipped (exported)' if not report['timings'] else 'ok')
+        print(f"{str(report.get('company', report['company_id']))[:40]:<40} {report.get('statement', ''):<16} "
+              + ' '.join(f"{report['timings'].get(p, 0.0):>11.1f}s" for p in phases)
+              + f" {report['total']:>7.1f}s  {status}")
+    print(f"{len(reports)} companies in {time.monotonic() - start:.1f}s")
+    return 1 if any(report['error'] for report in reports) else 0
+
+
+if __name__ == '__main__':
+    raise SystemExit(main())